@@ -0,0 +1,115 @@
+import heapq
+import itertools
+import threading
+import time
+
+# Same order as the webapp's PriorityQueue comparator: severity rank first, then arrival
+SEVERITY_RANK = {"emergent": 0, "urgent": 1, "moderate": 2, "routine": 3}
+UNKNOWN_RANK = SEVERITY_RANK["moderate"]
+
+# How long a request may wait for a slot before it is shed; emergencies are never shed on time
+DEFAULT_LATENCY_BUDGETS = {"emergent": None, "urgent": 4.0, "moderate": 3.0, "routine": 1.0}
+
+_WAITING, _ADMITTED, _SHED = "waiting", "admitted", "shed"
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed instead of admitted; retry_after is a hint in seconds."""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_budgets(spec, defaults=DEFAULT_LATENCY_BUDGETS):
+    """'routine=1,moderate=2.5' -> budgets dict on top of defaults; 'none' means never shed on time."""
+    budgets = dict(defaults)
+    for part in filter(None, (p.strip() for p in (spec or "").split(","))):
+        severity, _, value = part.partition("=")
+        budgets[severity.strip()] = None if value.strip().lower() == "none" else float(value)
+    return budgets
+
+
+class AdmissionController:
+    """
+    Severity-aware admission for a server running many triage requests at once.
+
+    At most max_concurrent requests run; the rest wait in a heap ordered by
+    (severity rank, arrival), so a freed slot always goes to the most severe,
+    then oldest, waiting request. The wait queue is bounded: when it is full, a
+    new request displaces the least urgent, most recent waiter if it outranks it,
+    otherwise it is shed itself. A waiter still queued when its severity's
+    latency budget runs out is shed too, so routine work gives way first.
+    """
+
+    def __init__(self, max_concurrent=8, max_queue=64, latency_budgets=None):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.latency_budgets = dict(DEFAULT_LATENCY_BUDGETS if latency_budgets is None else latency_budgets)
+        self._cond = threading.Condition()
+        self._waiting = []  # heap of [rank, seq, state]
+        self._seq = itertools.count()
+        self._active = 0
+        self.admitted = 0
+        self.shed = {severity: 0 for severity in SEVERITY_RANK}
+
+    def acquire(self, severity):
+        """Block until a slot is free for this request, or raise Overloaded if it is shed."""
+        rank = SEVERITY_RANK.get(severity, UNKNOWN_RANK)
+        budget = self.latency_budgets.get(severity)
+        with self._cond:
+            if self._active < self.max_concurrent and not self._waiting:
+                self._active += 1
+                self.admitted += 1
+                return
+
+            entry = [rank, next(self._seq), _WAITING]
+            if len(self._waiting) >= self.max_queue:
+                worst = max(self._waiting) if self._waiting else None  # no queue at all with max_queue <= 0
+                if worst is None or worst < entry:
+                    self._count_shed(severity)
+                    raise Overloaded(f"admission queue full ({self.max_queue} waiting), shedding {severity} request")
+                self._drop(worst)
+            heapq.heappush(self._waiting, entry)
+
+            deadline = time.monotonic() + budget if budget is not None else None
+            while entry[2] == _WAITING:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    self._drop(entry)
+                    break
+                self._cond.wait(remaining)
+
+            if entry[2] == _SHED:
+                self._count_shed(severity)
+                raise Overloaded(f"{severity} request shed after waiting for a slot", retry_after=max(1, round(budget or 1)))
+            self.admitted += 1  # the slot was handed over by release(), _active already counts it
+
+    def release(self):
+        with self._cond:
+            if self._waiting:
+                entry = heapq.heappop(self._waiting)
+                entry[2] = _ADMITTED
+                self._cond.notify_all()
+            else:
+                self._active -= 1
+
+    def run(self, severity, fn):
+        self.acquire(severity)
+        try:
+            return fn()
+        finally:
+            self.release()
+
+    def _drop(self, entry):
+        entry[2] = _SHED
+        self._waiting.remove(entry)
+        heapq.heapify(self._waiting)
+        self._cond.notify_all()
+
+    def _count_shed(self, severity):
+        self.shed[severity if severity in self.shed else "moderate"] += 1
+
+    def stats(self):
+        with self._cond:
+            return {"active": self._active, "waiting": len(self._waiting), "admitted": self.admitted, "shed": dict(self.shed)}
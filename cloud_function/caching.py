@@ -0,0 +1,127 @@
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_message(text):
+    """Cache key for a free-text message: NFKC-normalized, casefolded, whitespace collapsed."""
+    text = unicodedata.normalize("NFKC", str(text))
+    return _WHITESPACE.sub(" ", text.casefold()).strip()
+
+
+def symptom_set_key(symptoms):
+    """
+    Canonical, order-independent key for a list of extracted symptoms:
+    ["Fever", "chills "] and ["chills", "fever"] both become ("chills", "fever").
+    """
+    return tuple(sorted({normalize_message(s) for s in symptoms if normalize_message(s)}))
+
+
+class LRUTTLCache:
+    """
+    Small thread-safe LRU cache with a per-entry time-to-live.
+    Lives for as long as the (warm) function instance does.
+    """
+
+    def __init__(self, maxsize=1024, ttl_seconds=3600.0, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0    # dropped to make room (LRU)
+        self.expirations = 0  # dropped because the TTL ran out
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= self._clock():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires_at = self._clock() + self.ttl_seconds if self.ttl_seconds else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key: the first caller runs fn, callers
+    arriving while it is in flight wait for it and get the same result (or exception).
+    Nothing is kept once the call returns; pair it with a cache for that.
+    """
+
+    def __init__(self):
+        self._in_flight = {}  # key -> Future
+        self._lock = threading.Lock()
+        self.calls = 0   # calls that actually ran fn
+        self.shared = 0  # callers that got another caller's result
+
+    def do(self, key, fn):
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+                self.calls += 1
+            else:
+                self.shared += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._in_flight[key]
+        future.set_result(result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._in_flight), "calls": self.calls, "shared": self.shared}
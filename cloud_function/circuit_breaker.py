@@ -0,0 +1,122 @@
+import threading
+import time
+from collections import deque
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the backend while the breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Error-rate / slow-call circuit breaker around one backend.
+
+    closed    -> calls go through; the last `window` outcomes are tracked and the
+                 breaker opens once at least min_calls are recorded and either the
+                 failure rate or the slow-call rate reaches its threshold.
+    open      -> calls fail fast with CircuitOpenError for open_seconds.
+    half_open -> up to half_open_probes calls are let through; if they all
+                 succeed (and aren't slow) the breaker closes, any failure re-opens it.
+    """
+
+    def __init__(self, name, window=20, min_calls=10, failure_rate_threshold=0.5,
+                 slow_call_seconds=2.0, slow_rate_threshold=0.5, open_seconds=30.0,
+                 half_open_probes=3, clock=time.monotonic):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_rate_threshold = slow_rate_threshold
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=window)  # (failed, slow)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self.rejected = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            self._maybe_half_open()
+            return self._state
+
+    def _maybe_half_open(self):
+        if self._state == OPEN and self._clock() - self._opened_at >= self.open_seconds:
+            print(f"{self.name} breaker half-open, probing")
+            self._state = HALF_OPEN
+            self._probes_in_flight = 0
+            self._probe_successes = 0
+
+    def _open(self, reason):
+        print(f"{self.name} breaker OPEN: {reason}")
+        self._state = OPEN
+        self._opened_at = self._clock()
+        self._outcomes.clear()
+
+    def _acquire(self):
+        with self._lock:
+            self._maybe_half_open()
+            if self._state == OPEN:
+                self.rejected += 1
+                return False
+            if self._state == HALF_OPEN:
+                if self._probes_in_flight + self._probe_successes >= self.half_open_probes:
+                    self.rejected += 1
+                    return False
+                self._probes_in_flight += 1
+            return True
+
+    def _record(self, failed, elapsed):
+        slow = elapsed >= self.slow_call_seconds
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if failed or slow:
+                    self._open("probe failed" if failed else f"probe took {elapsed:.2f}s")
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_probes:
+                        print(f"{self.name} breaker closed again")
+                        self._state = CLOSED
+                return
+            if self._state != CLOSED:
+                return  # a call that started before the breaker opened
+            self._outcomes.append((failed, slow))
+            if len(self._outcomes) < self.min_calls:
+                return
+            failure_rate = sum(f for f, _ in self._outcomes) / len(self._outcomes)
+            slow_rate = sum(s for _, s in self._outcomes) / len(self._outcomes)
+            if failure_rate >= self.failure_rate_threshold:
+                self._open(f"failure rate {failure_rate:.0%} over the last {len(self._outcomes)} calls")
+            elif slow_rate >= self.slow_rate_threshold:
+                self._open(f"{slow_rate:.0%} of the last {len(self._outcomes)} calls slower than {self.slow_call_seconds}s")
+
+    def call(self, fn, *args, **kwargs):
+        if not self._acquire():
+            raise CircuitOpenError(f"{self.name} circuit is open")
+        start = self._clock()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self._record(True, self._clock() - start)
+            raise
+        self._record(False, self._clock() - start)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self._state,
+                "recent_calls": len(self._outcomes),
+                "recent_failures": sum(f for f, _ in self._outcomes),
+                "rejected": self.rejected,
+            }
@@ -0,0 +1,210 @@
+"""
+Shared, lazily built Google Cloud clients.
+
+Nothing heavy is imported or constructed at module import time: each client
+is built once, on first use (or by warm_in_background()), behind its own lock
+so concurrent first requests don't build it twice. Gemini, Firestore and the
+prediction client come from pools of GRPC_POOL_SIZE clients with their own
+channels, which warm_in_background() also connects ahead of the first request.
+"""
+import itertools
+import json
+import os
+import threading
+import time
+
+# PROJECT = os.environ["GCP_PROJECT"]
+# Use .get() for safer access,
+PROJECT = os.environ.get("GOOGLE_CLOUD_PROJECT", "crypto-sphere-464015-e4")
+if not PROJECT:
+    raise ValueError("GOOGLE_CLOUD_PROJECT environment variable not found.")
+
+REGION = "us-central1"
+GEMINI_MODEL_NAME = os.environ.get("GEMINI_MODEL_NAME", "gemini-2.5-flash")
+
+
+def lazy_singleton(factory):
+    """Wrap a zero-argument factory so its result is built once, on first call, thread-safely."""
+    lock = threading.Lock()
+    holder = []
+
+    def get():
+        if not holder:
+            with lock:
+                if not holder:
+                    holder.append(factory())
+        return holder[0]
+
+    get.is_ready = lambda: bool(holder)
+    get.__name__ = getattr(factory, "__name__", "get")
+    return get
+
+
+# gRPC channels. Each pooled client owns its own channel (HTTP/2 connection); the
+# server mode raises GRPC_POOL_SIZE so concurrent requests aren't all multiplexed on one
+# connection. Keepalive pings keep idle connections from being dropped by load balancers,
+# so a quiet instance doesn't pay for a new TLS handshake on its next request.
+GRPC_POOL_SIZE = max(1, int(os.environ.get("GRPC_POOL_SIZE", "1")))
+GRPC_PREWARM = os.environ.get("GRPC_PREWARM", "true").lower() in ("1", "true", "yes")
+GRPC_WARM_TIMEOUT_SECONDS = float(os.environ.get("GRPC_WARM_TIMEOUT_SECONDS", "10"))
+GRPC_KEEPALIVE_OPTIONS = [
+    ("grpc.keepalive_time_ms", int(os.environ.get("GRPC_KEEPALIVE_TIME_MS", "30000"))),
+    ("grpc.keepalive_timeout_ms", int(os.environ.get("GRPC_KEEPALIVE_TIMEOUT_MS", "10000"))),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+    ("grpc.max_send_message_length", -1),
+    ("grpc.max_receive_message_length", -1),
+]
+# Vertex endpoints are regional; override for a private or different-region endpoint
+VERTEX_API_ENDPOINT = os.environ.get("VERTEX_API_ENDPOINT", f"{REGION}-aiplatform.googleapis.com")
+
+_channel_states = {}
+_channel_states_lock = threading.Lock()
+
+
+def report_channel(name, state, **fields):
+    """Record a channel's health and emit it as a structured log line (log-based metrics pick it up)."""
+    with _channel_states_lock:
+        _channel_states[name] = state
+    healthy = state not in ("TRANSIENT_FAILURE", "SHUTDOWN", "WARM_FAILED")
+    print(json.dumps({"severity": "INFO" if healthy else "WARNING", "message": "grpc channel health",
+                      "channel": name, "state": state, **fields}, default=str))
+
+
+def channel_health():
+    """Last known state of every pooled channel, e.g. {"prediction[0]": "READY", "firestore[0]": "WARM"}."""
+    with _channel_states_lock:
+        return dict(_channel_states)
+
+
+def watch_channel(name, channel):
+    """Report every connectivity change of a grpc.Channel we created ourselves."""
+    channel.subscribe(lambda state: report_channel(name, state.name), try_to_connect=False)
+
+
+class ClientPool:
+    """Fixed set of clients handed out round-robin, built once, on first use."""
+
+    def __init__(self, name, factory, size=GRPC_POOL_SIZE, warm=None):
+        self.name = name
+        self.clients = [factory(i) for i in range(size)]
+        self._warm = warm
+        self._next = itertools.count()
+
+    def get(self):
+        return self.clients[next(self._next) % len(self.clients)]
+
+    def warm(self):
+        """Open every client's connection (TLS + auth) now, instead of inside a user's request."""
+        if self._warm is None:
+            return
+        for i, client in enumerate(self.clients):
+            name = f"{self.name}[{i}]"
+            start = time.monotonic()
+            try:
+                self._warm(client)
+                report_channel(name, "WARM", warm_ms=round((time.monotonic() - start) * 1000, 3))
+            except Exception as e:
+                report_channel(name, "WARM_FAILED", error=str(e))
+
+
+def pooled(name, factory, warm=None):
+    """
+    Getter over a lazily built ClientPool: each call returns the next client.
+    getter.warm() opens all of the pool's connections; warm_in_background() calls it.
+    """
+    pool = lazy_singleton(lambda: ClientPool(name, factory, warm=warm))
+
+    def get():
+        return pool().get()
+
+    get.is_ready = pool.is_ready
+    get.warm = lambda: pool().warm()
+    get.__name__ = f"get_{name}"
+    return get
+
+
+@lazy_singleton
+def get_credentials():
+    """One set of application-default credentials shared by every client, refreshed up front."""
+    import google.auth
+    from google.auth.transport.requests import Request
+    credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+    credentials.refresh(Request())
+    return credentials
+
+
+@lazy_singleton
+def init_vertexai():
+    import vertexai
+    vertexai.init(project=PROJECT, location=REGION, credentials=get_credentials())
+    return vertexai
+
+
+def _new_gemini(_):
+    init_vertexai()
+    from vertexai.generative_models import GenerativeModel
+    return GenerativeModel(GEMINI_MODEL_NAME)
+
+
+def generate_content(model, contents, timeout=None, **kwargs):
+    """
+    model.generate_content(contents, **kwargs) with a client-side deadline. The vertexai SDK
+    has no timeout parameter, so the request is built the way generate_content() builds it
+    and sent on the model's own gapic client with timeout=; the RPC is then cancelled at the
+    deadline instead of holding its thread. SDKs without those internals get a plain call.
+    """
+    prepare = getattr(model, "_prepare_request", None)
+    parse = getattr(model, "_parse_response", None)
+    if timeout is None or prepare is None or parse is None:
+        return model.generate_content(contents, **kwargs)
+    request = prepare(contents=contents, **kwargs)
+    return parse(model._prediction_client.generate_content(request=request, timeout=timeout))
+
+
+def _new_db(_):
+    from google.cloud import firestore
+    return firestore.Client(credentials=get_credentials())
+
+
+def _new_prediction_client(i):
+    import grpc
+    from google.cloud.aiplatform_v1.services.prediction_service import PredictionServiceClient
+    from google.cloud.aiplatform_v1.services.prediction_service.transports import PredictionServiceGrpcTransport
+    channel = PredictionServiceGrpcTransport.create_channel(
+        VERTEX_API_ENDPOINT, credentials=get_credentials(), options=GRPC_KEEPALIVE_OPTIONS,
+    )
+    watch_channel(f"prediction[{i}]", channel)
+    client = PredictionServiceClient(transport=PredictionServiceGrpcTransport(host=VERTEX_API_ENDPOINT, channel=channel))
+    client.warm_channel = lambda: grpc.channel_ready_future(channel).result(timeout=GRPC_WARM_TIMEOUT_SECONDS)
+    return client
+
+
+# Gemini: count_tokens is free and goes over the same connection generate_content uses.
+# Firestore: a point read of a missing document is the cheapest call that opens the
+# connection; its client already sets a 30s keepalive on the channel it creates.
+get_gemini = pooled("gemini", _new_gemini, warm=lambda model: model.count_tokens("warmup"))
+get_db = pooled("firestore", _new_db, warm=lambda db: db.collection("_warmup").document("ping").get())
+get_prediction_client = pooled("prediction", _new_prediction_client, warm=lambda client: client.warm_channel())
+
+
+def warm_in_background(*getters):
+    """
+    Build the given clients on a daemon thread right after import, so the
+    first request usually finds them ready instead of paying for them.
+    A request that arrives mid-warmup just waits on that client's lock.
+    """
+    def warm():
+        for getter in getters:
+            start = time.monotonic()
+            try:
+                getter()
+                if GRPC_PREWARM and hasattr(getter, "warm"):
+                    getter.warm()
+                print(f"warmed {getter.__name__} in {time.monotonic() - start:.3f}s")
+            except Exception as e:
+                print(f"warming {getter.__name__} failed, it will be retried on first use: {e}")
+
+    thread = threading.Thread(target=warm, name="client-warmup", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,194 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class LatencyHistogram:
+    """Rolling window of the most recent call latencies (seconds) with percentile lookups."""
+
+    def __init__(self, window=512):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def percentile(self, p):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+
+class TrackedExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor that knows how many of its tasks are queued or running."""
+
+    def __init__(self, max_workers, **kwargs):
+        super().__init__(max_workers=max_workers, **kwargs)
+        self.max_workers = max_workers
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        with self._in_flight_lock:
+            self._in_flight += 1
+        try:
+            future = super().submit(fn, *args, **kwargs)
+        except Exception:
+            self._finished(None)
+            raise
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, _):
+        with self._in_flight_lock:
+            self._in_flight -= 1
+
+    def in_flight(self):
+        return self._in_flight
+
+    def saturated(self):
+        """True when a new task would wait for a worker instead of starting right away."""
+        return self._in_flight >= self.max_workers
+
+
+class HedgedCaller:
+    """
+    Runs a backend call with an adaptive deadline and an optional hedge.
+
+    - The deadline is the rolling p99 latency times timeout_multiplier, clamped
+      to [min_timeout, max_timeout]; default_timeout applies until min_samples
+      latencies have been seen.
+    - If the first attempt is still running at the rolling p95, a second
+      identical attempt is started and whichever succeeds first wins. The other
+      one is cancelled if it hasn't started; a running loser can't be
+      interrupted, so pass timeout_kwarg to let the client abort it at the deadline.
+    - Hedges are rate-limited with a token bucket refilled by max_hedge_ratio
+      per call, so at most ~10% (by default) extra requests hit the backend quota.
+      No hedge is sent while the executor is saturated (TrackedExecutor): it
+      would only queue behind the calls that are already slow.
+    - Latencies are measured from when an attempt starts running, so time spent
+      waiting for a worker doesn't inflate the p95 / p99.
+    """
+
+    def __init__(self, name, executor, default_timeout=5.0, min_timeout=0.5, max_timeout=10.0,
+                 timeout_multiplier=1.5, hedge_percentile=0.95, max_hedge_ratio=0.1, hedge_burst=5,
+                 min_samples=20, window=512, timeout_kwarg=None):
+        self.name = name
+        self._executor = executor
+        self.default_timeout = default_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout_multiplier = timeout_multiplier
+        self.hedge_percentile = hedge_percentile
+        self.max_hedge_ratio = max_hedge_ratio
+        self.hedge_burst = hedge_burst
+        self.min_samples = min_samples
+        self.timeout_kwarg = timeout_kwarg
+        self.latencies = LatencyHistogram(window)
+        self._lock = threading.Lock()
+        self._hedge_tokens = float(hedge_burst)
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+
+    def adaptive_timeout(self):
+        if len(self.latencies) < self.min_samples:
+            return self.default_timeout
+        p99 = self.latencies.percentile(0.99)
+        return min(self.max_timeout, max(self.min_timeout, p99 * self.timeout_multiplier))
+
+    def hedge_delay(self):
+        if len(self.latencies) < self.min_samples or self.max_hedge_ratio <= 0:
+            return None
+        return self.latencies.percentile(self.hedge_percentile)
+
+    def _take_hedge_token(self):
+        saturated = getattr(self._executor, "saturated", None)
+        if saturated is not None and saturated():
+            return False
+        with self._lock:
+            if self._hedge_tokens >= 1:
+                self._hedge_tokens -= 1
+                self.hedges += 1
+                return True
+            return False
+
+    def call(self, fn, *args, **kwargs):
+        timeout = self.adaptive_timeout()
+        hedge_after = self.hedge_delay()
+        if self.timeout_kwarg:
+            kwargs[self.timeout_kwarg] = timeout
+        with self._lock:
+            self.calls += 1
+            self._hedge_tokens = min(self.hedge_burst, self._hedge_tokens + self.max_hedge_ratio)
+
+        start = time.monotonic()
+        deadline = start + timeout
+        attempts = [self._executor.submit(self._timed, fn, args, kwargs)]
+        errors = []
+        try:
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                wake_at = deadline
+                if len(attempts) == 1 and hedge_after is not None:
+                    wake_at = min(deadline, start + hedge_after)
+                done, _ = wait([f for f in attempts if not f.done()] or attempts,
+                               timeout=max(0.0, wake_at - now), return_when=FIRST_COMPLETED)
+
+                for future in attempts:
+                    if future.done() and future not in errors:
+                        if future.exception() is None:
+                            result, seconds = future.result()
+                            self.latencies.record(seconds)
+                            if future is not attempts[0]:
+                                self.hedge_wins += 1
+                            return result
+                        errors.append(future)
+
+                if len(errors) == len(attempts):
+                    if len(attempts) == 1 and hedge_after is not None and self._take_hedge_token():
+                        # first attempt failed fast: the hedge doubles as a retry
+                        attempts.append(self._executor.submit(self._timed, fn, args, kwargs))
+                        continue
+                    raise errors[-1].exception()
+
+                if len(attempts) == 1 and hedge_after is not None and time.monotonic() >= start + hedge_after:
+                    if self._take_hedge_token():
+                        print(f"{self.name}: no answer after p95 ({hedge_after:.3f}s), sending hedged request")
+                        attempts.append(self._executor.submit(self._timed, fn, args, kwargs))
+                    else:
+                        hedge_after = None  # out of hedge budget, just wait for the deadline
+        finally:
+            for future in attempts:
+                future.cancel()
+
+        # Count the deadline as a sample so the histogram adapts to a backend that got slower
+        self.latencies.record(timeout)
+        self.timeouts += 1
+        raise TimeoutError(f"{self.name} did not answer within its adaptive deadline of {timeout:.2f}s")
+
+    @staticmethod
+    def _timed(fn, args, kwargs):
+        started = time.monotonic()
+        result = fn(*args, **kwargs)
+        return result, time.monotonic() - started
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "timeouts": self.timeouts,
+            "p95_s": self.latencies.percentile(0.95),
+            "timeout_s": self.adaptive_timeout(),
+        }
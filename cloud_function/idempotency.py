@@ -0,0 +1,63 @@
+import hashlib
+
+from caching import LRUTTLCache, SingleFlight, normalize_message
+
+
+def turn_key(session_id, turn_id=None, message=None):
+    """
+    Identity of one webhook turn: the session plus Dialogflow's detectIntentResponseId,
+    or the normalized message when the request carries no turn id.
+    None when there is no session to scope it to. Parts are strings whatever type the
+    request used for them (a JSON session id or turn id may be a number).
+    """
+    if not session_id:
+        return None
+    if turn_id:
+        return (str(session_id), "turn", str(turn_id))
+    return (str(session_id), "msg", hashlib.sha256(normalize_message(message).encode("utf-8")).hexdigest())
+
+
+def doc_id_for(key):
+    """Deterministic Firestore document id for a turn, so a retry writes the same document instead of adding one."""
+    return hashlib.sha256("\x1f".join(key).encode("utf-8")).hexdigest()[:20]
+
+
+class TurnRegistry:
+    """
+    Runs each webhook turn once per instance.
+
+    The first request for a key runs the handler; a retry arriving while it is
+    still running waits on the same Future, and one arriving afterwards gets the
+    stored response (for ttl_seconds). Only responses for which should_store()
+    is true are kept, so a failed turn is simply run again on retry.
+    """
+
+    def __init__(self, maxsize=10000, ttl_seconds=600.0, should_store=lambda result: True):
+        self._completed = LRUTTLCache(maxsize=maxsize, ttl_seconds=ttl_seconds)
+        self._flights = SingleFlight()
+        self._should_store = should_store
+        self.replayed = 0  # retries answered from a stored response
+
+    def run(self, key, handler):
+        result = self._completed.get(key)
+        if result is not None:
+            self.replayed += 1
+            print(f"turn {key} already answered, replaying the stored response")
+            return result
+        return self._flights.do(key, lambda: self._run_once(key, handler))
+
+    def _run_once(self, key, handler):
+        # The first run may have finished between the lookup above and joining the flight
+        result = self._completed.get(key)
+        if result is not None:
+            self.replayed += 1
+            return result
+        result = handler()
+        if self._should_store(result):
+            self._completed.put(key, result)
+        return result
+
+    def stats(self):
+        flights = self._flights.stats()
+        return {"in_flight": flights["in_flight"], "attached": flights["shared"], "replayed": self.replayed,
+                **{f"stored_{k}": v for k, v in self._completed.stats().items()}}
@@ -0,0 +1,131 @@
+import json
+import os
+
+import numpy as np
+
+from local_severity import MAX_ESCALATION_MASS, NEVER, SEVERITY_LABELS, hashed_features
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_INDEX_PATH = os.path.join(_HERE, "knn_severity_index.npy")  # + knn_severity_index.json next to it
+MIN_SIMILARITY = 0.5  # the nearest neighbour must be at least this close before the vote may answer
+
+
+def embed(texts, dim):
+    """Binary hashed n-gram vectors (same features as the local model), L2-normalized, one row per text."""
+    X = np.zeros((len(texts), dim), dtype=np.float32)
+    for i, text in enumerate(texts):
+        X[i, hashed_features(text, dim)] = 1.0
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    return X / np.maximum(norms, 1e-12)
+
+
+def metadata_path(index_path):
+    return os.path.splitext(index_path)[0] + ".json"
+
+
+class KNNSeverityRetriever:
+    """
+    Nearest-neighbour severity over the labeled corpus (utils/build_knn_index.py).
+
+    The corpus embeddings are one normalized float32 matrix, memory-mapped from
+    an .npy file, so cosine similarity for a whole batch of queries is a single
+    matrix product; the top-k neighbours then vote, weighted by similarity.
+
+    thresholds holds, per label, the vote share from which held-out votes for
+    that label were precise enough to skip the endpoint (utils/build_knn_index.py);
+    NEVER when none were, which is also the default for an uncalibrated index.
+    """
+
+    def __init__(self, matrix, texts, labels, k=5, thresholds=None):
+        self.matrix = matrix  # (n_examples, dim), rows L2-normalized
+        self.texts = list(texts)
+        self.labels = np.array([SEVERITY_LABELS.index(label) for label in labels])
+        self.k = min(k, len(self.texts))
+        self.dim = matrix.shape[1]
+        self.thresholds = np.full(len(SEVERITY_LABELS), NEVER) if thresholds is None else np.asarray(thresholds, dtype=np.float64)
+        self._more_severe = [np.arange(len(SEVERITY_LABELS)) > label for label in range(len(SEVERITY_LABELS))]
+
+    @classmethod
+    def load(cls, path=DEFAULT_INDEX_PATH, k=5):
+        with open(metadata_path(path), encoding="utf-8") as fin:
+            meta = json.load(fin)
+        thresholds = [meta["thresholds"][label] for label in SEVERITY_LABELS] if "thresholds" in meta else None
+        return cls(np.load(path, mmap_mode="r"), meta["texts"], meta["labels"], k=k, thresholds=thresholds)
+
+    def save(self, path):
+        np.save(path, np.ascontiguousarray(self.matrix, dtype=np.float32))
+        with open(metadata_path(path), "w", encoding="utf-8") as fout:
+            json.dump({"texts": self.texts, "labels": [SEVERITY_LABELS[i] for i in self.labels],
+                       "thresholds": {label: float(t) for label, t in zip(SEVERITY_LABELS, self.thresholds)}},
+                      fout, ensure_ascii=False)
+
+    def vote(self, texts):
+        """(shares, top, top_sims): per text, each label's share of the top-k similarity mass and the top-k rows."""
+        similarities = embed(texts, self.dim) @ self.matrix.T  # (n_queries, n_examples)
+        top = np.argpartition(-similarities, self.k - 1, axis=1)[:, :self.k]
+        top_sims = np.take_along_axis(similarities, top, axis=1)
+        order = np.argsort(-top_sims, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_sims = np.clip(np.take_along_axis(top_sims, order, axis=1), 0.0, None)
+
+        votes = np.zeros((len(texts), len(SEVERITY_LABELS)), dtype=np.float64)
+        np.add.at(votes, (np.arange(len(texts))[:, None], self.labels[top]), top_sims)
+        totals = votes.sum(axis=1, keepdims=True)
+        shares = np.divide(votes, totals, out=np.zeros_like(votes), where=totals > 0)
+        return shares, top, top_sims
+
+    def predict_batch(self, texts):
+        """
+        Return one (severity, confidence, neighbours) per text. confidence is the
+        winning label's share of the top-k similarity mass; neighbours are the
+        top-k examples as {"text", "severity", "similarity"}, most similar first.
+        """
+        if not texts:
+            return []
+        shares, top, top_sims = self.vote(texts)
+        best = shares.argmax(axis=1)
+        return [(SEVERITY_LABELS[best[q]], float(shares[q, best[q]]), self._neighbours(top[q], top_sims[q]))
+                for q in range(len(texts))]
+
+    def _neighbours(self, top, top_sims):
+        return [{"text": self.texts[j], "severity": SEVERITY_LABELS[self.labels[j]], "similarity": round(float(s), 4)}
+                for j, s in zip(top, top_sims)]
+
+    def fast_path(self, shares, nearest_similarity, threshold=None, min_similarity=MIN_SIMILARITY,
+                  max_escalation_mass=MAX_ESCALATION_MASS):
+        """
+        (severity, confidence) when the vote may stand in for the endpoint, else None: the nearest
+        neighbour is at least min_similarity close, the winning share reaches the label's calibrated
+        threshold (or `threshold`, if given) and the more severe labels get at most max_escalation_mass.
+        """
+        best = int(shares.argmax())
+        if nearest_similarity < min_similarity:
+            return None
+        if shares[best] < (self.thresholds[best] if threshold is None else threshold):
+            return None
+        if shares[self._more_severe[best]].sum() > max_escalation_mass:
+            return None
+        return SEVERITY_LABELS[best], float(shares[best])
+
+    def confident_batch(self, texts, threshold=None, min_similarity=MIN_SIMILARITY):
+        """One (fast-path (severity, confidence) or None, neighbours) per text; see fast_path()."""
+        if not texts:
+            return []
+        shares, top, top_sims = self.vote(texts)
+        return [(self.fast_path(shares[q], float(top_sims[q, 0]), threshold, min_similarity),
+                 self._neighbours(top[q], top_sims[q]))
+                for q in range(len(texts))]
+
+    def predict(self, text):
+        return self.predict_batch([text])[0]
+
+
+def load_knn_retriever(path=None, k=None):
+    """Load the shipped index, or return None so callers skip the retriever."""
+    path = path or os.environ.get("KNN_INDEX_PATH", DEFAULT_INDEX_PATH)
+    k = k or int(os.environ.get("KNN_K", "5"))
+    try:
+        return KNNSeverityRetriever.load(path, k=k)
+    except (OSError, KeyError, ValueError) as e:
+        print(f"kNN severity index not available at {path}: {e}")
+        return None
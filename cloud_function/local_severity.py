@@ -0,0 +1,101 @@
+import os
+import re
+import zlib
+
+import numpy as np
+
+from caching import normalize_message
+
+SEVERITY_LABELS = ("routine", "moderate", "urgent", "emergent")
+DEFAULT_MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "local_severity_model.npz")
+# A local answer may only skip the endpoint if the model puts at most this much probability
+# on the more severe labels, so the fast path can't undertriage where the model has doubts
+MAX_ESCALATION_MASS = 0.01
+NEVER = 2.0  # threshold of a label the fast path may not answer with
+
+_TOKEN = re.compile(r"[\w']+")
+
+
+def hashed_features(text, n_features):
+    """
+    Hash word unigrams/bigrams and character 3-5 grams of a message into
+    n_features buckets. crc32 keeps the buckets identical between the
+    offline training run and every function instance.
+    """
+    text = normalize_message(text)
+    words = _TOKEN.findall(text)
+    grams = [f"w:{w}" for w in words]
+    grams += [f"b:{a} {b}" for a, b in zip(words, words[1:])]
+    padded = f" {text} "
+    for n in (3, 4, 5):
+        grams += [f"c:{padded[i:i + n]}" for i in range(len(padded) - n + 1)]
+
+    indices = np.fromiter((zlib.crc32(g.encode("utf-8")) % n_features for g in grams),
+                          dtype=np.int64, count=len(grams))
+    return np.unique(indices)
+
+
+class LocalSeverityModel:
+    """
+    Hashed n-gram softmax classifier; weights come from utils/train_local_severity.py.
+    thresholds holds, per label, the confidence from which held-out predictions of
+    that label were precise enough to skip the endpoint (NEVER when none were).
+    """
+
+    def __init__(self, weights, bias, labels=SEVERITY_LABELS, thresholds=None):
+        self.weights = np.asarray(weights, dtype=np.float32)  # (n_features, n_labels)
+        self.bias = np.asarray(bias, dtype=np.float32)        # (n_labels,)
+        self.labels = tuple(labels)
+        self.n_features = self.weights.shape[0]
+        self.thresholds = np.full(len(self.labels), NEVER) if thresholds is None else np.asarray(thresholds, dtype=np.float64)
+        ranks = [SEVERITY_LABELS.index(label) for label in self.labels]
+        self._more_severe = [np.array([r > rank for r in ranks]) for rank in ranks]
+
+    @classmethod
+    def load(cls, path=DEFAULT_MODEL_PATH):
+        with np.load(path, allow_pickle=False) as artifact:
+            thresholds = artifact["thresholds"] if "thresholds" in artifact.files else None  # older, uncalibrated artifacts
+            return cls(artifact["weights"], artifact["bias"], [str(l) for l in artifact["labels"]], thresholds)
+
+    def save(self, path):
+        np.savez_compressed(path, weights=self.weights, bias=self.bias, labels=np.array(self.labels),
+                            thresholds=self.thresholds)
+
+    def predict_proba(self, text):
+        indices = hashed_features(text, self.n_features)
+        logits = self.weights[indices].sum(axis=0) + self.bias
+        logits -= logits.max()
+        probs = np.exp(logits)
+        return probs / probs.sum()
+
+    def predict(self, text):
+        """Return (severity, confidence) for one free-text message."""
+        probs = self.predict_proba(text)
+        best = int(probs.argmax())
+        return self.labels[best], float(probs[best])
+
+    def confident_prediction(self, text, threshold=None, max_escalation_mass=MAX_ESCALATION_MASS):
+        """
+        (severity, confidence) when the local answer can stand in for the endpoint, else None:
+        confidence reaches the label's calibrated threshold (or `threshold`, if given) and
+        the more severe labels together get at most max_escalation_mass.
+        """
+        return self.fast_path(self.predict_proba(text), threshold, max_escalation_mass)
+
+    def fast_path(self, probs, threshold=None, max_escalation_mass=MAX_ESCALATION_MASS):
+        best = int(probs.argmax())
+        if probs[best] < (self.thresholds[best] if threshold is None else threshold):
+            return None
+        if probs[self._more_severe[best]].sum() > max_escalation_mass:
+            return None
+        return self.labels[best], float(probs[best])
+
+
+def load_local_model(path=None):
+    """Load the shipped artifact, or return None so callers fall back to the remote endpoint."""
+    path = path or os.environ.get("LOCAL_SEVERITY_MODEL_PATH", DEFAULT_MODEL_PATH)
+    try:
+        return LocalSeverityModel.load(path)
+    except (OSError, KeyError, ValueError) as e:
+        print(f"Local severity model not available at {path}: {e}")
+        return None
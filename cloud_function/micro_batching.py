@@ -0,0 +1,101 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class PredictionBatcher:
+    """
+    Collects prediction instances from concurrent requests and sends them to the
+    endpoint as one multi-instance predict call.
+
+    A batch is flushed when it reaches max_batch_size or when max_wait_seconds
+    have passed since its first instance arrived, whichever comes first.
+    predict_fn(instances) must return one prediction per instance, in order.
+
+    Flushed batches are sent from a pool of max_in_flight threads, so the next
+    batch is collected while earlier predict calls are still running; once
+    max_in_flight calls are outstanding, the collector waits and the queue
+    builds up into fuller batches.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=16, max_wait_seconds=0.01, max_in_flight=4):
+        self._predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self.max_in_flight = max_in_flight
+        self._pending = queue.Queue()
+        self._closed = False
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._senders = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="prediction-batch")
+        self._stats_lock = threading.Lock()
+        self.batches_sent = 0
+        self.instances_sent = 0
+        self._worker = threading.Thread(target=self._run, name="prediction-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, instance):
+        """Queue one instance; the returned Future resolves to its own prediction."""
+        if self._closed:
+            raise RuntimeError("PredictionBatcher is closed")
+        future = Future()
+        self._pending.put((instance, future))
+        return future
+
+    def predict(self, instance, timeout=None):
+        return self.submit(instance).result(timeout=timeout)
+
+    def close(self):
+        """Stop accepting work; whatever is already queued is still flushed."""
+        self._closed = True
+        self._pending.put(None)
+        self._worker.join()
+        self._senders.shutdown(wait=True)
+
+    def _collect(self):
+        first = self._pending.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait_seconds
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._pending.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                self._pending.put(None)  # let the loop see the shutdown after this flush
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            batch = [(instance, future) for instance, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            self._slots.acquire()
+            self._senders.submit(self._send, batch)
+
+    def _send(self, batch):
+        try:
+            predictions = list(self._predict_fn([instance for instance, _ in batch]))
+            if len(predictions) != len(batch):
+                raise ValueError(f"expected {len(batch)} predictions, endpoint returned {len(predictions)}")
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+        with self._stats_lock:
+            self.batches_sent += 1
+            self.instances_sent += len(batch)
+        for (_, future), prediction in zip(batch, predictions):
+            future.set_result(prediction)
@@ -0,0 +1,144 @@
+"""
+Compact patients schema.
+
+List views only need who to call and how urgently, so with the compact schema
+the patients document ("hot") carries small numbers instead of text:
+
+    {"v": 2, "sev": 1, "conf_q": 214, "sym": [5108554558204440326, 8288624469944598604], "flags": 1,
+     "icd10": "R07.9", "status": "queued", "timestamp": ..., "severity_rank": 1, "arrival_ms": ...}
+
+- sev is the index in SEVERITY_CODES, conf_q the confidence quantized to 0..255
+- sym are symptom codes: a 63-bit blake2b hash of the normalized symptom text,
+  so every instance derives the same code without coordination and distinct
+  texts don't realistically collide (a 31-bit code would be expected to
+  after ~50k distinct symptoms, overwriting symptom_codes/<code>);
+  symptom_codes/<code> holds the text, written the first time an instance
+  sees the code
+- flags is a bitmask of FLAG_* booleans
+
+The raw message, the free-text symptoms and other evidence go to a cold
+sibling document, patients_raw/<same id>, read only on drill-down.
+PatientCodec converts between the full record triage() builds and the two documents.
+"""
+import hashlib
+
+from caching import LRUTTLCache, normalize_message
+
+SCHEMA_VERSION = 2
+SEVERITY_CODES = ("emergent", "urgent", "moderate", "routine", "no_symptoms_found", "unknown_severity")
+CONFIDENCE_LEVELS = 255
+
+FLAG_RED_FLAGS = 1
+FLAG_DEGRADED = 2
+FLAG_KNN = 4
+
+# Full-record fields that move to the cold document as they are
+COLD_FIELDS = ("msg", "symptoms", "red_flags", "knn_neighbours", "session_floor", "turn_estimate")
+# Full-record fields the hot document keeps as they are
+HOT_PASSTHROUGH = ("status", "timestamp", "severity_rank", "arrival_ms")
+
+
+def symptom_code(symptom):
+    # 63 bits: Firestore integers are signed 64-bit
+    digest = hashlib.blake2b(normalize_message(symptom).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") >> 1
+
+
+def quantize_confidence(confidence):
+    return max(0, min(CONFIDENCE_LEVELS, round(float(confidence or 0.0) * CONFIDENCE_LEVELS)))
+
+
+def dequantize_confidence(conf_q):
+    return round(conf_q / CONFIDENCE_LEVELS, 3)
+
+
+class PatientCodec:
+    def __init__(self, get_db, cold_collection="patients_raw", vocabulary_collection="symptom_codes",
+                 vocabulary_cache_size=50000):
+        self._get_db = get_db
+        self.cold_collection = cold_collection
+        self.vocabulary_collection = vocabulary_collection
+        self._vocabulary = LRUTTLCache(maxsize=vocabulary_cache_size, ttl_seconds=0)  # code -> text, known to be stored
+
+    def encode(self, record):
+        """
+        Full patient record -> (hot, cold, new_codes). new_codes maps symptom codes this
+        instance hasn't stored yet to their text; write them as
+        symptom_codes/<code> {"text": ...} together with the documents.
+        """
+        symptoms = list(record.get("symptoms") or [])
+        codes = [symptom_code(s) for s in symptoms]
+        severity = record.get("severity")
+        flags = ((FLAG_RED_FLAGS if record.get("red_flags") else 0)
+                 | (FLAG_DEGRADED if record.get("degraded") else 0)
+                 | (FLAG_KNN if record.get("knn_neighbours") else 0))
+
+        hot = {
+            "v": SCHEMA_VERSION,
+            "sev": SEVERITY_CODES.index(severity) if severity in SEVERITY_CODES else SEVERITY_CODES.index("unknown_severity"),
+            "conf_q": quantize_confidence(record.get("confidence")),
+            "sym": codes,
+        }
+        if flags:
+            hot["flags"] = flags
+        if record.get("icd10_code"):
+            hot["icd10"] = record["icd10_code"]
+        hot.update({key: record[key] for key in HOT_PASSTHROUGH if key in record})
+
+        cold = {key: record[key] for key in COLD_FIELDS if record.get(key) is not None}
+
+        new_codes = {code: normalize_message(symptom) for code, symptom in zip(codes, symptoms)
+                     if self._vocabulary.get(code) is None}
+        return hot, cold, new_codes
+
+    def mark_stored(self, new_codes):
+        """Remember codes whose vocabulary documents were written, so they aren't written again."""
+        for code, text in new_codes.items():
+            self._vocabulary.put(code, text)
+
+    def symptom_texts(self, codes):
+        """Resolve symptom codes to text through the local cache, reading missing ones from symptom_codes."""
+        texts = {code: self._vocabulary.get(code) for code in codes}
+        missing = [code for code, text in texts.items() if text is None]
+        if missing:
+            db = self._get_db()
+            refs = [db.collection(self.vocabulary_collection).document(str(code)) for code in missing]
+            for snapshot in db.get_all(refs):
+                if snapshot.exists:
+                    code = int(snapshot.id)
+                    texts[code] = (snapshot.to_dict() or {}).get("text")
+                    self._vocabulary.put(code, texts[code])
+        return [texts.get(code) or f"#{code}" for code in codes]
+
+    def decode(self, hot, cold=None, resolve_symptoms=True):
+        """
+        Hot (+ optional cold) document -> record shaped like the full schema.
+        Without cold, "symptoms" holds the canonical (normalized) texts of the codes.
+        Documents written with the full schema are returned unchanged.
+        """
+        if hot.get("v") != SCHEMA_VERSION:
+            return dict(hot)
+        flags = hot.get("flags", 0)
+        record = {
+            "severity": SEVERITY_CODES[hot["sev"]],
+            "confidence": dequantize_confidence(hot.get("conf_q", 0)),
+            "degraded": bool(flags & FLAG_DEGRADED),
+            "icd10_code": hot.get("icd10"),
+            **{key: hot[key] for key in HOT_PASSTHROUGH if key in hot},
+        }
+        if cold:
+            record.update(cold)
+        elif resolve_symptoms:
+            record["symptoms"] = self.symptom_texts(hot.get("sym", []))
+        return record
+
+    def load(self, doc_ref):
+        """Drill-down: read the hot document and its cold sibling, return the decoded full record (or None)."""
+        db = self._get_db()
+        cold_ref = db.collection(self.cold_collection).document(doc_ref.id)
+        snapshots = {snapshot.reference.path: snapshot for snapshot in db.get_all([doc_ref, cold_ref])}  # any order
+        hot_snapshot, cold_snapshot = snapshots[doc_ref.path], snapshots[cold_ref.path]
+        if not hot_snapshot.exists:
+            return None
+        cold = cold_snapshot.to_dict() if cold_snapshot.exists else None
+        return {"id": doc_ref.id, **self.decode(hot_snapshot.to_dict() or {}, cold)}
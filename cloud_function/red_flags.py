@@ -0,0 +1,184 @@
+import re
+import unicodedata
+from collections import deque
+
+# Curated red-flag lexicon: phrases that on their own mean "call emergency services now".
+# Checked against fine_tuning_training: none of these appear in a non-emergent example.
+# Matching is on whole words after normalize_for_matching(), so accents, apostrophes,
+# casing and punctuation don't matter ("n'arrive", "narrive" and "N’ARRIVE" all match).
+# Entries are acute phrases rather than bare condition names: "stroke", "choking" or
+# "suicidal" alone also appear in history, idioms and denials.
+RED_FLAG_PHRASES = {
+    "chest pain": [
+        "elephant on my chest", "chest pain spreading", "chest pain that radiates",
+        "pain in my chest feeling crushed", "crushing chest pain", "severe chest pain",
+        "severe chest tightness", "sudden severe chest pain",
+        "having a heart attack", "its a heart attack", "signs of a heart attack",
+        "douleur thoracique", "douleur a la poitrine", "mal a la poitrine",
+        "fais une crise cardiaque", "fait une crise cardiaque", "faire une crise cardiaque",
+    ],
+    "breathing": [
+        "cant breathe", "cannot breathe", "severe trouble breathing", "sudden trouble breathing",
+        "gasping for air", "airways are closing", "throat is closing",
+        "im choking", "is choking", "choking on food", "choking and cant", "turning blue",
+        "je narrive pas a respirer", "jai du mal a respirer", "difficulte a respirer",
+        "je metouffe", "je ne peux pas respirer",
+    ],
+    "stroke": [
+        "words are slurred", "slurred speech", "trouble speaking", "cant get the words out",
+        "weakness on one side", "numbness and weakness on one side", "face is drooping",
+        "lost feeling in my left arm", "lost feeling in my right arm", "sudden vision loss",
+        "sudden blindness", "total paralysis", "cant move my leg at all",
+        "having a stroke", "signs of a stroke",
+        "fais un avc", "fait un avc", "faire un avc", "paralysie soudaine", "paralysie brutale",
+        "je ne sens plus mon bras",
+    ],
+    "consciousness": [
+        "unresponsive", "is unconscious", "found unconscious", "knocked unconscious",
+        "just passed out", "has passed out", "keeps passing out",
+        "having a seizure", "having seizures", "seizure that wont stop",
+        "confusion and disorientation",
+        "inconscient", "perte de connaissance", "convulsions", "crise depilepsie",
+    ],
+    "bleeding": [
+        "vomiting blood", "severe bleeding", "heavy bleeding",
+        "bright red bleeding", "bleeding that wont stop",
+        "hemorragie", "saignement abondant", "je vomis du sang",
+    ],
+    "other": [
+        "swollen face and lips", "swallowed a battery",
+        "took an overdose", "i overdosed", "has overdosed",
+        "im suicidal", "feel suicidal", "feeling suicidal", "suicidal thoughts",
+        "want to kill myself", "severe headache and stiff neck",
+        "excruciating pain in my head",
+        "pensees suicidaires", "je veux mourir",
+    ],
+}
+
+# A phrase right after one of these words is a denial or history ("not suicidal", "never had
+# a seizure", "had a stroke"), and one right before a history marker ("ago", "il y a",
+# "depuis 3 ans") or a qualifier ("can't breathe through my nose") is not an emergency on its
+# own either: it goes through the models instead of short-circuiting.
+GUARD_WORDS_BEFORE = frozenset({
+    "not", "no", "never", "dont", "didnt", "doesnt", "isnt", "wasnt", "without", "denies",
+    "had", "history", "previous", "past",
+    "pas", "jamais", "sans", "eu",
+})
+GUARD_PHRASES_AFTER = (
+    "ago", "last week", "last month", "last year", "il y a", "depuis * ans",
+    "through my nose", "through his nose", "through her nose", "through the nose", "par le nez",
+)  # "*" stands for any one word
+GUARD_WINDOW = 3  # words looked at on each side of a match
+
+# Messages that mention a lexicon word but must not short-circuit; regression cases for the lexicon
+NOT_RED_FLAGS = (
+    "J'ai le mal de tête depuis ce matin",
+    "I'm not suicidal, just tired",
+    "I had a stroke 5 years ago and need a refill",
+    "Working on my golf stroke, my shoulder aches",
+    "Choking on laughter at my own joke, now my ribs hurt",
+    "Trouble breathing through my nose, stuffy cold",
+    "I've never had a seizure but my hands shake",
+    "No chest pain, just heartburn after dinner",
+    "Had a heart attack two years ago, follow-up visit",
+    "Je n'ai jamais eu de crise cardiaque",
+    "I need a refill of my seizure medication",
+    "Can I overdose on vitamin C?",
+    "My dad passed out last week and is fine now",
+    "Mon grand-père a fait un AVC il y a 3 ans",
+    "I cant breathe through my nose",
+    "I am scared I might get a heart attack someday",
+)
+
+_APOSTROPHES = re.compile(r"['’ʼ`]")
+_NON_WORD = re.compile(r"[^0-9a-z]+")
+_GUARD_AFTER = re.compile(r"(?:\S+ ){0,%d}(?:%s) " % (
+    GUARD_WINDOW - 1, "|".join(re.escape(phrase).replace(r"\*", r"\S+") for phrase in GUARD_PHRASES_AFTER)))
+
+
+def normalize_for_matching(text):
+    """Strip accents and apostrophes, casefold, turn punctuation into single spaces and pad with spaces."""
+    text = unicodedata.normalize("NFKD", str(text))
+    text = "".join(ch for ch in text if not unicodedata.combining(ch)).casefold()
+    text = _NON_WORD.sub(" ", _APOSTROPHES.sub("", text)).strip()
+    return f" {text} "
+
+
+class AhoCorasick:
+    """Classic Aho-Corasick automaton: finds every pattern occurrence in one pass over the text."""
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        for index, pattern in enumerate(self.patterns):
+            state = 0
+            for ch in pattern:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                state = nxt
+            self._output[state].append(index)
+
+        # Breadth-first pass to wire failure links and merge outputs
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fallback = self._fail[state]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[nxt] = self._goto[fallback].get(ch, 0)
+                self._output[nxt] = self._output[nxt] + self._output[self._fail[nxt]]
+
+    def find_all(self, text):
+        """Yield (end_position, pattern_index) for every match."""
+        state = 0
+        for position, ch in enumerate(text):
+            while state and ch not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(ch, 0)
+            for index in self._output[state]:
+                yield position, index
+
+
+class RedFlagMatcher:
+    """Compiled once at startup; match() costs one pass over the message."""
+
+    def __init__(self, lexicon=RED_FLAG_PHRASES):
+        self._phrases = []  # (category, phrase as written in the lexicon)
+        padded = []
+        self._lengths = []
+        for category, phrases in lexicon.items():
+            for phrase in phrases:
+                self._phrases.append((category, phrase))
+                padded.append(normalize_for_matching(phrase))  # spaces on both ends = whole words only
+                self._lengths.append(len(padded[-1]))
+        self._automaton = AhoCorasick(padded)
+
+    def match(self, text):
+        """Return the distinct red-flag phrases found in text, in order of appearance, minus guarded ones."""
+        normalized = normalize_for_matching(text)
+        found = []
+        for end, index in self._automaton.find_all(normalized):
+            phrase = self._phrases[index][1]
+            if phrase in found or self._guarded(normalized, end + 1 - self._lengths[index], end):
+                continue
+            found.append(phrase)
+        return found
+
+    @staticmethod
+    def _guarded(normalized, start, end):
+        """True when a denial / history word or phrase starts within GUARD_WINDOW words of the match at normalized[start:end]."""
+        before = normalized[:start].split()[-GUARD_WINDOW:]
+        return any(word in GUARD_WORDS_BEFORE for word in before) or _GUARD_AFTER.match(normalized, end + 1) is not None
+
+    def categories(self, text):
+        matched = set(self.match(text))
+        return sorted({category for category, phrase in self._phrases if phrase in matched})
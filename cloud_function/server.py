@@ -0,0 +1,307 @@
+"""
+Long-running triage server for GKE / self-hosted deployments.
+
+    PORT=8080 SERVER_MAX_CONCURRENCY=32 python server.py
+
+One asyncio event loop owns all connections (HTTP/1.1 with keep-alive) and
+hands each request to the same pipeline the Cloud Functions use
+(handle_triage / handle_triage_batch) on a bounded worker pool, so one
+process serves many requests at once instead of one per instance:
+
+    POST /            triage (Dialogflow CX webhook or direct call)
+    POST /triage      same
+    POST /triage_batch
+    GET  /healthz     200 while serving, 503 once draining
+    GET  /metrics     in-flight count and pooled gRPC channel health, as JSON
+    GET  /queue?k=10  next patients to call, with WORK_QUEUE=true (work_queue.py)
+    POST /queue/claim {"coordinator": "..."} claims the next patient
+    GET  /patient?id= one patient in full, with its cold raw-text document (patient_codec.py)
+
+The Gemini, Vertex and Firestore clients are the shared, thread-safe ones
+from clients.py; their gRPC calls release the GIL, so the workers overlap on
+backend I/O. At most SERVER_MAX_CONCURRENCY requests run at a time, the rest
+wait on the loop in arrival order. With ADMISSION_CONTROL=true, triage requests
+skip that FIFO wait and go straight to the severity-ordered AdmissionController
+(admission.py), which bounds them instead; the worker pool then also has a
+thread for every request admission may hold waiting, so nothing queues in
+front of it (SERVER_WORKERS overrides the pool size). Set GRPC_POOL_SIZE
+(e.g. 4) to spread the backend calls over several pre-warmed gRPC connections.
+
+On SIGTERM / SIGINT the server stops accepting connections, fails /healthz,
+lets in-flight requests finish for up to SERVER_DRAIN_SECONDS and then
+flushes the Firestore write-behind queue before exiting.
+"""
+import asyncio
+import json
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import triage_function_original as pipeline
+from clients import channel_health, get_db
+from work_queue import PatientWorkQueue
+
+HOST = os.environ.get("HOST", "0.0.0.0")
+PORT = int(os.environ.get("PORT", "8080"))
+SERVER_MAX_CONCURRENCY = int(os.environ.get("SERVER_MAX_CONCURRENCY", "32"))
+SERVER_DRAIN_SECONDS = float(os.environ.get("SERVER_DRAIN_SECONDS", "25"))  # below GKE's 30s grace period
+SERVER_IDLE_TIMEOUT_SECONDS = float(os.environ.get("SERVER_IDLE_TIMEOUT_SECONDS", "75"))
+SERVER_MAX_BODY_BYTES = int(os.environ.get("SERVER_MAX_BODY_BYTES", str(4 * 1024 * 1024)))
+SERVER_MAX_HEADERS = int(os.environ.get("SERVER_MAX_HEADERS", "100"))
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", "0"))  # 0: sized from the concurrency limits
+WORK_QUEUE = os.environ.get("WORK_QUEUE", "false").lower() in ("1", "true", "yes")
+QUEUE_MAX_K = int(os.environ.get("QUEUE_MAX_K", "500"))
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 408: "Request Timeout",
+           411: "Length Required", 413: "Payload Too Large", 414: "URI Too Long",
+           431: "Request Header Fields Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+def normalize_response(result):
+    """Flask-style handler return values -> (status, headers, body bytes)."""
+    if not isinstance(result, tuple):
+        result = (result,)
+    body, status, headers = (tuple(result) + (200, {}))[:3]
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    return status, dict(headers or {}), body
+
+
+def load_patient(doc_id):
+    """Drill-down read of one patient: decoded hot + cold documents with the compact schema, the document otherwise."""
+    doc_ref = pipeline.PATIENT_SHARDS.document(get_db(), doc_id)
+    if pipeline.patient_codec is not None:
+        return pipeline.patient_codec.load(doc_ref)
+    snapshot = doc_ref.get()
+    return {"id": doc_id, **(snapshot.to_dict() or {})} if snapshot.exists else None
+
+
+def default_workers(max_concurrency, admission):
+    """Threads for the semaphore-bound requests plus, with admission control, every triage request it admits or holds."""
+    if admission is None:
+        return max_concurrency
+    return max_concurrency + admission.max_concurrent + admission.max_queue
+
+
+class TriageServer:
+    def __init__(self, max_concurrency=SERVER_MAX_CONCURRENCY, drain_seconds=SERVER_DRAIN_SECONDS, workers=SERVER_WORKERS):
+        self.max_concurrency = max_concurrency
+        self.drain_seconds = drain_seconds
+        self.workers = workers or default_workers(max_concurrency, pipeline.admission)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="triage-worker")
+        self._slots = None  # asyncio.Semaphore, created on the loop
+        self._server = None
+        self._connections = set()
+        self._in_flight = 0
+        self._idle = None  # asyncio.Event, set whenever nothing is in flight
+        self._stopped = None
+        self.draining = False
+        self.served = 0
+        self.work_queue = PatientWorkQueue(get_db, collection_group=pipeline.PATIENT_SHARDS.sharded) if WORK_QUEUE else None
+
+    async def start(self, host=HOST, port=PORT):
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._stopped = asyncio.Event()
+        if self.work_queue is not None:
+            self.work_queue.start()
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, lambda: asyncio.ensure_future(self.shutdown()))
+        print(f"triage server listening on {host}:{port}, max concurrency {self.max_concurrency}, "
+              f"{self.workers} workers, admission control {'on' if pipeline.admission is not None else 'off'}")
+
+    async def serve_forever(self):
+        await self._stopped.wait()
+
+    async def shutdown(self):
+        """Graceful drain: stop accepting, finish in-flight requests, flush pending Firestore writes."""
+        if self.draining:
+            return
+        self.draining = True
+        print(f"draining: {self._in_flight} request(s) in flight")
+        self._server.close()
+        if self.work_queue is not None:
+            self.work_queue.stop()
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=self.drain_seconds)
+        except asyncio.TimeoutError:
+            print(f"drain timed out after {self.drain_seconds}s with {self._in_flight} request(s) still running")
+        for writer in list(self._connections):
+            writer.close()
+        if pipeline.patient_writer is not None:
+            await asyncio.get_running_loop().run_in_executor(None, pipeline.patient_writer.drain)
+        self._executor.shutdown(wait=False)
+        print(f"triage server stopped after serving {self.served} request(s)")
+        self._stopped.set()
+
+    async def _handle_connection(self, reader, writer):
+        self._connections.add(writer)
+        try:
+            while not self.draining:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), timeout=SERVER_IDLE_TIMEOUT_SECONDS)
+                except asyncio.TimeoutError:
+                    break
+                except ValueError:  # longer than the StreamReader limit (64 KiB)
+                    await self._write(writer, 414, {}, b"Request line too long", keep_alive=False)
+                    break
+                if not request_line.strip():
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await self._write(writer, 400, {}, b"Malformed request line", keep_alive=False)
+                    break
+
+                # Headers and body get the same deadline as the request line, so a client that
+                # stalls mid-request can't hold the connection (and its buffers) forever
+                try:
+                    headers = await asyncio.wait_for(self._read_headers(reader), timeout=SERVER_IDLE_TIMEOUT_SECONDS)
+                except asyncio.TimeoutError:
+                    await self._write(writer, 408, {}, b"Timed out reading the request headers", keep_alive=False)
+                    break
+                except ValueError:  # a line over the StreamReader limit, or more than SERVER_MAX_HEADERS lines
+                    await self._write(writer, 431, {}, b"Request header fields too large", keep_alive=False)
+                    break
+
+                if "chunked" in headers.get("transfer-encoding", "").lower():
+                    await self._write(writer, 411, {}, b"Chunked bodies are not supported", keep_alive=False)
+                    break
+                try:
+                    length = int(headers.get("content-length") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await self._write(writer, 400, {}, b"Invalid Content-Length", keep_alive=False)
+                    break
+                if length > SERVER_MAX_BODY_BYTES:
+                    await self._write(writer, 413, {}, b"Request body too large", keep_alive=False)
+                    break
+                try:
+                    body = await asyncio.wait_for(reader.readexactly(length), timeout=SERVER_IDLE_TIMEOUT_SECONDS)
+                except asyncio.TimeoutError:
+                    await self._write(writer, 408, {}, b"Timed out reading the request body", keep_alive=False)
+                    break
+
+                path, _, query = target.partition("?")
+                status, response_headers, response_body = await self._dispatch(method, path, body, query)
+                keep_alive = (version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                              and not self.draining)
+                await self._write(writer, status, response_headers, response_body, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    @staticmethod
+    async def _read_headers(reader):
+        """Header fields up to the blank line, lowercased names; ValueError past SERVER_MAX_HEADERS of them."""
+        headers = {}
+        for _ in range(SERVER_MAX_HEADERS + 1):
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                return headers
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        raise ValueError(f"more than {SERVER_MAX_HEADERS} header fields")
+
+    async def _dispatch(self, method, path, body, query=""):
+        if path == "/healthz":
+            return (503, {}, b"draining") if self.draining else (200, {}, b"ok")
+        if path == "/metrics":
+            metrics = {"in_flight": self._in_flight, "served": self.served, "draining": self.draining,
+                       "channels": channel_health()}
+            return 200, {"Content-Type": "application/json"}, json.dumps(metrics).encode("utf-8")
+        if path == "/patient" and method == "GET":
+            doc_id = parse_qs(query).get("id", [None])[0]
+            if not doc_id:
+                return 400, {}, b"Missing ?id="
+            patient = await asyncio.get_running_loop().run_in_executor(self._executor, load_patient, doc_id)
+            if patient is None:
+                return 404, {}, b"Not Found"
+            return 200, {"Content-Type": "application/json"}, json.dumps(patient, default=str).encode("utf-8")
+        if path.startswith("/queue") and self.work_queue is not None:
+            return await self._dispatch_queue(method, path, body, query)
+        handlers = {"/": pipeline.handle_triage, "/triage": pipeline.handle_triage,
+                    "/triage_batch": pipeline.handle_triage_batch}
+        handler = handlers.get(path)
+        if handler is None:
+            return 404, {}, b"Not Found"
+        if method != "POST":
+            return 405, {}, b"Method Not Allowed"
+        try:
+            request_json = json.loads(body) if body else None
+        except ValueError:
+            request_json = None  # same as request.get_json(silent=True); the handler answers 400
+
+        self._in_flight += 1
+        self._idle.clear()
+        loop = asyncio.get_running_loop()
+        try:
+            if handler is pipeline.handle_triage and pipeline.admission is not None:
+                # handle_triage waits in the AdmissionController, most severe first; a FIFO
+                # semaphore in front of it would decide the order before severity is known
+                result = await loop.run_in_executor(self._executor, handler, request_json)
+            else:
+                async with self._slots:
+                    result = await loop.run_in_executor(self._executor, handler, request_json)
+            self.served += 1
+            return normalize_response(result)
+        except Exception as e:
+            print(f"Unhandled error in {path}: {e}")
+            return 500, {"Content-Type": "application/json"}, json.dumps({"error": str(e)}).encode("utf-8")
+        finally:
+            self._in_flight -= 1
+            if not self._in_flight:
+                self._idle.set()
+
+    async def _dispatch_queue(self, method, path, body, query):
+        loop = asyncio.get_running_loop()
+        if path == "/queue" and method == "GET":
+            try:
+                k = int(parse_qs(query).get("k", ["10"])[0])
+            except ValueError:
+                k = 0
+            if not 1 <= k <= QUEUE_MAX_K:
+                return 400, {}, f"k must be an integer between 1 and {QUEUE_MAX_K}".encode("utf-8")
+            payload = {"patients": self.work_queue.top(k), **self.work_queue.stats()}
+        elif path == "/queue/claim" and method == "POST":
+            try:
+                coordinator = (json.loads(body) if body else {}).get("coordinator")
+            except ValueError:
+                coordinator = None
+            if not coordinator:
+                return 400, {}, b'Request body must be {"coordinator": "..."}'
+            payload = {"patient": await loop.run_in_executor(self._executor, self.work_queue.claim, coordinator)}
+        else:
+            return 404, {}, b"Not Found"
+        return 200, {"Content-Type": "application/json"}, json.dumps(payload, default=str).encode("utf-8")
+
+    @staticmethod
+    async def _write(writer, status, headers, body, keep_alive):
+        headers = {"Content-Type": "text/plain; charset=utf-8", **headers}
+        head = [f"HTTP/1.1 {status} {REASONS.get(status, 'Unknown')}",
+                f"Content-Length: {len(body)}",
+                f"Connection: {'keep-alive' if keep_alive else 'close'}",
+                f"Date: {time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime())}"]
+        head += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+
+async def main():
+    server = TriageServer()
+    await server.start()
+    await server.serve_forever()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,100 @@
+import hashlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from admission import SEVERITY_RANK
+from caching import LRUTTLCache, normalize_message
+
+# What a session has established so far: the merged symptoms, the most severe severity any
+# turn was answered with, and the red-flag phrases matched in any turn
+SessionContext = namedtuple("SessionContext", ["symptoms", "severity", "red_flags"])
+EMPTY_CONTEXT = SessionContext((), None, ())
+
+
+def merge_symptoms(known, new):
+    """Known symptoms followed by the genuinely new ones, de-duplicated on their normalized text."""
+    merged = list(known)
+    seen = {normalize_message(s) for s in merged}
+    for symptom in new:
+        key = normalize_message(symptom)
+        if key and key not in seen:
+            seen.add(key)
+            merged.append(symptom)
+    return merged
+
+
+def more_severe(a, b):
+    """The more severe of two severities; labels outside SEVERITY_RANK never win over a ranked one."""
+    if b not in SEVERITY_RANK:
+        return a
+    if a not in SEVERITY_RANK or SEVERITY_RANK[b] < SEVERITY_RANK[a]:
+        return b
+    return a
+
+
+class SessionContextStore:
+    """
+    Symptoms extracted so far in each Dialogflow CX session, with the highest
+    severity and the red flags seen so far (SessionContext).
+
+    The in-memory tier (LRU + TTL) serves follow-up turns that land on the same
+    instance. With get_db set, every update is also written through to Firestore
+    in the background, and a memory miss falls back to Firestore, so a follow-up
+    turn routed to another instance still sees the earlier symptoms.
+    """
+
+    def __init__(self, maxsize=10000, ttl_seconds=3600.0, get_db=None, collection="triage_sessions"):
+        self._memory = LRUTTLCache(maxsize=maxsize, ttl_seconds=ttl_seconds)
+        self._get_db = get_db
+        self.collection = collection
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-context") if get_db else None
+
+    @staticmethod
+    def _doc_id(session_id):
+        # CX session ids are resource paths ("projects/.../sessions/abc"); '/' isn't allowed in doc ids
+        return hashlib.sha256(session_id.encode("utf-8")).hexdigest()
+
+    def get(self, session_id):
+        context = self._memory.get(session_id)
+        if context is not None:
+            return context
+        if self._get_db is None:
+            return EMPTY_CONTEXT
+        try:
+            snapshot = self._get_db().collection(self.collection).document(self._doc_id(session_id)).get()
+        except Exception as e:
+            print(f"Could not read session context from Firestore: {e}")
+            return EMPTY_CONTEXT
+        data = (snapshot.to_dict() or {}) if snapshot.exists else {}
+        context = SessionContext(tuple(data.get("symptoms", [])), data.get("severity"), tuple(data.get("red_flags", [])))
+        self._memory.put(session_id, context)
+        return context
+
+    def update(self, session_id, symptoms=None, severity=None, red_flags=()):
+        """
+        Record a turn: symptoms (when given) replace the merged list, severity only ever
+        goes up and red flags accumulate. Returns the new SessionContext.
+        """
+        known = self.get(session_id)
+        context = SessionContext(
+            tuple(symptoms) if symptoms is not None else known.symptoms,
+            more_severe(known.severity, severity),
+            known.red_flags + tuple(flag for flag in red_flags if flag not in known.red_flags),
+        )
+        self._memory.put(session_id, context)
+        if self._writer is not None and context != known:
+            self._writer.submit(self._write_through, session_id, context)
+        return context
+
+    def _write_through(self, session_id, context):
+        from google.cloud.firestore import SERVER_TIMESTAMP
+        try:
+            self._get_db().collection(self.collection).document(self._doc_id(session_id)).set(
+                {"session": session_id, "symptoms": list(context.symptoms), "severity": context.severity,
+                 "red_flags": list(context.red_flags), "updated_at": SERVER_TIMESTAMP}
+            )
+        except Exception as e:
+            print(f"Could not write session context to Firestore: {e}")
+
+    def stats(self):
+        return self._memory.stats()
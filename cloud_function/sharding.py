@@ -0,0 +1,106 @@
+"""
+Sharded Firestore layout for high-rate patients writes.
+
+One patients collection whose documents all carry a monotonically increasing
+timestamp concentrates every write on the tail of the same index range, which
+caps sustained intake. With n_shards > 1, a document lives in
+patient_shards/<NN>/patients/<id>, NN chosen by hashing its id: index entries
+of a collection-scoped index are prefixed by the parent path, so writes spread
+over n_shards ranges. Every shard is a "patients" collection, so the existing
+single-field indexes and a collection-group query still see all of them.
+
+Per-severity totals come from ShardedCounter, so dashboards read a handful of
+small documents instead of running aggregate queries over patients.
+"""
+import heapq
+import random
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from write_behind import Merge
+
+PATIENTS_COLLECTION = "patients"
+
+
+class PatientShards:
+    """Where a patients document lives, and reads that merge all shards back together."""
+
+    def __init__(self, n_shards=1, root="patient_shards", collection=PATIENTS_COLLECTION):
+        self.n_shards = max(1, n_shards)
+        self.root = root
+        self.collection = collection
+
+    @property
+    def sharded(self):
+        return self.n_shards > 1
+
+    def shard_of(self, doc_id):
+        return zlib.crc32(doc_id.encode("utf-8")) % self.n_shards
+
+    def shard_path(self, shard):
+        return f"{self.root}/{shard:02d}/{self.collection}" if self.sharded else self.collection
+
+    def collection_path(self, doc_id):
+        """Collection path for doc_id; usable with db.collection(path) and WriteBehindQueue.enqueue()."""
+        return self.shard_path(self.shard_of(doc_id)) if self.sharded else self.collection
+
+    def new_id(self, db):
+        """Random document id, allocated client side (the id decides the shard)."""
+        return db.collection(self.collection).document().id
+
+    def document(self, db, doc_id):
+        return db.collection(self.collection_path(doc_id)).document(doc_id)
+
+    def query_merged(self, db, limit=50, field="timestamp", descending=True, filters=()):
+        """
+        The first `limit` documents across all shards, ordered by `field`.
+        Each shard is queried in parallel with the same filters / order / limit
+        and the sorted results are merged; needs the same index as the unsharded query.
+        filters are (field, op, value) tuples, e.g. [("status", "==", "queued")].
+        """
+        from google.cloud.firestore import Query
+        direction = Query.DESCENDING if descending else Query.ASCENDING
+
+        def run(shard):
+            query = db.collection(self.shard_path(shard))
+            for f in filters:
+                query = query.where(*f)
+            return list(query.order_by(field, direction=direction).limit(limit).stream())
+
+        with ThreadPoolExecutor(max_workers=min(self.n_shards, 16)) as pool:
+            per_shard = list(pool.map(run, range(self.n_shards)))
+        merged = heapq.merge(*per_shard, key=lambda snap: snap.get(field), reverse=descending)
+        return [snap for _, snap in zip(range(limit), merged)]
+
+
+class ShardedCounter:
+    """
+    Counters spread over n_shards documents: <collection>/<name>/shards/<k>.{count}.
+
+    increment() writes nothing itself: it returns the (collection, doc id, data)
+    write adding delta to a random shard, for the caller to commit in the same
+    batch as the document being counted, written as a write_behind.Create: a
+    re-run that stores the same document again then fails as a whole instead
+    of counting it twice. A count is stored exactly once, when that document
+    is first created, with no in-process buffer to lose when an instance is
+    frozen or stopped, and concurrent instances rarely contend on one shard.
+    """
+
+    def __init__(self, get_db, collection="severity_counters", n_shards=10):
+        self._get_db = get_db
+        self.collection = collection
+        self.n_shards = n_shards
+
+    def increment(self, name, delta=1):
+        from google.cloud.firestore import Increment
+        return (f"{self.collection}/{name}/shards", str(random.randrange(self.n_shards)),
+                Merge({"count": Increment(delta)}))
+
+    def totals(self, names):
+        """{name: total} summed over every shard (n_shards small reads per name)."""
+        db = self._get_db()
+        totals = {}
+        for name in names:
+            shards = db.collection(self.collection).document(name).collection("shards").stream()
+            totals[name] = sum((snap.to_dict() or {}).get("count", 0) for snap in shards)
+        return totals
@@ -0,0 +1,56 @@
+import json
+import time
+from contextlib import contextmanager
+
+
+class StageTimer:
+    """
+    Records how long each stage of one request took.
+
+    Use `with timer.stage("extract"):` around each step, then expose the
+    result as a Server-Timing header and/or one structured log line.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self._clock = clock
+        self.started_at = clock()
+        self.stages = []  # (name, seconds), in execution order
+
+    @contextmanager
+    def stage(self, name):
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self.stages.append((name, self._clock() - start))
+
+    def total_seconds(self):
+        return self._clock() - self.started_at
+
+    def durations_ms(self):
+        durations = {}
+        for name, seconds in self.stages:
+            durations[name] = round(durations.get(name, 0.0) + seconds * 1000, 3)
+        return durations
+
+    def server_timing_header(self):
+        """e.g. 'parse;dur=0.4, extract;dur=812.3, predict;dur=95.0, total;dur=910.2'"""
+        parts = [f"{name};dur={ms:.1f}" for name, ms in self.durations_ms().items()]
+        parts.append(f"total;dur={self.total_seconds() * 1000:.1f}")
+        return ", ".join(parts)
+
+    def log(self, message="triage timing", **labels):
+        """
+        Print one JSON line; Cloud Logging turns it into a structured jsonPayload,
+        so stage latencies can be charted per session, doc id or severity outcome.
+        "severity" is Cloud Logging's log level field, triage labels go in their own keys.
+        """
+        record = {
+            "severity": "INFO",
+            "message": message,
+            "stages_ms": self.durations_ms(),
+            "total_ms": round(self.total_seconds() * 1000, 3),
+        }
+        record.update({key: value for key, value in labels.items() if value is not None})
+        print(json.dumps(record, default=str))
+        return record
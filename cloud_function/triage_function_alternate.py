@@ -1,31 +1,21 @@
 import json
 import os
 import functions_framework
-from google.cloud import firestore
-# from google.cloud.aiplatform_v1.services.prediction_service import PredictionServiceClient # No longer needed
-# from vertexai.generative_models import GenerativeModel, Part # Still needed for symptom extraction
-import vertexai # Still needed for vertexai.init
-import random
 import decimal # For precise decimal formatting
+# No prediction client here: severity comes from the offline local model.
+# vertexai / google.cloud.firestore are only imported when their client is first built (clients.py)
+from clients import get_db, get_gemini, lazy_singleton, warm_in_background
 
-# PROJECT = os.environ["GCP_PROJECT"]
-PROJECT = os.environ.get("GOOGLE_CLOUD_PROJECT", "crypto-sphere-464015-e4")
-if not PROJECT:
-    raise ValueError("GOOGLE_CLOUD_PROJECT environment variable not found.")
 
-REGION = "us-central1"
-vertexai.init(project=PROJECT, location=REGION) # Still needed for Gemini symptom extraction
+# Offline severity classifier (utils/train_local_severity.py) replaces the old random placeholder
+@lazy_singleton
+def get_local_model():
+    from local_severity import load_local_model  # pulls in numpy
+    return load_local_model()
 
-# Latest at time of writing
-# We keep GenerativeModel for symptom extraction, so this is still needed
-from vertexai.generative_models import GenerativeModel, Part
-GEMINI = GenerativeModel("gemini-2.5-flash")
 
-# Remove or comment out SEVERITY_ENDPOINT and related client initialization
-# SEVERITY_ENDPOINT = "projects/506101299280/locations/us-central1/endpoints/8775805933163905024"
-# severity_prediction_client = PredictionServiceClient() # No longer needed
-
-db = firestore.Client()
+if os.environ.get("WARM_CLIENTS_ON_STARTUP", "true").lower() in ("1", "true", "yes"):
+    warm_in_background(get_gemini, get_db, get_local_model)
 
 @functions_framework.http
 def triage(request):
@@ -73,12 +63,13 @@ def triage(request):
 
     try:
         # 1️⃣ extract symptoms with Gemini function-calling
+        from vertexai.generative_models import Part
         prompt = Part.from_text(
             f"""Extract the key medical symptoms from this free-text (no interpretation):
             \"\"\"{user_msg}\"\"\".
             Return a JSON list of max 5 symptoms."""
         )
-        symptoms_response = GEMINI.generate_content(prompt,
+        symptoms_response = get_gemini().generate_content(prompt,
                                     generation_config={"response_mime_type": "application/json"}
                                  )
         symptoms = json.loads(symptoms_response.text)
@@ -94,21 +85,17 @@ def triage(request):
             confidence = 0.0
             dialogflow_message = "I couldn't extract any specific symptoms from your message. Could you please describe them more clearly?"
         else:
-            # 2️⃣ Severity prediction - STATIC CODE REPLACEMENT
-            print(f"Switching to static severity prediction.")
-
-            # Define possible severities
-            possible_severities = ["routine", "moderate", "urgent", "emergent"]
-
-            # Randomly select a severity
-            severity = random.choice(possible_severities)
+            # 2️⃣ Severity prediction - offline local classifier on the raw message
+            local_model = get_local_model()
+            if local_model is not None:
+                severity, confidence_raw = local_model.predict(user_msg)
+            else:
+                severity, confidence_raw = "unknown_severity", 0.0
 
-            # Randomly generate a confidence level (float with 3 decimal places)
-            # Use Decimal for precise floating point arithmetic
-            confidence_raw = random.uniform(0, 1)
+            # Use Decimal for precise floating point arithmetic (3 decimal places)
             confidence = float(decimal.Decimal(confidence_raw).quantize(decimal.Decimal('0.001'), rounding=decimal.ROUND_HALF_UP))
 
-            print(f"Randomly detected severity is {severity} with confidence level: {confidence}")
+            print(f"Locally detected severity is {severity} with confidence level: {confidence}")
 
             # 3️⃣ Decide next step and prepare initial dialogflow_message
             dialogflow_message = ""
@@ -128,13 +115,14 @@ def triage(request):
         # 3️⃣ Save to Firestore
         doc_ref_id = None
         try:
-            update_time, doc_ref = db.collection("patients").add({
+            from google.cloud.firestore import SERVER_TIMESTAMP
+            update_time, doc_ref = get_db().collection("patients").add({
                 "msg": user_msg,
                 "symptoms": symptoms,
                 "severity": severity,
                 "confidence": confidence,
                 "status": "queued",
-                "timestamp": firestore.SERVER_TIMESTAMP
+                "timestamp": SERVER_TIMESTAMP
             })
             doc_ref_id = doc_ref.id
         except Exception as firestore_e:
@@ -1,22 +1,27 @@
-import vertexai
 import json
+import math
 import os
+import time
 import functions_framework
-from google.cloud import firestore
-from google.cloud.aiplatform_v1.services.prediction_service import PredictionServiceClient
-from vertexai.generative_models import GenerativeModel, Part
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from admission import AdmissionController, Overloaded, parse_budgets
+from caching import LRUTTLCache, SingleFlight, normalize_message, symptom_set_key
+from circuit_breaker import OPEN, CircuitBreaker
+from clients import GEMINI_MODEL_NAME, generate_content, get_db, get_gemini, get_prediction_client, init_vertexai, lazy_singleton, warm_in_background
+from hedging import HedgedCaller, TrackedExecutor
+from idempotency import TurnRegistry, doc_id_for, turn_key
+from micro_batching import PredictionBatcher
+from patient_codec import PatientCodec
+from red_flags import RedFlagMatcher
+from session_context import EMPTY_CONTEXT, SessionContextStore, merge_symptoms, more_severe
+from sharding import PatientShards, ShardedCounter
+from timing import StageTimer
+from work_queue import queue_fields
+from write_behind import FIRESTORE_BATCH_LIMIT, Create, WriteBehindQueue, already_exists, stage_write
 
-# PROJECT = os.environ["GCP_PROJECT"]
-# Use .get() for safer access,
-PROJECT = os.environ.get("GOOGLE_CLOUD_PROJECT", "crypto-sphere-464015-e4")
-if not PROJECT:
-    raise ValueError("GOOGLE_CLOUD_PROJECT environment variable not found.")
+# Heavy SDK modules (vertexai, google.cloud.*) and numpy are only imported when a client or
+# the local model is first built, see clients.py
 
-REGION = "us-central1"
-vertexai.init(project=PROJECT, location=REGION)
-
-# Latest at time of writing :contentReference[oaicite:0]{index=0}
-GEMINI = GenerativeModel("gemini-2.5-flash")
 #SEVERITY_ENDPOINT = f"projects/{PROJECT}/locations/{REGION}/publishers/google/models/8775805933163905024"
 #SEVERITY_ENDPOINT = f"https://us-central1-aiplatform.googleapis.com/v1/projects/{PROJECT}/locations/us-central1/endpoints/8775805933163905024:predict"
 #SEVERITY_ENDPOINT = f"https://us-central1-aiplatform.googleapis.com/v1/projects/{PROJECT}/locations/us-central1/endpoints/8775805933163905024:predict"
@@ -27,14 +32,462 @@ GEMINI = GenerativeModel("gemini-2.5-flash")
 #SEVERITY_ENDPOINT = "https://us-central1-aiplatform.googleapis.com/projects/506101299280/locations/us-central1/endpoints/8775805933163905024:predict"
 SEVERITY_ENDPOINT = "projects/506101299280/locations/us-central1/endpoints/8775805933163905024"
 
-db = firestore.Client()
-#severity_prediction_client = aiplatform.PredictionServiceClient()
-severity_prediction_client = PredictionServiceClient()
+# Write-behind persistence: the doc id is allocated locally and returned right away,
+# the write itself is committed in the background in WriteBatch groups. When the queue is
+# backed up or its commits are failing, writes are committed synchronously before answering.
+# FIRESTORE_SPILL_PATH is optional and must be durable, shared storage (not /tmp).
+FIRESTORE_WRITE_BEHIND = os.environ.get("FIRESTORE_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+patient_writer = None
+if FIRESTORE_WRITE_BEHIND:
+    patient_writer = WriteBehindQueue(
+        get_db,
+        flush_interval_seconds=float(os.environ.get("FIRESTORE_FLUSH_INTERVAL_MS", "50")) / 1000,
+        spill_path=os.environ.get("FIRESTORE_SPILL_PATH") or None,
+        max_pending=int(os.environ.get("FIRESTORE_MAX_PENDING", "2000")),
+    )
+    patient_writer.install_shutdown_hooks()
+    patient_writer.replay_spill()
+
+# Sharded patients layout (sharding.py): PATIENT_SHARDS > 1 spreads documents over
+# patient_shards/NN/patients so timestamp-indexed writes don't all land on one index range.
+# Per-severity totals are kept in sharded counters instead of aggregate queries; each patient's
+# increment is one more write in the batch that stores the patient (patient_writes below).
+PATIENT_SHARDS = PatientShards(int(os.environ.get("PATIENT_SHARDS", "1")))
+SEVERITY_COUNTERS = os.environ.get("SEVERITY_COUNTERS", "true").lower() in ("1", "true", "yes")
+severity_counter = None
+if SEVERITY_COUNTERS:
+    severity_counter = ShardedCounter(get_db, n_shards=int(os.environ.get("SEVERITY_COUNTER_SHARDS", "10")))
+
+# Patients schema: "full" stores the record as built below; "compact" (patient_codec.py) stores
+# a small hot document (severity / confidence / symptom codes as ints) for list views and
+# moves the raw message and free-text symptoms to patients_raw/<id>, read only on drill-down.
+PATIENT_SCHEMA = os.environ.get("PATIENT_SCHEMA", "full").lower()
+patient_codec = PatientCodec(get_db) if PATIENT_SCHEMA == "compact" else None
+
+
+def patient_writes(doc_id, record):
+    """
+    (collection path, doc id, data) of every document one patient record is stored as, plus new
+    symptom codes. Includes the record's severity counter increment, with the patient document as
+    a Create: committing these writes together counts the patient exactly once, when it is first
+    stored, and a re-run of the same turn (same doc id) fails with AlreadyExists instead.
+    """
+    path = PATIENT_SHARDS.collection_path(doc_id)
+    new_codes = {}
+    if patient_codec is None:
+        writes = [(path, doc_id, record)]
+    else:
+        hot, cold, new_codes = patient_codec.encode(record)
+        writes = [(path, doc_id, hot)]
+        if cold:
+            writes.append((patient_codec.cold_collection, doc_id, cold))
+        writes += [(patient_codec.vocabulary_collection, str(code), {"text": text}) for code, text in new_codes.items()]
+    if severity_counter is not None:
+        writes[0] = (path, doc_id, Create(writes[0][2]))
+        writes.append(severity_counter.increment(record.get("severity")))
+    return writes, new_codes
+
+
+def commit_writes(db, writes):
+    batch = db.batch()
+    for collection, doc_id, data in writes:
+        stage_write(batch, db.collection(collection).document(doc_id), data)
+    batch.commit()
+
+
+# Speculative severity: score the raw user message while Gemini is still extracting symptoms.
+# The prediction on extracted symptoms wins if it lands before the webhook deadline,
+# otherwise we answer with the speculative one instead of letting Dialogflow CX time out.
+SPECULATIVE_SEVERITY = os.environ.get("SPECULATIVE_SEVERITY", "false").lower() in ("1", "true", "yes")
+WEBHOOK_DEADLINE_SECONDS = float(os.environ.get("WEBHOOK_DEADLINE_SECONDS", "5.0"))  # CX default webhook timeout
+WEBHOOK_SAFETY_MARGIN_SECONDS = float(os.environ.get("WEBHOOK_SAFETY_MARGIN_SECONDS", "1.0"))  # Firestore + response
+_prediction_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("PREDICTION_WORKERS", "8")))
+
+# Offline classifier trained from fine_tuning_training (utils/train_local_severity.py).
+# With LOCAL_FAST_PATH=true, confident local predictions skip the Vertex endpoint round-trip:
+# only labels whose held-out precision reached the training script's target have a threshold
+# (stored in the artifact, LOCAL_SEVERITY_THRESHOLD overrides it for every label), and never
+# when the model gives the more severe labels any real probability, so it can't undertriage.
+@lazy_singleton
+def get_local_model():
+    from local_severity import load_local_model  # pulls in numpy
+    return load_local_model()
+
+
+LOCAL_FAST_PATH = os.environ.get("LOCAL_FAST_PATH", "false").lower() in ("1", "true", "yes")
+LOCAL_SEVERITY_THRESHOLD = float(os.environ["LOCAL_SEVERITY_THRESHOLD"]) if os.environ.get("LOCAL_SEVERITY_THRESHOLD") else None
+
+
+def local_fast_prediction(user_msg):
+    """(severity, confidence) from the local model when it may stand in for the endpoint, else None."""
+    local_model = get_local_model() if LOCAL_FAST_PATH else None
+    if local_model is None:
+        return None
+    prediction = local_model.confident_prediction(user_msg, threshold=LOCAL_SEVERITY_THRESHOLD)
+    print(f"local fast path {'answers ' + str(prediction) if prediction else 'not confident'}")
+    return prediction
+
+# Nearest-neighbour severity over the same labeled corpus (knn_severity.py, built by
+# utils/build_knn_index.py). Consulted when the local model isn't confident; the neighbours are
+# kept with the patient as evidence (KNN_EVIDENCE). With KNN_FAST_PATH=true the vote may also
+# skip the endpoint, under the same rules as the local fast path: only with a label's threshold
+# calibrated by leave-one-out and stored with the index (KNN_SEVERITY_THRESHOLD overrides it for
+# every label), and never when a more severe label gets any real share of the vote.
+KNN_EVIDENCE = os.environ.get("KNN_EVIDENCE", "true").lower() in ("1", "true", "yes")
+KNN_FAST_PATH = os.environ.get("KNN_FAST_PATH", "false").lower() in ("1", "true", "yes")
+KNN_SEVERITY_THRESHOLD = float(os.environ["KNN_SEVERITY_THRESHOLD"]) if os.environ.get("KNN_SEVERITY_THRESHOLD") else None
+KNN_MIN_SIMILARITY = float(os.environ.get("KNN_MIN_SIMILARITY", "0.5"))
+
+
+@lazy_singleton
+def get_knn_retriever():
+    from knn_severity import load_knn_retriever  # pulls in numpy, memory-maps the index
+    return load_knn_retriever()
+
+
+def knn_predictions(messages):
+    """
+    One (prediction, neighbours) per message: prediction is the (severity, confidence) the vote
+    answers with when it may skip the endpoint, else None; neighbours is None without an index.
+    """
+    retriever = get_knn_retriever() if KNN_EVIDENCE or KNN_FAST_PATH else None
+    if retriever is None:
+        return [(None, None)] * len(messages)
+    results = retriever.confident_batch(messages, threshold=KNN_SEVERITY_THRESHOLD, min_similarity=KNN_MIN_SIMILARITY)
+    return [(prediction if KNN_FAST_PATH else None, neighbours) for prediction, neighbours in results]
+
+# Red-flag lexicon (red_flags.py), compiled once per instance: obvious emergencies are
+# answered without waiting on Gemini or the severity endpoint
+RED_FLAG_FAST_PATH = os.environ.get("RED_FLAG_FAST_PATH", "true").lower() in ("1", "true", "yes")
+RED_FLAG_MATCHER = RedFlagMatcher()
+
+# Build clients in the background right after import so the first request doesn't pay for them
+if os.environ.get("WARM_CLIENTS_ON_STARTUP", "true").lower() in ("1", "true", "yes"):
+    warm_in_background(get_gemini, get_prediction_client, get_db, get_local_model, get_knn_retriever)
+
+# Warm instances remember what Gemini extracted for messages they've already seen
+EXTRACTION_CACHE = LRUTTLCache(
+    maxsize=int(os.environ.get("EXTRACTION_CACHE_SIZE", "2048")),
+    ttl_seconds=float(os.environ.get("EXTRACTION_CACHE_TTL_SECONDS", "3600")),
+)
+
+
+# Single-flight: identical concurrent cache misses (e.g. everyone pasting the same outreach
+# template) share one in-flight Gemini / predict call instead of each sending their own
+SINGLE_FLIGHT = os.environ.get("SINGLE_FLIGHT", "true").lower() in ("1", "true", "yes")
+BACKEND_FLIGHTS = SingleFlight()
+
+
+def single_flight(key, fn):
+    return BACKEND_FLIGHTS.do(key, fn) if SINGLE_FLIGHT else fn()
+
+
+# Multi-turn CX sessions: remember the symptoms extracted so far per session, so each turn only
+# sends its own new message to Gemini and severity is scored on the merged set.
+# SESSION_CONTEXT_FIRESTORE adds a Firestore tier for turns that land on another instance.
+SESSION_CONTEXT = os.environ.get("SESSION_CONTEXT", "true").lower() in ("1", "true", "yes")
+SESSION_CONTEXT_FIRESTORE = os.environ.get("SESSION_CONTEXT_FIRESTORE", "false").lower() in ("1", "true", "yes")
+SESSION_STORE = SessionContextStore(
+    maxsize=int(os.environ.get("SESSION_CONTEXT_SIZE", "10000")),
+    ttl_seconds=float(os.environ.get("SESSION_CONTEXT_TTL_SECONDS", "3600")),
+    get_db=get_db if SESSION_CONTEXT_FIRESTORE else None,
+)
+
+# Admission control for the self-hosted server, where one instance runs many requests at once:
+# requests are pre-scored cheaply (red-flag lexicon, then the local model) and wait for one of
+# ADMISSION_MAX_CONCURRENT slots in severity-then-arrival order; routine work is shed first
+# once the queue is full or its latency budget (ADMISSION_BUDGETS) has been spent waiting.
+ADMISSION_CONTROL = os.environ.get("ADMISSION_CONTROL", "false").lower() in ("1", "true", "yes")
+ADMISSION_PRESCORE_CONFIDENCE = float(os.environ.get("ADMISSION_PRESCORE_CONFIDENCE", "0.6"))
+admission = None
+if ADMISSION_CONTROL:
+    admission = AdmissionController(
+        max_concurrent=int(os.environ.get("ADMISSION_MAX_CONCURRENT", "8")),
+        max_queue=int(os.environ.get("ADMISSION_MAX_QUEUE", "64")),
+        latency_budgets=parse_budgets(os.environ.get("ADMISSION_BUDGETS")),
+    )
+
+
+def pre_score(user_msg):
+    """Cheap severity guess used only to order admission: red flags, then a reasonably confident local model."""
+    if RED_FLAG_MATCHER.match(user_msg):
+        return "emergent"
+    local_model = get_local_model()
+    if local_model is not None:
+        severity, confidence = local_model.predict(user_msg)
+        if confidence >= ADMISSION_PRESCORE_CONFIDENCE:
+            return severity
+    return "moderate"  # not sure: neither first in line nor first to be shed
+
+
+# Idempotent turns: a Dialogflow retry of a turn that is still running (or already answered
+# on this instance) gets that turn's response instead of paying for Gemini, predict and a
+# second patients document. Only successful responses are kept: a turn answered with 200 but
+# whose patient document couldn't be saved is marked with PERSIST_FAILED_HEADER, so a retry
+# runs it (and the write) again instead of replaying an answer nothing was stored for.
+IDEMPOTENT_WEBHOOK = os.environ.get("IDEMPOTENT_WEBHOOK", "true").lower() in ("1", "true", "yes")
+PERSIST_FAILED_HEADER = "X-Triage-Persist-Failed"
+TURN_REGISTRY = TurnRegistry(
+    maxsize=int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", "10000")),
+    ttl_seconds=float(os.environ.get("IDEMPOTENCY_TTL_SECONDS", "600")),
+    should_store=lambda response: response[1] == 200 and PERSIST_FAILED_HEADER not in response[2],
+)
+
+# Adaptive deadlines and hedged requests per backend (hedging.py): once a call runs past the
+# rolling p95 a second attempt is sent and the first answer wins; hedges are capped at
+# HEDGE_MAX_RATIO of calls so quota use stays close to 1x.
+# The pool has a worker for every backend call that REQUEST_CONCURRENCY requests can have in
+# flight (two per request with speculative severity) plus hedge headroom, so primaries don't
+# queue behind each other; when it is saturated anyway, no hedges are sent.
+HEDGED_CALLS = os.environ.get("HEDGED_CALLS", "true").lower() in ("1", "true", "yes")
+HEDGE_MAX_RATIO = float(os.environ.get("HEDGE_MAX_RATIO", "0.1"))
+REQUEST_CONCURRENCY = int(os.environ.get("REQUEST_CONCURRENCY") or os.environ.get("SERVER_MAX_CONCURRENCY") or "32")
+_backend_pool = TrackedExecutor(max_workers=int(os.environ.get("BACKEND_WORKERS") or math.ceil(
+    REQUEST_CONCURRENCY * (2 if SPECULATIVE_SEVERITY else 1) * (1 + HEDGE_MAX_RATIO))))
+GEMINI_CALLER = HedgedCaller(
+    "gemini", _backend_pool,
+    default_timeout=float(os.environ.get("GEMINI_TIMEOUT_SECONDS", "4.0")),
+    max_timeout=float(os.environ.get("GEMINI_MAX_TIMEOUT_SECONDS", "4.0")),
+    max_hedge_ratio=HEDGE_MAX_RATIO,
+    timeout_kwarg="timeout",  # clients.generate_content() sends it as the RPC deadline
+)
+SEVERITY_CALLER = HedgedCaller(
+    "severity", _backend_pool,
+    default_timeout=float(os.environ.get("SEVERITY_TIMEOUT_SECONDS", "2.0")),
+    max_timeout=float(os.environ.get("SEVERITY_MAX_TIMEOUT_SECONDS", "3.0")),
+    max_hedge_ratio=HEDGE_MAX_RATIO,
+    timeout_kwarg="timeout",  # the gRPC client aborts a losing attempt at the deadline
+)
+
+
+# Circuit breaker around the severity endpoint: while it is open, calls fail fast and
+# triage() answers from the offline fallback scorer, tagged as degraded
+SEVERITY_BREAKER = CircuitBreaker(
+    "severity",
+    failure_rate_threshold=float(os.environ.get("BREAKER_FAILURE_RATE", "0.5")),
+    slow_call_seconds=float(os.environ.get("BREAKER_SLOW_CALL_SECONDS", "2.0")),
+    open_seconds=float(os.environ.get("BREAKER_OPEN_SECONDS", "30")),
+)
+
+
+def call_gemini(model, contents, **kwargs):
+    """model.generate_content(...) behind the Gemini adaptive deadline / hedge, with a client-side RPC deadline."""
+    if not HEDGED_CALLS:
+        return generate_content(model, contents, timeout=GEMINI_CALLER.default_timeout, **kwargs)
+    return GEMINI_CALLER.call(generate_content, model, contents, **kwargs)
 
 
-db = firestore.Client()
-#severity_prediction_client = aiplatform.PredictionServiceClient()
-severity_prediction_client = PredictionServiceClient()
+def call_predict(**kwargs):
+    """PredictionServiceClient.predict(...) behind the circuit breaker and the adaptive deadline / hedge."""
+    client = get_prediction_client()
+    if not HEDGED_CALLS:
+        return SEVERITY_BREAKER.call(client.predict, timeout=SEVERITY_CALLER.default_timeout, **kwargs)
+    return SEVERITY_BREAKER.call(SEVERITY_CALLER.call, client.predict, **kwargs)
+
+
+def extract_symptoms(user_msg):
+    """Return the list of symptoms Gemini extracts from user_msg, served from cache when possible."""
+    cache_key = normalize_message(user_msg)
+    cached = EXTRACTION_CACHE.get(cache_key)
+    if cached is not None:
+        print(f"extraction cache hit {EXTRACTION_CACHE.stats()}")
+        return list(cached)
+    return list(single_flight(("extract", cache_key), lambda: _extract_symptoms_uncached(user_msg, cache_key)))
+
+
+def _extract_symptoms_uncached(user_msg, cache_key):
+    from vertexai.generative_models import Part
+    prompt = Part.from_text(
+        f"""Extract the key medical symptoms from this free-text (no interpretation):
+        \"\"\"{user_msg}\"\"\".
+        Return a JSON list of max 5 symptoms."""
+    )
+    symptoms_response = call_gemini(get_gemini(), prompt,
+                                generation_config={"response_mime_type": "application/json"}
+                             )
+    symptoms = json.loads(symptoms_response.text)
+
+    # Ensure symptoms is a list, even if Gemini returns a single string or non-list
+    if not isinstance(symptoms, list):
+        symptoms = [str(symptoms)] # Convert to list of string if not already
+
+    symptoms = tuple(symptoms)
+    EXTRACTION_CACHE.put(cache_key, symptoms)
+    return symptoms
+
+
+# Micro-batching for self-hosted deployments serving many requests per instance:
+# concurrent severity calls within a short window share one multi-instance predict.
+SEVERITY_MICROBATCH = os.environ.get("SEVERITY_MICROBATCH", "false").lower() in ("1", "true", "yes")
+severity_batcher = None
+if SEVERITY_MICROBATCH:
+    severity_batcher = PredictionBatcher(
+        lambda instances: call_predict(endpoint=SEVERITY_ENDPOINT, instances=instances).predictions,
+        max_batch_size=int(os.environ.get("SEVERITY_MICROBATCH_SIZE", "16")),
+        max_wait_seconds=float(os.environ.get("SEVERITY_MICROBATCH_WAIT_MS", "10")) / 1000,
+        max_in_flight=int(os.environ.get("SEVERITY_MICROBATCH_IN_FLIGHT", "4")),
+    )
+
+
+# Pipeline mode: "two_hop" = Gemini extraction then the severity endpoint (original flow),
+# "single_call" = one structured Gemini call returning symptoms, severity and ICD-10 code
+PIPELINE_MODE = os.environ.get("PIPELINE_MODE", "two_hop").lower()
+if PIPELINE_MODE not in ("two_hop", "single_call"):
+    raise ValueError(f"PIPELINE_MODE must be 'two_hop' or 'single_call', got {PIPELINE_MODE!r}")
+
+# Same system instruction as fine_tuning_training/aibot_train.jsonl
+TRIAGE_SYSTEM_INSTRUCTION = (
+    "You are an AI-powered healthcare triage assistant. Your job is to read free-text symptom descriptions "
+    "from patients and determine how urgently they need care. Focus only on the information provided, without "
+    "guessing or making diagnoses. Respond with a JSON object containing three fields: the extracted symptoms "
+    "(in plain English), the severity level (one of: 'routine', 'moderate', 'urgent', or 'emergent'), and an "
+    "optional ICD-10 code that best matches the complaint. Do not include explanations, just the JSON."
+)
+TRIAGE_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "symptoms": {"type": "array", "items": {"type": "string"}},
+        "severity": {"type": "string", "enum": ["routine", "moderate", "urgent", "emergent"]},
+        "icd10_code": {"type": "string", "nullable": True},
+    },
+    "required": ["symptoms", "severity"],
+}
+
+
+@lazy_singleton
+def get_triage_gemini():
+    init_vertexai()
+    from vertexai.generative_models import GenerativeModel
+    return GenerativeModel(GEMINI_MODEL_NAME, system_instruction=[TRIAGE_SYSTEM_INSTRUCTION])
+
+
+def triage_single_call(user_msg):
+    """
+    Extract symptoms, severity and ICD-10 code with one schema-enforced Gemini call.
+    Returns (symptoms, severity, confidence, icd10_code); confidence is the
+    probability of the generated answer (exp of its average token log-probability).
+    """
+    cache_key = ("single_call", normalize_message(user_msg))
+    cached = EXTRACTION_CACHE.get(cache_key)
+    if cached is not None:
+        print(f"single-call cache hit {EXTRACTION_CACHE.stats()}")
+        symptoms, severity, confidence, icd10_code = cached
+        return list(symptoms), severity, confidence, icd10_code
+    symptoms, severity, confidence, icd10_code = single_flight(cache_key, lambda: _triage_single_call_uncached(user_msg, cache_key))
+    return list(symptoms), severity, confidence, icd10_code
+
+
+def _triage_single_call_uncached(user_msg, cache_key):
+    response = call_gemini(
+        get_triage_gemini(),
+        f'"""{user_msg}"""',
+        generation_config={"response_mime_type": "application/json", "response_schema": TRIAGE_RESPONSE_SCHEMA},
+    )
+    result = json.loads(response.text)
+    symptoms = result.get("symptoms") or []
+    if not isinstance(symptoms, list):
+        symptoms = [str(symptoms)]
+    avg_logprobs = getattr(response.candidates[0], "avg_logprobs", None) if response.candidates else None
+    confidence = round(math.exp(avg_logprobs), 4) if avg_logprobs is not None else 0.0
+    icd10_code = result.get("icd10_code") or None
+
+    result = (tuple(symptoms), result.get("severity"), confidence, icd10_code)
+    EXTRACTION_CACHE.put(cache_key, result)
+    return result
+
+
+def predict_severity(input_text):
+    """Call the severity endpoint for one text and return (severity, confidence)."""
+    return single_flight(("predict", SEVERITY_ENDPOINT, input_text), lambda: _predict_severity_uncoalesced(input_text))
+
+
+def _predict_severity_uncoalesced(input_text):
+    instance = {"mime_type": "text/plain","content": input_text} # This is the most likely correct format for Gemini fine-tune
+    if severity_batcher is not None:
+        prediction = severity_batcher.predict(instance)
+    else:
+        prediction = call_predict(
+            endpoint=SEVERITY_ENDPOINT,
+            instances=[instance],
+        ).predictions[0]
+    print(f"prediction {prediction}")
+    return prediction["severity"], prediction["confidence"]
+
+
+def fallback_severity(user_msg):
+    """Offline scorer for when the endpoint is unavailable: the local model's best guess, whatever its confidence."""
+    local_model = get_local_model()
+    if local_model is None:
+        return "moderate", 0.0  # conservative default: see a professional within 24-48h
+    return local_model.predict(user_msg)
+
+
+NO_SYMPTOMS_MESSAGE = "I couldn't extract any specific symptoms from your message. Could you please describe them more clearly?"
+
+
+def advice_for_severity(severity):
+    """Map a model severity to (severity, message shown to the user); unknown labels become "unknown_severity"."""
+    if severity == "routine":
+        return severity, "Based on your symptoms, your condition appears routine. You may consider over-the-counter remedies or schedule a regular appointment if symptoms persist."
+    elif severity == "moderate":
+        return severity, "Your symptoms indicate a moderate concern. It's advisable to consult a healthcare professional within the next 24-48 hours. Would you like assistance finding a clinic?"
+    elif severity == "urgent":
+        return severity, "Your symptoms suggest an urgent need for care. Please seek medical attention within the next few hours. We can help you find an urgent care clinic or emergency room."
+    elif severity == "emergent":
+        return severity, "Your symptoms are emergent. Please call emergency services immediately or go to the nearest emergency room."
+    # Fallback for unknown severity from your model
+    return "unknown_severity", "I couldn't determine the severity of your symptoms. Please clarify or provide more details."
+
+
+# Severity results per canonical symptom set. The endpoint is part of the key, so pointing
+# SEVERITY_ENDPOINT at a new model version starts from an empty cache; the optional TTL
+# bounds how long a prediction is trusted for the same model.
+SEVERITY_CACHE = LRUTTLCache(
+    maxsize=int(os.environ.get("SEVERITY_CACHE_SIZE", "4096")),
+    ttl_seconds=float(os.environ.get("SEVERITY_CACHE_TTL_SECONDS", "0")),  # 0 = no expiry
+)
+
+
+def predict_severity_for_symptoms(symptoms):
+    """predict_severity() on the canonical symptom set, served from SEVERITY_CACHE when possible."""
+    symptom_set = symptom_set_key(symptoms)
+    cache_key = (SEVERITY_ENDPOINT, symptom_set)
+    cached = SEVERITY_CACHE.get(cache_key)
+    if cached is not None:
+        print(f"severity cache hit {SEVERITY_CACHE.stats()}")
+        return cached
+    # Send the canonical text so the cached answer is the one for this exact key
+    result = predict_severity(", ".join(symptom_set))
+    SEVERITY_CACHE.put(cache_key, result)
+    return result
+
+
+def extract_symptoms_within_deadline(user_msg, request_start):
+    """extract_symptoms(), raising FuturesTimeoutError if it can't finish before the webhook deadline."""
+    budget = WEBHOOK_DEADLINE_SECONDS - WEBHOOK_SAFETY_MARGIN_SECONDS - (time.monotonic() - request_start)
+    if budget <= 0:
+        raise FuturesTimeoutError("no time left for symptom extraction")
+    return _prediction_pool.submit(extract_symptoms, user_msg).result(timeout=budget)
+
+
+def resolve_severity(symptoms, speculative_future, request_start):
+    """
+    Prefer the prediction on extracted symptoms; fall back to the speculative
+    prediction on the raw message when the webhook deadline gets close.
+    """
+    budget = WEBHOOK_DEADLINE_SECONDS - WEBHOOK_SAFETY_MARGIN_SECONDS - (time.monotonic() - request_start)
+    if budget > 0:
+        primary_future = _prediction_pool.submit(predict_severity_for_symptoms, symptoms)
+        try:
+            return primary_future.result(timeout=budget)
+        except FuturesTimeoutError:
+            print(f"symptom prediction missed the {budget:.2f}s budget, using speculative prediction")
+        except Exception as primary_e:
+            print(f"symptom prediction failed ({primary_e}), using speculative prediction")
+    else:
+        print("no time left for symptom prediction, using speculative prediction")
+    return speculative_future.result()
+
 
 @functions_framework.http
 def triage(request):
@@ -42,24 +495,46 @@ def triage(request):
     if request.method != 'POST':
         return ('Method Not Allowed', 405)
 
-    request_json = request.get_json(silent=True) # Get the full JSON body once
+    request_start = time.monotonic()
+    timer = StageTimer()
+    with timer.stage("parse"):
+        request_json = request.get_json(silent=True) # Get the full JSON body once
+    return handle_triage(request_json, timer, request_start)
+
+
+def handle_triage(request_json, timer=None, request_start=None):
+    """
+    Triage one parsed webhook / direct-call body and return (body, status, headers).
+    Shared by the triage() Cloud Function and the long-running server (server.py).
+    """
+    request_start = request_start or time.monotonic()
+    timer = timer or StageTimer()
     print(f"user request {request_json}")
     
-    if not request_json:
+    if not request_json or not isinstance(request_json, dict): # a JSON array or scalar is no request either
         return ('Invalid JSON in request body.', 400, {'Content-Type': 'application/json'}) # Return JSON even for error
 
     user_msg = None
     is_dialogflow_request = False
+    session_id = None
 
-    # Try to extract user_msg from Dialogflow CX format
-    if 'sessionInfo' in request_json and \
-       'parameters' in request_json['sessionInfo'] and \
-       'user_message' in request_json['sessionInfo']['parameters']:
-        user_msg = request_json['sessionInfo']['parameters']['user_message']
-        is_dialogflow_request = True
-    # Fallback for direct testing or non-Dialogflow CX calls
-    elif 'message' in request_json:
-        user_msg = request_json['message']
+    with timer.stage("parse"):
+        # Try to extract user_msg from Dialogflow CX format
+        if 'sessionInfo' in request_json and \
+           'parameters' in request_json['sessionInfo'] and \
+           'user_message' in request_json['sessionInfo']['parameters']:
+            user_msg = request_json['sessionInfo']['parameters']['user_message']
+            session_id = request_json['sessionInfo'].get('session')
+            is_dialogflow_request = True
+        # Fallback for direct testing or non-Dialogflow CX calls
+        elif 'message' in request_json:
+            user_msg = request_json['message']
+            session_id = request_json.get('session_id')
+
+        # Direct calls may pick the pipeline per request, to compare both modes side by side
+        pipeline_mode = PIPELINE_MODE
+        if not is_dialogflow_request and request_json.get('pipeline_mode') in ("two_hop", "single_call"):
+            pipeline_mode = request_json['pipeline_mode']
 
     print(f"extracted user message {user_msg}")
     
@@ -84,78 +559,225 @@ def triage(request):
             return (error_message, 400, {'Content-Type': 'application/json'})
 
 
+    # Dialogflow retries a turn that ran past its webhook timeout: the retry joins the
+    # original run (or gets its stored response) and reuses its patients document
+    key = None
+    if IDEMPOTENT_WEBHOOK:
+        key = turn_key(session_id, request_json.get('detectIntentResponseId') or request_json.get('request_id'), user_msg)
+
+    def handle():
+        if key is None:
+            return _triage_turn(user_msg, session_id, pipeline_mode, is_dialogflow_request, timer, request_start)
+        return TURN_REGISTRY.run(key, lambda: _triage_turn(user_msg, session_id, pipeline_mode, is_dialogflow_request,
+                                                           timer, request_start, doc_id=doc_id_for(key)))
+
+    if admission is None:
+        return handle()
+    with timer.stage("admission"):
+        pre_severity = pre_score(user_msg)
+        try:
+            admission.acquire(pre_severity)
+        except Overloaded as e:
+            print(f"{e} {admission.stats()}")
+            timer.log(session=session_id, triage_severity="deferred", pre_severity=pre_severity,
+                      dialogflow=is_dialogflow_request, status=503)
+            return overloaded_response(e, is_dialogflow_request)
     try:
-        # 1️⃣ extract symptoms with Gemini function-calling
-        prompt = Part.from_text(
-            f"""Extract the key medical symptoms from this free-text (no interpretation):
-            \"\"\"{user_msg}\"\"\".
-            Return a JSON list of max 5 symptoms."""
-        )
-        symptoms_response = GEMINI.generate_content(prompt,
-                                    generation_config={"response_mime_type": "application/json"}
-                                 )
-        symptoms = json.loads(symptoms_response.text)
-        print(f"symptoms are {symptoms}")
+        return handle()
+    finally:
+        admission.release()
+
+
+def overloaded_response(error, is_dialogflow_request):
+    """503 + Retry-After for a shed request; CX gets its usual webhook body with a "deferred" severity."""
+    message = ("We're handling a very high number of requests right now, please try again in a moment. "
+               "If this is an emergency, call emergency services immediately.")
+    headers = {'Content-Type': 'application/json', 'Retry-After': str(error.retry_after)}
+    if not is_dialogflow_request:
+        return json.dumps({"severity": "deferred", "message": message}), 503, headers
+    response = {
+        "fulfillmentResponse": {"messages": [{"text": {"text": [message]}}]},
+        "sessionInfo": {"parameters": {"triage_severity": "deferred", "error_details": str(error)}},
+    }
+    return json.dumps(response), 503, headers
 
 
-        # Ensure symptoms is a list, even if Gemini returns a single string or non-list
-        if not isinstance(symptoms, list):
-            symptoms = [str(symptoms)] # Convert to list of string if not already
+def _triage_turn(user_msg, session_id, pipeline_mode, is_dialogflow_request, timer, request_start, doc_id=None):
+    """Triage one parsed message and build the (body, status, headers) response."""
+    try:
+        # 0️⃣ Red flags first: a matched phrase is an emergency, no model call needed
+        red_flags = []
+        if RED_FLAG_FAST_PATH:
+            with timer.stage("red_flags"):
+                red_flags = RED_FLAG_MATCHER.match(user_msg)
+
+        # What earlier turns of this session established. In two_hop mode this turn's symptoms are
+        # only a delta on the known ones; in every mode the answer never drops below the session's severity.
+        track_session = SESSION_CONTEXT and bool(session_id)
+        use_session = track_session and pipeline_mode == "two_hop"
+        session = EMPTY_CONTEXT
+        if track_session:
+            with timer.stage("session"):
+                session = SESSION_STORE.get(session_id)
+            print(f"session already has symptoms {list(session.symptoms)}, severity {session.severity}")
+        known_symptoms = list(session.symptoms) if use_session else []
+
+        # Local fast path next; only when it isn't confident do we need the endpoint.
+        # Both it and the speculative prediction read the raw message, so they only apply to a first turn.
+        # known_prediction is a (severity, confidence) we already have without calling the endpoint.
+        known_prediction = None
+        knn_neighbours = None
+        if red_flags:
+            print(f"red flags matched {red_flags}, skipping model calls")
+            known_prediction = ("emergent", 1.0)
+        elif pipeline_mode == "two_hop" and not known_symptoms:
+            with timer.stage("local_model"):
+                known_prediction = local_fast_prediction(user_msg)
+            if known_prediction is None:
+                with timer.stage("knn"):
+                    known_prediction, knn_neighbours = knn_predictions([user_msg])[0]
+                if known_prediction is not None:
+                    print(f"kNN severity is {known_prediction[0]} with confidence level: {known_prediction[1]}")
+
+        # Optionally start scoring the raw message right away, in parallel with extraction
+        speculative_future = None
+        if SPECULATIVE_SEVERITY and known_prediction is None and pipeline_mode == "two_hop" \
+                and not known_symptoms and SEVERITY_BREAKER.state != OPEN:
+            speculative_future = _prediction_pool.submit(predict_severity, user_msg)
+
+        # 1️⃣ extract symptoms with Gemini function-calling
+        icd10_code = None
+        degraded = False
+        extraction_failed = False
+        if red_flags:
+            symptoms = list(red_flags) # the matched phrases stand in for extracted symptoms
+        elif pipeline_mode == "single_call":
+            # One structured call returns symptoms, severity and ICD-10 together
+            with timer.stage("extract_and_score"):
+                symptoms, model_severity, model_confidence, icd10_code = triage_single_call(user_msg)
+            known_prediction = (model_severity, model_confidence)
+        elif speculative_future is not None:
+            # The speculative prediction already covers this turn, so a failing or too slow
+            # extraction answers from it instead of erroring out or running past the deadline
+            with timer.stage("extract"):
+                try:
+                    symptoms = extract_symptoms_within_deadline(user_msg, request_start)
+                except Exception as extract_e:
+                    print(f"symptom extraction failed ({extract_e!r}), answering from the speculative prediction")
+                    symptoms = []
+                    extraction_failed = True
+        else:
+            with timer.stage("extract"):
+                symptoms = extract_symptoms(user_msg) # only this turn's message goes to Gemini
+        if use_session:
+            symptoms = merge_symptoms(known_symptoms, symptoms)
+        print(f"symptoms are {symptoms}")
 
         # Handle empty symptom list if Gemini couldn't extract anything meaningful
-        if not symptoms:
+        if not symptoms and not extraction_failed:
             # You might define a "no_symptoms" severity or route for this
             severity = "no_symptoms_found"
             confidence = 0.0
-            dialogflow_message = "I couldn't extract any specific symptoms from your message. Could you please describe them more clearly?"
+            dialogflow_message = NO_SYMPTOMS_MESSAGE
         else:
             # 2️⃣ Severity prediction model
             print(f"before prediction")
-            # prediction = severity_prediction_client.predict(
-            #     endpoint=SEVERITY_ENDPOINT, # Use the correctly formatted endpoint path
-            #     instances=[{"symptoms": ", ".join(symptoms)}],
-            # )
             input_text = ", ".join(symptoms)
             print(f"Input text for model: {input_text}")
-            prediction = severity_prediction_client.predict(
-                endpoint=SEVERITY_ENDPOINT,
-                instances=[{"mime_type": "text/plain","content": input_text}], # This is the most likely correct format for Gemini fine-tune
-            )
+            with timer.stage("predict"):
+                try:
+                    if known_prediction is not None:
+                        severity, confidence = known_prediction
+                    elif extraction_failed:
+                        severity, confidence = speculative_future.result()
+                    elif speculative_future is not None:
+                        severity, confidence = resolve_severity(symptoms, speculative_future, request_start)
+                    else:
+                        severity, confidence = predict_severity_for_symptoms(symptoms)
+                except Exception as severity_e:
+                    # Endpoint failing, too slow or its breaker is open: degrade instead of erroring out
+                    print(f"severity endpoint unavailable ({severity_e}), using offline fallback {SEVERITY_BREAKER.stats()}")
+                    severity, confidence = fallback_severity(user_msg)
+                    degraded = True
             print(f"after prediction")
-            print(f"prediction {prediction}")
-            severity = prediction.predictions[0]["severity"]
-            confidence = prediction.predictions[0]["confidence"]
             print(f"detected severity is {severity} with confidence level: {confidence}")
             
             # 3️⃣ Decide next step and prepare initial dialogflow_message
-            dialogflow_message = "" # Initialize here for scope
-            if severity == "routine":
-                dialogflow_message = "Based on your symptoms, your condition appears routine. You may consider over-the-counter remedies or schedule a regular appointment if symptoms persist."
-            elif severity == "moderate":
-                dialogflow_message = "Your symptoms indicate a moderate concern. It's advisable to consult a healthcare professional within the next 24-48 hours. Would you like assistance finding a clinic?"
-            elif severity == "urgent":
-                dialogflow_message = "Your symptoms suggest an urgent need for care. Please seek medical attention within the next few hours. We can help you find an urgent care clinic or emergency room."
-            elif severity == "emergent":
-                dialogflow_message = "Your symptoms are emergent. Please call emergency services immediately or go to the nearest emergency room."
-            else:
-                # Fallback for unknown severity from your model
-                dialogflow_message = "I couldn't determine the severity of your symptoms. Please clarify or provide more details."
-                severity = "unknown_severity" # Set a specific status for CX
+            severity, dialogflow_message = advice_for_severity(severity)
+
+        # An earlier turn was answered more severely (say a red flag, then "also a runny nose"):
+        # keep answering at that level rather than walking the patient back down. That is a rule,
+        # like a red flag, so it is reported with confidence 1.0; this turn's own estimate is kept
+        # in the record for audit.
+        session_floor = None
+        if track_session:
+            if more_severe(severity, session.severity) != severity:
+                session_floor = session.severity
+                print(f"session was already {session_floor}, answering that instead of {severity}")
+                model_estimate = {"severity": severity, "confidence": float(confidence)}
+                severity, dialogflow_message = advice_for_severity(session_floor)
+                confidence = 1.0
+            SESSION_STORE.update(session_id, symptoms if use_session and symptoms else None, severity, red_flags)
 
 
         # 3️⃣ Save to Firestore
+        from google.cloud.firestore import SERVER_TIMESTAMP
         doc_ref_id = None
+        patient_record = {
+            "msg": user_msg,
+            "symptoms": symptoms,
+            "severity": severity,
+            "confidence": confidence,
+            "status": "queued", # Initial status
+            "timestamp": SERVER_TIMESTAMP,
+            **queue_fields(severity), # severity_rank + arrival_ms, for the coordinators' work queue
+        }
+        if red_flags or session.red_flags:
+            patient_record["red_flags"] = list(dict.fromkeys(session.red_flags + tuple(red_flags)))
+        if session_floor:
+            patient_record["session_floor"] = session_floor
+            patient_record["turn_estimate"] = model_estimate
+        if knn_neighbours:
+            patient_record["knn_neighbours"] = knn_neighbours
+        if icd10_code:
+            patient_record["icd10_code"] = icd10_code
+        if degraded:
+            patient_record["degraded"] = True
         try:
-            # Using add() returns a tuple (update_time, document_reference)
-            update_time, doc_ref = db.collection("patients").add({
-                "msg": user_msg,
-                "symptoms": symptoms,
-                "severity": severity,
-                "confidence": confidence,
-                "status": "queued", # Initial status
-                "timestamp": firestore.SERVER_TIMESTAMP
-            })
-            doc_ref_id = doc_ref.id # Correctly get the ID from the DocumentReference
+            with timer.stage("persist"):
+                db = get_db()
+                new_codes = {}
+                if patient_writer is not None:
+                    # Allocate the id client side and let the background queue do the write;
+                    # a patient's documents and counter increment go in one commit
+                    new_id = doc_id or PATIENT_SHARDS.new_id(db)
+                    writes, new_codes = patient_writes(new_id, patient_record)
+                    try:
+                        patient_writer.enqueue_many(writes)
+                    except Exception as e:
+                        if not already_exists(e):
+                            raise
+                        # committed synchronously on a re-run of this turn: already stored and counted
+                    doc_ref_id = new_id
+                elif doc_id or PATIENT_SHARDS.sharded or patient_codec is not None or severity_counter is not None:
+                    # set() on the turn's own id, so a retried turn can't create a second document;
+                    # sharded and compact writes need the id up front (it picks the shard / names the cold doc),
+                    # and a counted one goes in a batch with its counter increment
+                    new_id = doc_id or PATIENT_SHARDS.new_id(db)
+                    writes, new_codes = patient_writes(new_id, patient_record)
+                    try:
+                        commit_writes(db, writes)
+                    except Exception as e:
+                        if not already_exists(e):
+                            raise
+                        # a re-run of this turn: the earlier commit stored the patient and its count
+                    doc_ref_id = new_id  # only hand out ids of documents that were actually written
+                else:
+                    # Using add() returns a tuple (update_time, document_reference)
+                    update_time, doc_ref = db.collection("patients").add(patient_record)
+                    doc_ref_id = doc_ref.id # Correctly get the ID from the DocumentReference
+                if patient_codec is not None:
+                    patient_codec.mark_stored(new_codes)
         except Exception as firestore_e:
             print(f"Error saving to Firestore: {firestore_e}")
             dialogflow_message += "\n(Note: Could not save details to database.)" # Inform user if critical
@@ -177,27 +799,46 @@ def triage(request):
                     "triage_severity": severity,
                     "triage_confidence": float(confidence),
                     "triage_doc_id": doc_ref_id,
-                    "extracted_symptoms": ", ".join(symptoms)
+                    "extracted_symptoms": ", ".join(symptoms),
+                    "triage_icd10_code": icd10_code,
+                    "triage_degraded": degraded,
+                    "triage_session_floor": session_floor,
+                    "triage_persisted": doc_ref_id is not None
                 }
             }
         }
 
         # For direct testing, return a more concise response
+        with timer.stage("serialize"):
+            if not is_dialogflow_request:
+                body = json.dumps({
+                    "id": doc_ref_id,
+                    "severity": severity,
+                    "confidence": confidence,
+                    "message": dialogflow_message,
+                    "extracted_symptoms": symptoms,
+                    "icd10_code": icd10_code,
+                    "degraded": degraded,
+                    "session_floor": session_floor,
+                    "persisted": doc_ref_id is not None
+                })
+            else:
+                # For Dialogflow CX, return the full webhook response
+                body = json.dumps(response_for_dialogflow)
+
+        timer.log(session=session_id, doc_id=doc_ref_id, triage_severity=severity, pipeline=pipeline_mode,
+                  degraded=degraded, dialogflow=is_dialogflow_request, status=200)
+        headers = {'Content-Type': 'application/json'}
         if not is_dialogflow_request:
-            return json.dumps({
-                "id": doc_ref_id,
-                "severity": severity,
-                "confidence": confidence,
-                "message": dialogflow_message,
-                "extracted_symptoms": symptoms
-            }), 200, {'Content-Type': 'application/json'}
-        else:
-            # For Dialogflow CX, return the full webhook response
-            return json.dumps(response_for_dialogflow), 200, {'Content-Type': 'application/json'}
+            headers['Server-Timing'] = timer.server_timing_header()
+        if doc_ref_id is None:
+            headers[PERSIST_FAILED_HEADER] = "true"  # keeps the response out of TURN_REGISTRY
+        return body, 200, headers
 
 
     except Exception as e:
         print(f"An unexpected error occurred in triage function: {e}")
+        timer.log(session=session_id, triage_severity="error", dialogflow=is_dialogflow_request, status=500)
         # Return a generic error message to Dialogflow CX
         error_message = f"I'm sorry, an unexpected error occurred while processing your request: {e}. Please try again later."
         error_response = {
@@ -218,3 +859,244 @@ def triage(request):
             }
         }
         return json.dumps(error_response), 500, {'Content-Type': 'application/json'}
+
+
+# ---------------------------------------------------------------------------
+# Batch intake: kiosks and nightly backfills post many messages in one call.
+# One structured Gemini call per chunk of messages, one multi-instance predict
+# per chunk of symptom texts and one Firestore batch commit per 500 documents.
+# ---------------------------------------------------------------------------
+BATCH_MAX_MESSAGES = int(os.environ.get("BATCH_MAX_MESSAGES", "500"))
+BATCH_EXTRACTION_CHUNK = int(os.environ.get("BATCH_EXTRACTION_CHUNK", "25"))  # messages per Gemini call
+BATCH_PREDICT_CHUNK = int(os.environ.get("BATCH_PREDICT_CHUNK", "50"))        # instances per predict call
+# RPC deadlines for one chunk: a whole chunk takes longer than the single calls GEMINI_CALLER and
+# SEVERITY_CALLER are tuned on, but a stuck call must still give its thread back
+BATCH_GEMINI_TIMEOUT_SECONDS = float(os.environ.get("BATCH_GEMINI_TIMEOUT_SECONDS", "30"))
+BATCH_PREDICT_TIMEOUT_SECONDS = float(os.environ.get("BATCH_PREDICT_TIMEOUT_SECONDS", "10"))
+
+SYMPTOM_LISTS_SCHEMA = {"type": "array", "items": {"type": "array", "items": {"type": "string"}}}
+
+
+def extract_symptoms_batch(messages):
+    """
+    Extract symptoms for many messages at once. Returns a list aligned with
+    messages holding either the symptom list or the Exception for that item.
+    """
+    results = [None] * len(messages)
+
+    # Cached messages are answered right away; identical misses are only sent once
+    pending = {}  # cache_key -> indexes of messages with that key
+    for i, msg in enumerate(messages):
+        cache_key = normalize_message(msg)
+        cached = EXTRACTION_CACHE.get(cache_key)
+        if cached is not None:
+            results[i] = list(cached)
+        else:
+            pending.setdefault(cache_key, []).append(i)
+
+    keys = list(pending)
+    for start in range(0, len(keys), BATCH_EXTRACTION_CHUNK):
+        chunk = keys[start:start + BATCH_EXTRACTION_CHUNK]
+        numbered = "\n".join(f'{n + 1}. """{messages[pending[key][0]]}"""' for n, key in enumerate(chunk))
+        from vertexai.generative_models import Part
+        prompt = Part.from_text(
+            f"""Extract the key medical symptoms from each of these {len(chunk)} numbered free-text messages (no interpretation):
+            {numbered}
+            Return a JSON list with exactly one entry per message, in the same order.
+            Each entry is a JSON list of max 5 symptoms."""
+        )
+        try:
+            response = generate_content(get_gemini(), prompt, timeout=BATCH_GEMINI_TIMEOUT_SECONDS,
+                                        generation_config={"response_mime_type": "application/json",
+                                                           "response_schema": SYMPTOM_LISTS_SCHEMA}
+                                        )
+            extracted = json.loads(response.text)
+            if not isinstance(extracted, list) or len(extracted) != len(chunk):
+                raise ValueError(f"expected {len(chunk)} symptom lists from Gemini, got {extracted!r:.200}")
+        except Exception as e:
+            print(f"Batch extraction failed for {len(chunk)} messages: {e}")
+            for key in chunk:
+                for i in pending[key]:
+                    results[i] = e
+            continue
+
+        for key, symptoms in zip(chunk, extracted):
+            if not isinstance(symptoms, list):
+                symptoms = [str(symptoms)]
+            EXTRACTION_CACHE.put(key, tuple(symptoms))
+            for i in pending[key]:
+                results[i] = list(symptoms)
+    return results
+
+
+def predict_severity_batch(input_texts):
+    """Score many texts with multi-instance predict calls; returns (severity, confidence) or Exception per text."""
+    results = []
+    for start in range(0, len(input_texts), BATCH_PREDICT_CHUNK):
+        chunk = input_texts[start:start + BATCH_PREDICT_CHUNK]
+        try:
+            prediction = SEVERITY_BREAKER.call(
+                get_prediction_client().predict,
+                endpoint=SEVERITY_ENDPOINT,
+                instances=[{"mime_type": "text/plain", "content": text} for text in chunk],
+                timeout=BATCH_PREDICT_TIMEOUT_SECONDS,
+            )
+            predictions = list(prediction.predictions)
+            if len(predictions) != len(chunk):
+                raise ValueError(f"expected {len(chunk)} predictions, endpoint returned {len(predictions)}")
+            results.extend((p["severity"], p["confidence"]) for p in predictions)
+        except Exception as e:
+            print(f"Batch prediction failed for {len(chunk)} instances: {e}")
+            results.extend([e] * len(chunk))
+    return results
+
+
+def save_patients_batch(records):
+    """Write patient records with batched commits; returns the doc id (or None on failure) per record."""
+    from google.cloud.firestore import SERVER_TIMESTAMP
+    db = get_db()
+    doc_ids = [None] * len(records)
+    # Group whole records into commits of at most FIRESTORE_BATCH_LIMIT writes
+    # (one per record with the full schema, a few more with the compact one)
+    chunks, chunk = [], []  # chunk: [(index, doc id, writes, new_codes)]
+    for i, record in enumerate(records):
+        doc_id = PATIENT_SHARDS.new_id(db)  # id is allocated client side
+        writes, new_codes = patient_writes(doc_id, {**record, "status": "queued", "timestamp": SERVER_TIMESTAMP,
+                                                    **queue_fields(record.get("severity"))})
+        if chunk and sum(len(w) for _, _, w, _ in chunk) + len(writes) > FIRESTORE_BATCH_LIMIT:
+            chunks.append(chunk)
+            chunk = []
+        chunk.append((i, doc_id, writes, new_codes))
+    if chunk:
+        chunks.append(chunk)
+
+    for chunk in chunks:
+        try:
+            commit_writes(db, [write for _, _, writes, _ in chunk for write in writes])
+        except Exception as firestore_e:
+            print(f"Error saving batch to Firestore: {firestore_e}")
+            continue
+        for i, doc_id, _, new_codes in chunk:
+            doc_ids[i] = doc_id
+            if patient_codec is not None:
+                patient_codec.mark_stored(new_codes)
+    return doc_ids
+
+
+@functions_framework.http
+def triage_batch(request):
+    """
+    Triage many messages per HTTP call.
+    Body: {"messages": ["...", "..."]}
+    Returns {"results": [...]} with one entry per message, in order, each carrying
+    either the triage outcome or an "error".
+    """
+    if request.method != 'POST':
+        return ('Method Not Allowed', 405)
+    return handle_triage_batch(request.get_json(silent=True))
+
+
+def handle_triage_batch(request_json):
+    """triage_batch() on an already parsed body; returns (body, status, headers)."""
+    messages = request_json.get("messages") if isinstance(request_json, dict) else None
+    if not isinstance(messages, list) or not messages:
+        return (json.dumps({"error": 'Request body must be {"messages": [...]} with at least one message.'}),
+                400, {'Content-Type': 'application/json'})
+    if len(messages) > BATCH_MAX_MESSAGES:
+        return (json.dumps({"error": f"At most {BATCH_MAX_MESSAGES} messages per batch, got {len(messages)}."}),
+                413, {'Content-Type': 'application/json'})
+    print(f"batch request with {len(messages)} messages")
+
+    try:
+        results = [{"index": i} for i in range(len(messages))]
+        valid = []
+        for i, msg in enumerate(messages):
+            if isinstance(msg, str) and msg.strip():
+                valid.append(i)
+            else:
+                results[i]["error"] = "Message must be a non-empty string."
+
+        # 0️⃣ red-flag emergencies skip extraction and prediction altogether
+        outcomes = {}  # index -> (symptoms, severity, confidence)
+        if RED_FLAG_FAST_PATH:
+            for i in valid:
+                red_flags = RED_FLAG_MATCHER.match(messages[i])
+                if red_flags:
+                    outcomes[i] = (red_flags, "emergent", 1.0)
+            valid = [i for i in valid if i not in outcomes]
+
+        # 1️⃣ extract symptoms for every other message
+        needs_endpoint = []
+        for i, symptoms in zip(valid, extract_symptoms_batch([messages[i] for i in valid])):
+            if isinstance(symptoms, Exception):
+                results[i]["error"] = f"Symptom extraction failed: {symptoms}"
+            elif not symptoms:
+                outcomes[i] = (symptoms, "no_symptoms_found", 0.0)
+            else:
+                local_prediction = local_fast_prediction(messages[i])
+                if local_prediction is not None:
+                    outcomes[i] = (symptoms, *local_prediction)
+                else:
+                    outcomes[i] = (symptoms, None, None)
+                    needs_endpoint.append(i)
+
+        # then one vectorized kNN vote over everything the local model wasn't sure about
+        knn_results = knn_predictions([messages[i] for i in needs_endpoint]) if KNN_FAST_PATH else []
+        for i, (knn_prediction, _) in zip(list(needs_endpoint), knn_results):
+            if knn_prediction is not None:
+                outcomes[i] = (outcomes[i][0], *knn_prediction)
+                needs_endpoint.remove(i)
+
+        # 2️⃣ one multi-instance severity prediction for everything the local model wasn't sure about
+        # Cached symptom sets are answered locally and each distinct set is only scored once
+        symptom_sets = {i: symptom_set_key(outcomes[i][0]) for i in needs_endpoint}
+        scored = {}
+        for symptom_set in dict.fromkeys(symptom_sets.values()):
+            cached = SEVERITY_CACHE.get((SEVERITY_ENDPOINT, symptom_set))
+            if cached is not None:
+                scored[symptom_set] = cached
+        to_score = [symptom_set for symptom_set in dict.fromkeys(symptom_sets.values()) if symptom_set not in scored]
+        for symptom_set, prediction in zip(to_score, predict_severity_batch([", ".join(ss) for ss in to_score])):
+            scored[symptom_set] = prediction
+            if not isinstance(prediction, Exception):
+                SEVERITY_CACHE.put((SEVERITY_ENDPOINT, symptom_set), prediction)
+
+        for i in needs_endpoint:
+            prediction = scored[symptom_sets[i]]
+            if isinstance(prediction, Exception):
+                # Endpoint down or breaker open: offline fallback, flagged as degraded
+                outcomes[i] = (outcomes[i][0], *fallback_severity(messages[i]))
+                results[i]["degraded"] = True
+            else:
+                outcomes[i] = (outcomes[i][0], *prediction)
+
+        # 3️⃣ Save everything that was triaged with batched commits
+        order = sorted(outcomes)
+        records = []
+        for i in order:
+            symptoms, severity, confidence = outcomes[i]
+            if severity == "no_symptoms_found":
+                message = NO_SYMPTOMS_MESSAGE
+            else:
+                severity, message = advice_for_severity(severity)
+            outcomes[i] = (symptoms, severity, confidence)
+            results[i].update({"severity": severity, "confidence": confidence,
+                               "message": message, "extracted_symptoms": symptoms})
+            records.append({"msg": messages[i], "symptoms": symptoms,
+                            "severity": severity, "confidence": confidence})
+            if results[i].get("degraded"):
+                records[-1]["degraded"] = True
+
+        for i, doc_id in zip(order, save_patients_batch(records)):
+            results[i]["id"] = doc_id
+            if doc_id is None:
+                results[i]["message"] += "\n(Note: Could not save details to database.)"
+
+        failed = sum(1 for r in results if "error" in r)
+        print(f"batch done: {len(results) - failed} triaged, {failed} failed")
+        return json.dumps({"results": results, "succeeded": len(results) - failed, "failed": failed}), \
+            200, {'Content-Type': 'application/json'}
+
+    except Exception as e:
+        print(f"An unexpected error occurred in triage_batch function: {e}")
+        return json.dumps({"error": str(e)}), 500, {'Content-Type': 'application/json'}
@@ -0,0 +1,214 @@
+"""
+"Next patient to call" for coordinators.
+
+Triage writes carry severity_rank (emergent 0 .. routine 3, anything else after
+them) and arrival_ms, the same severity-then-arrival order as the webapp's
+PriorityQueue comparator. PatientWorkQueue keeps the queued patients in an
+indexed heap fed by a Firestore snapshot listener on status == "queued", so
+reading the top of the queue never scans the collection, and claims it with an
+optimistic precondition so two coordinators can't claim the same patient.
+"""
+import heapq
+import threading
+import time
+
+from admission import SEVERITY_RANK
+
+UNRANKED = len(SEVERITY_RANK)  # no_symptoms_found, unknown_severity, ...
+
+
+def severity_rank(severity):
+    return SEVERITY_RANK.get(severity, UNRANKED)
+
+
+def queue_fields(severity, arrival_ms=None):
+    """Fields every patients write adds so the queue can be ordered without parsing strings."""
+    return {"severity_rank": severity_rank(severity),
+            "arrival_ms": int(arrival_ms if arrival_ms is not None else time.time() * 1000)}
+
+
+def queue_key(data):
+    """(severity_rank, arrival_ms) of a patients document; older documents fall back to severity / timestamp."""
+    rank = data.get("severity_rank")
+    if rank is None:
+        rank = severity_rank(data.get("severity"))
+    arrival = data.get("arrival_ms")
+    if arrival is None:
+        timestamp = data.get("timestamp")
+        arrival = int(timestamp.timestamp() * 1000) if hasattr(timestamp, "timestamp") else 0
+    return rank, arrival
+
+
+class IndexedHeap:
+    """Binary min-heap of (key, item_id) with an id -> position index: push/update/remove/pop in O(log n)."""
+
+    def __init__(self):
+        self._heap = []  # [(key, item_id)]
+        self._pos = {}   # item_id -> index in _heap
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __contains__(self, item_id):
+        return item_id in self._pos
+
+    def push(self, item_id, key):
+        """Insert item_id, or move it if it is already in the heap with another key."""
+        i = self._pos.get(item_id)
+        if i is not None:
+            old_key = self._heap[i][0]
+            self._heap[i] = (key, item_id)
+            self._sift_up(i) if key < old_key else self._sift_down(i)
+            return
+        self._heap.append((key, item_id))
+        self._pos[item_id] = len(self._heap) - 1
+        self._sift_up(len(self._heap) - 1)
+
+    def remove(self, item_id):
+        i = self._pos.pop(item_id, None)
+        if i is None:
+            return False
+        last = self._heap.pop()
+        if i < len(self._heap):
+            self._heap[i] = last
+            self._pos[last[1]] = i
+            self._sift_up(i)
+            self._sift_down(self._pos[last[1]])
+        return True
+
+    def peek(self):
+        return self._heap[0] if self._heap else None
+
+    def pop(self):
+        if not self._heap:
+            return None
+        top = self._heap[0]
+        self.remove(top[1])
+        return top
+
+    def smallest(self, k):
+        """The k smallest entries in order, without modifying the heap: O(k log k)."""
+        result = []
+        frontier = [(self._heap[0], 0)] if self._heap else []
+        while frontier and len(result) < k:
+            entry, i = heapq.heappop(frontier)
+            result.append(entry)
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(self._heap):
+                    heapq.heappush(frontier, (self._heap[child], child))
+        return result
+
+    def _swap(self, i, j):
+        self._heap[i], self._heap[j] = self._heap[j], self._heap[i]
+        self._pos[self._heap[i][1]] = i
+        self._pos[self._heap[j][1]] = j
+
+    def _sift_up(self, i):
+        while i > 0:
+            parent = (i - 1) >> 1
+            if self._heap[i] >= self._heap[parent]:
+                break
+            self._swap(i, parent)
+            i = parent
+
+    def _sift_down(self, i):
+        n = len(self._heap)
+        while True:
+            smallest = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < n and self._heap[child] < self._heap[smallest]:
+                    smallest = child
+            if smallest == i:
+                return
+            self._swap(i, smallest)
+            i = smallest
+
+
+class PatientWorkQueue:
+    """
+    In-memory mirror of the queued patients, ordered by severity then arrival.
+
+    start() attaches a snapshot listener to patients where status == "queued":
+    the first snapshot loads the current queue, later ones apply only the
+    changed documents. top(k) reads the head of the heap; claim() takes the
+    best patient by flipping its status to "claimed" with a last-update-time
+    precondition, so a concurrent claim (or edit) makes it move on to the next one.
+    """
+
+    def __init__(self, get_db, collection="patients", collection_group=False):
+        self._get_db = get_db
+        self.collection = collection
+        self.collection_group = collection_group  # True for the sharded layout (sharding.py)
+        self._heap = IndexedHeap()
+        self._docs = {}  # doc id -> (data, update_time, reference)
+        self._lock = threading.Lock()
+        self._watch = None
+        self.ready = threading.Event()  # set once the first snapshot has been applied
+
+    def start(self):
+        db = self._get_db()
+        source = db.collection_group(self.collection) if self.collection_group else db.collection(self.collection)
+        query = source.where("status", "==", "queued")
+        self._watch = query.on_snapshot(self._on_snapshot)
+        return self
+
+    def stop(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+
+    def _on_snapshot(self, snapshots, changes, read_time):
+        with self._lock:
+            for change in changes:
+                doc = change.document
+                if change.type.name == "REMOVED":
+                    self._heap.remove(doc.id)
+                    self._docs.pop(doc.id, None)
+                else:  # ADDED / MODIFIED
+                    data = doc.to_dict() or {}
+                    self._docs[doc.id] = (data, doc.update_time, doc.reference)
+                    self._heap.push(doc.id, queue_key(data))
+        self.ready.set()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def top(self, k=10):
+        """The k patients to call next, as [{"id": ..., **fields}], without claiming them."""
+        with self._lock:
+            return [{"id": doc_id, **self._docs[doc_id][0]} for _, doc_id in self._heap.smallest(k)]
+
+    def claim(self, coordinator):
+        """Claim the next patient for coordinator; returns its document (with "id") or None if the queue is empty."""
+        from google.api_core.exceptions import FailedPrecondition, NotFound
+        from google.cloud.firestore import SERVER_TIMESTAMP
+        db = self._get_db()
+        while True:
+            with self._lock:
+                top = self._heap.pop()
+                if top is None:
+                    return None
+                doc_id = top[1]
+                data, update_time, reference = self._docs.pop(doc_id)
+            try:
+                reference.update(
+                    {"status": "claimed", "claimed_by": coordinator, "claimed_at": SERVER_TIMESTAMP},
+                    option=db.write_option(last_update_time=update_time),
+                )
+            except (FailedPrecondition, NotFound):
+                # Claimed or changed elsewhere since our snapshot; the listener will re-add it if still queued
+                continue
+            except Exception:
+                # Nothing was written (timeout, unavailable, ...): the patient is still queued, so put
+                # it back unless the listener already brought in a newer version meanwhile
+                with self._lock:
+                    if doc_id not in self._docs:
+                        self._docs[doc_id] = (data, update_time, reference)
+                        self._heap.push(doc_id, top[0])
+                raise
+            return {"id": doc_id, **data, "status": "claimed", "claimed_by": coordinator}
+
+    def stats(self):
+        with self._lock:
+            head = self._heap.peek()
+        return {"queued": len(self), "ready": self.ready.is_set(), "head": head[1] if head else None}
@@ -0,0 +1,292 @@
+import atexit
+import datetime
+import json
+import os
+import queue
+import signal
+import threading
+import time
+
+FIRESTORE_BATCH_LIMIT = 500  # Firestore caps a WriteBatch at 500 writes
+
+
+class Merge(dict):
+    """Write data merged into the document (set(..., merge=True)) instead of replacing it, e.g. counter Increment()s."""
+
+
+class Create(dict):
+    """Write data for a document that must not exist yet (create()): the whole commit fails with AlreadyExists if it does."""
+
+
+def stage_write(batch, ref, data):
+    """Add one write to a WriteBatch, as a create(), a merge or a plain set() depending on the type of data."""
+    if isinstance(data, Create):
+        batch.create(ref, data)
+    else:
+        batch.set(ref, data, merge=isinstance(data, Merge))
+
+
+def already_exists(error):
+    """True for the error a commit fails with when one of its Create documents was already stored."""
+    from google.api_core.exceptions import AlreadyExists
+    return isinstance(error, AlreadyExists)
+
+
+class WriteBehindQueue:
+    """
+    Takes Firestore writes off the request path.
+
+    Callers allocate the document id themselves (collection.document()), hand
+    the write over with enqueue() and answer the user right away. A background
+    thread groups queued writes into WriteBatch commits, retrying failed
+    commits with exponential backoff. Writes handed over together with
+    enqueue_many() always land in the same commit, so they are stored (or
+    retried, or spilled) all or none. A group whose Create document already
+    exists was stored by an earlier run and is dropped, the rest of its
+    batch is committed group by group.
+
+    Whenever the queue can't be trusted to commit a write, enqueue() commits it
+    synchronously instead, so the caller only acknowledges writes that are
+    either queued on a healthy writer or already stored (a failed synchronous
+    commit raises): while the last background commit failed, once max_pending
+    groups of writes are waiting, and while draining.
+
+    spill_path is optional and must be durable storage shared across instances
+    (a mounted volume, not /tmp: on Cloud Functions / Cloud Run that is
+    in-memory and private to the instance). With it, writes that exhaust their
+    retries or are left over when the process drains are appended there as
+    JSONL, one line per group, and replayed by replay_spill() on a later start.
+    Without it, failed batches are re-queued, and leftovers at drain get one
+    last synchronous commit; anything that still fails is logged with its
+    document ids.
+    """
+
+    def __init__(self, get_db, max_batch_size=FIRESTORE_BATCH_LIMIT, flush_interval_seconds=0.05,
+                 max_retries=5, retry_backoff_seconds=0.2, spill_path=None, max_pending=2000):
+        self._get_db = get_db  # called from the worker, so the Firestore client can stay lazy
+        self.max_batch_size = min(max_batch_size, FIRESTORE_BATCH_LIMIT)
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_retries = max_retries
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.spill_path = spill_path
+        self.max_pending = max_pending
+        self._pending = queue.Queue()  # groups: [(collection, doc id, data, enqueued_at)]
+        self._carry = None  # group collected but left for the next batch, which it didn't fit in; worker only
+        self._draining = threading.Event()
+        self._healthy = threading.Event()  # cleared while background commits are failing
+        self._healthy.set()
+        self._spill_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.committed = 0
+        self.committed_sync = 0
+        self.spilled = 0
+        self._worker = threading.Thread(target=self._run, name="firestore-write-behind", daemon=True)
+        self._worker.start()
+
+    def enqueue(self, collection, doc_id, data):
+        """
+        Queue a set() of data on collection/doc_id (a merge when data is a Merge, a create() when
+        it is a Create). SERVER_TIMESTAMP and, in a Merge, Increment values are allowed.
+        Raises when the write had to be committed synchronously and that commit failed.
+        """
+        self.enqueue_many([(collection, doc_id, data)])
+
+    def enqueue_many(self, writes):
+        """Queue (collection, doc id, data) writes that must be committed together, like enqueue()."""
+        enqueued_at = datetime.datetime.now(datetime.timezone.utc)
+        group = [(collection, doc_id, data, enqueued_at) for collection, doc_id, data in writes]
+        if len(group) > FIRESTORE_BATCH_LIMIT:
+            raise ValueError(f"{len(group)} writes can't be committed together (limit {FIRESTORE_BATCH_LIMIT})")
+        if self._draining.is_set() and self.spill_path:
+            self._spill([group])  # too late to commit, keep it for the next instance
+        elif self._draining.is_set() or not self._healthy.is_set() or self._pending.qsize() >= self.max_pending:
+            self._commit(group)  # the queue can't vouch for these writes: store them before the caller answers
+            self._healthy.set()
+            with self._stats_lock:
+                self.committed_sync += len(group)
+        else:
+            self._pending.put(group)
+
+    def pending(self):
+        return self._pending.qsize()
+
+    def drain(self, timeout_seconds=5.0):
+        """Stop queueing writes, flush what is queued and spill (or commit) whatever is left after the timeout."""
+        if self._draining.is_set():
+            return
+        self._draining.set()
+        self._worker.join(timeout=timeout_seconds)
+        leftovers = []
+        while True:
+            try:
+                leftovers.append(self._pending.get_nowait())
+            except queue.Empty:
+                break
+        if leftovers and self.spill_path:
+            self._spill(leftovers)
+        elif leftovers:
+            self._commit_leftovers(leftovers)
+        print(f"write-behind drained: {self.committed} committed, {self.committed_sync} committed synchronously, "
+              f"{self.spilled} spilled")
+
+    def _commit_leftovers(self, groups):
+        for group in groups:
+            try:
+                self._commit(group)
+                with self._stats_lock:
+                    self.committed += len(group)
+            except Exception as e:
+                print(json.dumps({"severity": "ERROR", "message": "write-behind lost writes at shutdown",
+                                  "error": str(e), "docs": [f"{c}/{d}" for c, d, _, _ in group]}))
+
+    def replay_spill(self):
+        """
+        Re-queue writes spilled by a previous process. Sets on a fixed id are safe to repeat;
+        an Increment is applied again if its batch did commit before it was spilled.
+        """
+        if not self.spill_path:
+            return 0
+        with self._spill_lock:
+            if not os.path.exists(self.spill_path):
+                return 0
+            replay_path = f"{self.spill_path}.replay"
+            os.replace(self.spill_path, replay_path)
+        from google.cloud.firestore import Increment
+        replayed = 0
+        with open(replay_path, encoding="utf-8") as fin:
+            for raw in fin:
+                if not raw.strip():
+                    continue
+                record = json.loads(raw)
+                enqueued_at = datetime.datetime.fromisoformat(record["enqueued_at"])
+                group = []
+                for write in record.get("writes", [record]):  # one write per line in older spill files
+                    data = {key: enqueued_at if key in write["server_timestamps"] else value
+                            for key, value in write["data"].items()}
+                    data.update({key: Increment(value) for key, value in write.get("increments", {}).items()})
+                    if write.get("merge"):
+                        data = Merge(data)
+                    elif write.get("create"):
+                        data = Create(data)
+                    group.append((write["collection"], write["doc_id"], data, enqueued_at))
+                self._pending.put(group)
+                replayed += len(group)
+        os.remove(replay_path)
+        print(f"write-behind replayed {replayed} spilled writes")
+        return replayed
+
+    def _collect(self):
+        """Whole groups, up to max_batch_size writes (a bigger group goes alone); never splits a group."""
+        if self._carry is not None:
+            groups, self._carry = [self._carry], None
+        else:
+            try:
+                groups = [self._pending.get(timeout=self.flush_interval_seconds)]
+            except queue.Empty:
+                return []
+        size = len(groups[0])
+        deadline = time.monotonic() + self.flush_interval_seconds
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                group = self._pending.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if size + len(group) > self.max_batch_size:
+                self._carry = group
+                break
+            groups.append(group)
+            size += len(group)
+        return groups
+
+    def _commit(self, items):
+        db = self._get_db()
+        batch = db.batch()
+        for collection, doc_id, data, _ in items:
+            stage_write(batch, db.collection(collection).document(doc_id), data)
+        batch.commit()
+
+    def _commit_groups_separately(self, groups):
+        """After a batch failed on an existing Create: commit each group on its own, dropping those already stored."""
+        for group in groups:
+            try:
+                self._commit(group)
+                with self._stats_lock:
+                    self.committed += len(group)
+            except Exception as e:
+                if already_exists(e):
+                    print(f"write-behind dropped {[f'{c}/{d}' for c, d, _, _ in group]}: already stored")
+                else:
+                    self._pending.put(group)  # retried with the next batches
+
+    def _run(self):
+        while not (self._draining.is_set() and self._pending.empty() and self._carry is None):
+            groups = self._collect()
+            if not groups:
+                continue
+            items = [item for group in groups for item in group]
+            for attempt in range(self.max_retries + 1):
+                try:
+                    self._commit(items)
+                    with self._stats_lock:
+                        self.committed += len(items)
+                    self._healthy.set()
+                    break
+                except Exception as e:
+                    if already_exists(e):
+                        self._commit_groups_separately(groups)
+                        break
+                    print(f"write-behind commit of {len(items)} docs failed (attempt {attempt + 1}): {e}")
+                    self._healthy.clear()  # new writes commit synchronously until a batch goes through
+                    if attempt == self.max_retries or self._draining.is_set():
+                        if self.spill_path:
+                            self._spill(groups)
+                        else:
+                            for group in groups:
+                                self._pending.put(group)  # nowhere durable to put them: keep retrying
+                            time.sleep(self.retry_backoff_seconds * (2 ** attempt))
+                        break
+                    time.sleep(self.retry_backoff_seconds * (2 ** attempt))
+
+    def _spill(self, groups):
+        from google.cloud.firestore import SERVER_TIMESTAMP, Increment
+        with self._spill_lock, open(self.spill_path, "a", encoding="utf-8") as fout:
+            for group in groups:
+                writes = []
+                for collection, doc_id, data, _ in group:
+                    server_timestamps = [key for key, value in data.items() if value is SERVER_TIMESTAMP]
+                    increments = {key: value.value for key, value in data.items() if isinstance(value, Increment)}
+                    writes.append({
+                        "collection": collection,
+                        "doc_id": doc_id,
+                        "data": {key: None if key in server_timestamps else value
+                                 for key, value in data.items() if key not in increments},
+                        "server_timestamps": server_timestamps,
+                        "increments": increments,
+                        "merge": isinstance(data, Merge),
+                        "create": isinstance(data, Create),
+                    })
+                fout.write(json.dumps({"writes": writes, "enqueued_at": group[0][3].isoformat()},
+                                      ensure_ascii=False, default=str) + "\n")
+            fout.flush()
+            os.fsync(fout.fileno())
+        with self._stats_lock:
+            self.spilled += sum(len(group) for group in groups)
+
+    def install_shutdown_hooks(self, timeout_seconds=5.0):
+        """Drain on interpreter exit and on SIGTERM (Cloud Run / GKE scale-down)."""
+        atexit.register(self.drain, timeout_seconds)
+        if threading.current_thread() is not threading.main_thread():
+            return
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def on_sigterm(signum, frame):
+            self.drain(timeout_seconds)
+            if callable(previous):
+                previous(signum, frame)
+            elif previous == signal.SIG_DFL:
+                raise SystemExit(0)
+
+        signal.signal(signal.SIGTERM, on_sigterm)
@@ -0,0 +1,40 @@
+import importlib
+import sys
+from pathlib import Path
+from types import ModuleType
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "cloud_function"))
+sys.path.insert(0, str(ROOT / "utils"))
+
+
+def stand_in(name, **attrs):
+    """Register a bare module with attrs when the Google library name isn't installed; the real one wins."""
+    try:
+        importlib.import_module(name)
+        return
+    except ImportError:
+        pass
+    parts = name.split(".")
+    for i in range(1, len(parts)):
+        parent = ".".join(parts[:i])
+        if parent not in sys.modules:
+            sys.modules[parent] = ModuleType(parent)
+            sys.modules[parent].__path__ = []
+    module = ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    setattr(sys.modules[".".join(parts[:-1])], parts[-1], module)
+
+
+class Increment:
+    def __init__(self, value):
+        self.value = value
+
+
+# What the modules under test import lazily from google-api-core / google-cloud-firestore
+stand_in("google.api_core.exceptions",
+         AlreadyExists=type("AlreadyExists", (Exception,), {}),
+         FailedPrecondition=type("FailedPrecondition", (Exception,), {}),
+         NotFound=type("NotFound", (Exception,), {}))
+stand_in("google.cloud.firestore", SERVER_TIMESTAMP=object(), Increment=Increment)
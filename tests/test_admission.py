@@ -0,0 +1,78 @@
+import threading
+import time
+
+import pytest
+
+from admission import AdmissionController, Overloaded
+
+NO_BUDGETS = {"emergent": None, "urgent": None, "moderate": None, "routine": None}
+
+
+def wait_for_waiting(controller, count):
+    deadline = time.monotonic() + 5
+    while controller.stats()["waiting"] != count:
+        assert time.monotonic() < deadline, controller.stats()
+        time.sleep(0.001)
+
+
+def start_waiter(controller, severity, outcomes):
+    def run():
+        try:
+            controller.run(severity, lambda: outcomes.append(severity))
+        except Overloaded:
+            outcomes.append(f"shed {severity}")
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def test_freed_slots_go_to_the_most_severe_then_oldest_waiter():
+    controller = AdmissionController(max_concurrent=1, max_queue=10, latency_budgets=NO_BUDGETS)
+    controller.acquire("routine")
+    outcomes, threads = [], []
+    for severity in ("routine", "urgent", "moderate", "emergent", "urgent"):
+        threads.append(start_waiter(controller, severity, outcomes))
+        wait_for_waiting(controller, len(threads))
+    controller.release()
+    for thread in threads:
+        thread.join(5)
+    assert outcomes == ["emergent", "urgent", "urgent", "moderate", "routine"]
+    assert controller.stats()["active"] == 0
+
+
+def test_full_queue_displaces_a_less_urgent_waiter_or_sheds_the_newcomer():
+    controller = AdmissionController(max_concurrent=1, max_queue=1, latency_budgets=NO_BUDGETS)
+    controller.acquire("urgent")
+    outcomes = []
+    routine = start_waiter(controller, "routine", outcomes)
+    wait_for_waiting(controller, 1)
+    emergent = start_waiter(controller, "emergent", outcomes)
+    routine.join(5)
+    assert outcomes == ["shed routine"]
+    wait_for_waiting(controller, 1)
+    with pytest.raises(Overloaded):
+        controller.acquire("moderate")
+    controller.release()
+    emergent.join(5)
+    assert outcomes == ["shed routine", "emergent"]
+    assert controller.stats()["shed"] == {"emergent": 0, "urgent": 0, "moderate": 1, "routine": 1}
+
+
+def test_waiter_is_shed_when_its_latency_budget_runs_out():
+    controller = AdmissionController(max_concurrent=1, max_queue=10, latency_budgets={**NO_BUDGETS, "routine": 0.05})
+    controller.acquire("urgent")
+    started = time.monotonic()
+    with pytest.raises(Overloaded):
+        controller.acquire("routine")
+    assert time.monotonic() - started >= 0.05
+    assert controller.stats()["waiting"] == 0
+    assert controller.stats()["shed"]["routine"] == 1
+
+
+def test_zero_queue_sheds_at_once_when_all_slots_are_busy():
+    controller = AdmissionController(max_concurrent=1, max_queue=0, latency_budgets=NO_BUDGETS)
+    controller.acquire("routine")
+    with pytest.raises(Overloaded):
+        controller.acquire("emergent")
+    controller.release()
+    assert controller.run("emergent", lambda: "ran") == "ran"
@@ -0,0 +1,39 @@
+import json
+
+import pytest
+
+import dataset_converter
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(dataset_converter, "READ_CHUNK_CHARS", 8)
+
+
+def values(tmp_path, text):
+    path = tmp_path / "data.jsonl"
+    path.write_text(text, encoding="utf-8")
+    return list(dataset_converter.iter_json_values(path))
+
+
+def test_reads_jsonl_and_pretty_printed_values_across_chunks(tmp_path, small_chunks):
+    records = [{"text_input": "chest pain", "output_label": "emergent"}, {"contents": [1, 2, {"x": True}]}]
+    assert values(tmp_path, "\n".join(json.dumps(r) for r in records) + "\n") == records
+    assert values(tmp_path, json.dumps(records, indent=2)) == [records]
+
+
+def test_malformed_record_fails_at_its_offset_without_reading_on(tmp_path, small_chunks, monkeypatch):
+    text = '{"a": 1}\n{"b": nope}\n' + '{"c": 3}\n' * 1000
+    reads = []
+    original = dataset_converter.json.JSONDecoder.raw_decode
+    monkeypatch.setattr(dataset_converter.json.JSONDecoder, "raw_decode",
+                        lambda self, s, idx=0: reads.append(len(s)) or original(self, s, idx))
+    with pytest.raises(ValueError, match="character 15"):
+        values(tmp_path, text)
+    assert max(reads) < 100
+
+
+def test_value_longer_than_the_cap_is_rejected(tmp_path, small_chunks, monkeypatch):
+    monkeypatch.setattr(dataset_converter, "MAX_RECORD_CHARS", 64)
+    with pytest.raises(ValueError, match="character 6: Unterminated string"):
+        values(tmp_path, '{"a": "' + "x" * 200 + '"}')
@@ -0,0 +1,64 @@
+import threading
+
+from idempotency import TurnRegistry, doc_id_for, turn_key
+
+
+def test_turn_key_prefers_the_turn_id_and_needs_a_session():
+    assert turn_key("s1", "r1", "cough") == ("s1", "turn", "r1")
+    assert turn_key("s1", None, "  Cough ") == turn_key("s1", None, "cough")
+    assert turn_key("s1", None, "cough") != turn_key("s2", None, "cough")
+    assert turn_key(None, "r1", "cough") is None
+
+
+def test_numeric_ids_give_the_same_key_and_doc_id_as_strings():
+    assert turn_key(42, 7) == turn_key("42", "7") == ("42", "turn", "7")
+    assert doc_id_for(turn_key("s", 7)) == doc_id_for(turn_key("s", "7"))
+    assert doc_id_for(turn_key(42, None, "cough")) == doc_id_for(turn_key("42", None, "cough"))
+
+
+def test_doc_id_is_deterministic_and_per_turn():
+    doc_id = doc_id_for(("s1", "turn", "r1"))
+    assert len(doc_id) == 20
+    assert doc_id == doc_id_for(("s1", "turn", "r1"))
+    assert doc_id != doc_id_for(("s1", "turn", "r2"))
+
+
+def test_a_stored_turn_is_replayed_without_running_again():
+    registry = TurnRegistry()
+    calls = []
+    assert registry.run(("s", "turn", "1"), lambda: calls.append(1) or "answer") == "answer"
+    assert registry.run(("s", "turn", "1"), lambda: calls.append(1) or "other") == "answer"
+    assert calls == [1]
+    assert registry.stats()["replayed"] == 1
+
+
+def test_results_rejected_by_should_store_run_again():
+    registry = TurnRegistry(should_store=lambda result: result != "failed")
+    results = iter(["failed", "answer"])
+    assert registry.run("key", lambda: next(results)) == "failed"
+    assert registry.run("key", lambda: next(results)) == "answer"
+    assert registry.run("key", lambda: "never called") == "answer"
+
+
+def test_concurrent_retries_share_one_run():
+    registry = TurnRegistry()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def handler():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "answer"
+
+    results = []
+    first = threading.Thread(target=lambda: results.append(registry.run("key", handler)))
+    first.start()
+    started.wait(5)
+    retry = threading.Thread(target=lambda: results.append(registry.run("key", handler)))
+    retry.start()
+    release.set()
+    first.join(5)
+    retry.join(5)
+    assert results == ["answer", "answer"]
+    assert calls == [1]
@@ -0,0 +1,28 @@
+import numpy as np
+
+from knn_severity import KNNSeverityRetriever, embed, load_knn_retriever
+
+TEXTS = ["slight sniffle and a cough", "mild sore throat", "crushing chest pain", "chest pain and sweating"]
+LABELS = ["routine", "routine", "emergent", "emergent"]
+
+
+def test_uncalibrated_index_never_skips_the_endpoint():
+    retriever = KNNSeverityRetriever(embed(TEXTS, 256), TEXTS, LABELS, k=2)
+    for prediction, neighbours in retriever.confident_batch(["a slight sniffle and a cough"]):
+        assert prediction is None
+        assert neighbours[0]["text"] == "slight sniffle and a cough"
+
+
+def test_fast_path_refuses_when_a_more_severe_label_has_votes():
+    retriever = KNNSeverityRetriever(embed(TEXTS, 256), TEXTS, LABELS, k=2, thresholds=[0.5, 0.5, 0.5, 0.5])
+    assert retriever.fast_path(np.array([0.9, 0.0, 0.0, 0.1]), 0.9) is None
+    assert retriever.fast_path(np.array([0.0, 0.0, 0.1, 0.9]), 0.9) == ("emergent", 0.9)
+    assert retriever.fast_path(np.array([1.0, 0.0, 0.0, 0.0]), 0.2) is None  # nearest neighbour too far
+
+
+def test_shipped_index_only_answers_with_calibrated_labels():
+    retriever = load_knn_retriever()
+    assert retriever is not None
+    for prediction, _ in retriever.confident_batch(["A child has a persistent cough and difficulty breathing.",
+                                                    "My ankle is swollen and discoloured after a bad twist."]):
+        assert prediction is None
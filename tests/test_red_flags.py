@@ -0,0 +1,40 @@
+import pytest
+
+from red_flags import NOT_RED_FLAGS, RedFlagMatcher
+
+MATCHER = RedFlagMatcher()
+
+
+@pytest.mark.parametrize("message", NOT_RED_FLAGS)
+def test_denials_history_and_idioms_do_not_short_circuit(message):
+    assert MATCHER.match(message) == []
+
+
+@pytest.mark.parametrize("message, phrase", [
+    ("Crushing chest pain, I had dinner an hour ago", "crushing chest pain"),
+    ("I think I'm having a stroke, my face is numb", "having a stroke"),
+    ("My son is choking on food", "choking on food"),
+    ("I feel suicidal tonight", "feel suicidal"),
+    ("I CAN’T BREATHE", "cant breathe"),
+    ("Je n'arrive pas à respirer", "je narrive pas a respirer"),
+    ("I think I'm having a heart attack", "having a heart attack"),
+    ("Mon père fait un AVC, il ne parle plus", "fait un avc"),
+    ("My son is having a seizure", "having a seizure"),
+    ("She just passed out in the kitchen", "just passed out"),
+    ("He took an overdose of sleeping pills", "took an overdose"),
+])
+def test_acute_phrases_still_match(message, phrase):
+    assert phrase in MATCHER.match(message)
+
+
+@pytest.mark.parametrize("message", [
+    "I need a refill of my seizure medication",
+    "Can I overdose on vitamin C?",
+    "My dad passed out last week and is fine now",
+    "Mon grand-père a fait un AVC il y a 3 ans",
+    "J'ai une paralysie soudaine du visage depuis 2 ans",
+    "I cant breathe through my nose",
+    "I am scared I might get a heart attack someday",
+])
+def test_condition_names_history_and_qualifiers_do_not_short_circuit(message):
+    assert MATCHER.match(message) == []
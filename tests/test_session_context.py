@@ -0,0 +1,22 @@
+from session_context import EMPTY_CONTEXT, SessionContextStore, more_severe
+
+
+def test_severity_never_goes_down_within_a_session():
+    store = SessionContextStore()
+    store.update("s1", ["crushing chest pain"], "emergent", ["crushing chest pain"])
+    context = store.update("s1", ["crushing chest pain", "runny nose"], "routine")
+    assert context.severity == "emergent"
+    assert context.red_flags == ("crushing chest pain",)
+    assert context.symptoms == ("crushing chest pain", "runny nose")
+    assert store.get("s1") == context
+
+
+def test_unranked_severities_do_not_replace_a_ranked_one():
+    assert more_severe("urgent", "no_symptoms_found") == "urgent"
+    assert more_severe("unknown_severity", "moderate") == "moderate"
+    assert more_severe(None, "routine") == "routine"
+    assert more_severe("moderate", "urgent") == "urgent"
+
+
+def test_unknown_session_is_empty():
+    assert SessionContextStore().get("nope") == EMPTY_CONTEXT
@@ -0,0 +1,83 @@
+import random
+
+import pytest
+from google.api_core.exceptions import FailedPrecondition
+
+from work_queue import IndexedHeap, PatientWorkQueue, queue_key
+
+
+def test_indexed_heap_matches_a_sorted_reference():
+    rng = random.Random(7)
+    heap, reference = IndexedHeap(), {}
+    for _ in range(5000):
+        op = rng.random()
+        item_id = rng.randrange(200)
+        if op < 0.5:
+            key = (rng.randrange(5), rng.randrange(1000))
+            heap.push(item_id, key)
+            reference[item_id] = key
+        elif op < 0.7:
+            assert heap.remove(item_id) == (reference.pop(item_id, None) is not None)
+        elif op < 0.85:
+            expected = min(((key, i) for i, key in reference.items()), default=None)
+            assert heap.pop() == expected
+            if expected is not None:
+                del reference[expected[1]]
+        else:
+            k = rng.randrange(1, 20)
+            assert heap.smallest(k) == sorted((key, i) for i, key in reference.items())[:k]
+        assert len(heap) == len(reference)
+        assert heap.peek() == min(((key, i) for i, key in reference.items()), default=None)
+
+
+def test_push_moves_an_existing_item():
+    heap = IndexedHeap()
+    heap.push("a", (3, 1))
+    heap.push("b", (2, 1))
+    heap.push("a", (0, 5))
+    assert heap.pop() == ((0, 5), "a")
+    assert heap.pop() == ((2, 1), "b")
+    assert heap.pop() is None
+
+
+class FakeReference:
+    def __init__(self, error=None):
+        self.error = error
+        self.updates = []
+
+    def update(self, fields, option=None):
+        if self.error is not None:
+            raise self.error
+        self.updates.append(fields)
+
+
+class FakeDb:
+    def write_option(self, **kwargs):
+        return kwargs
+
+
+def make_queue(references):
+    queue = PatientWorkQueue(lambda: FakeDb())
+    for arrival, (doc_id, reference) in enumerate(references.items()):
+        data = {"severity": "urgent", "severity_rank": 1, "arrival_ms": arrival, "status": "queued"}
+        queue._docs[doc_id] = (data, None, reference)
+        queue._heap.push(doc_id, queue_key(data))
+    return queue
+
+
+def test_claim_skips_patients_claimed_elsewhere():
+    taken, free = FakeReference(FailedPrecondition("stale")), FakeReference()
+    queue = make_queue({"p1": taken, "p2": free})
+    assert queue.claim("nurse-1")["id"] == "p2"
+    assert free.updates[0]["claimed_by"] == "nurse-1"
+    assert len(queue) == 0
+
+
+def test_claim_puts_the_patient_back_when_the_update_fails():
+    flaky = FakeReference(TimeoutError("deadline exceeded"))
+    queue = make_queue({"p1": flaky})
+    with pytest.raises(TimeoutError):
+        queue.claim("nurse-1")
+    assert queue.top(1)[0]["id"] == "p1"
+    flaky.error = None
+    assert queue.claim("nurse-1")["id"] == "p1"
@@ -0,0 +1,69 @@
+import threading
+
+from google.api_core.exceptions import AlreadyExists
+
+from write_behind import Create, Merge, WriteBehindQueue
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self._db = db
+        self._writes = []
+        self._creates = []
+
+    def set(self, ref, data, merge=False):
+        self._writes.append(ref)
+
+    def create(self, ref, data):
+        self._writes.append(ref)
+        self._creates.append(ref)
+
+    def commit(self):
+        with self._db.lock:
+            if any(ref in self._db.stored for ref in self._creates) or len(set(self._creates)) < len(self._creates):
+                raise AlreadyExists("document already exists")
+            self._db.stored.update(self._writes)
+            self._db.commits.append(list(self._writes))
+
+
+class FakeDb:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commits = []
+        self.stored = set()
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def collection(self, path):
+        return self
+
+    def document(self, doc_id):
+        return doc_id
+
+
+def test_enqueue_many_is_never_split_across_commits():
+    db = FakeDb()
+    writer = WriteBehindQueue(lambda: db, max_batch_size=5, flush_interval_seconds=0.05)
+    groups = [[("patients", f"p{i}", {}), ("patients_raw", f"p{i}", {}), ("counters", f"c{i}", {})] for i in range(20)]
+    for group in groups:
+        writer.enqueue_many(group)
+    writer.drain()
+    committed = [doc for commit in db.commits for doc in commit]
+    assert sorted(committed) == sorted(doc_id for group in groups for _, doc_id, _ in group)
+    for commit in db.commits:
+        patients = {doc_id[1:] for doc_id in commit}
+        assert len(commit) == 3 * len(patients)  # whole groups only
+        assert len(commit) <= 5 or len(patients) == 1
+
+
+def test_a_group_whose_create_already_exists_is_dropped_with_its_increment():
+    db = FakeDb()
+    writer = WriteBehindQueue(lambda: db, max_batch_size=10, flush_interval_seconds=0.05)
+    rerun = [("patients", "p1", Create({"severity": "urgent"})), ("counters", "c1", Merge({"count": 1}))]
+    writer.enqueue_many(rerun)
+    writer.enqueue_many(rerun)  # the same turn again: same patient doc id, a second increment
+    writer.enqueue_many([("patients", "p2", Create({"severity": "routine"})), ("counters", "c2", Merge({"count": 1}))])
+    writer.drain()
+    committed = [doc for commit in db.commits for doc in commit]
+    assert sorted(committed) == ["c1", "c2", "p1", "p2"]
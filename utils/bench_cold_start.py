@@ -0,0 +1,79 @@
+"""
+Cold-start benchmark for the triage cloud functions.
+
+Every run starts a fresh Python interpreter (like a new instance after
+scale-up), imports the function module, then sends it one POST the way
+functions_framework would. It reports import time and import-to-first-response
+time over several runs. The real SDKs and credentials are used, so run it
+with the same environment the function is deployed with.
+
+    python utils/bench_cold_start.py --module triage_function_original --runs 5
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+CLOUD_FUNCTION_DIR = Path(__file__).resolve().parent.parent / "cloud_function"
+
+# Runs inside the child interpreter; prints one JSON line with its timings
+CHILD = r"""
+import importlib, json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {cloud_function_dir!r})
+module = importlib.import_module({module!r})
+imported = time.perf_counter()
+
+class Request:
+    method = "POST"
+    def get_json(self, silent=True):
+        return {{"message": {message!r}}}
+
+result = module.triage(Request())
+responded = time.perf_counter()
+print(json.dumps({{
+    "import_s": imported - start,
+    "first_request_s": responded - imported,
+    "import_to_first_response_s": responded - start,
+    "status": result[1] if isinstance(result, tuple) and len(result) > 1 else None,
+}}))
+"""
+
+
+def run_once(module, message):
+    code = CHILD.format(cloud_function_dir=str(CLOUD_FUNCTION_DIR), module=module, message=message)
+    completed = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    # The function prints its own logs, the timings are the last line
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def summarize(values):
+    values = sorted(values)
+    p90 = values[min(len(values) - 1, int(round(0.9 * (len(values) - 1))))]
+    return f"median {statistics.median(values) * 1000:8.1f} ms   p90 {p90 * 1000:8.1f} ms   max {values[-1] * 1000:8.1f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="triage_function_original",
+                        help="module in cloud_function/ to benchmark (default: triage_function_original)")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--message", default="My knee is swollen and really tender after a fall.")
+    args = parser.parse_args()
+
+    runs = []
+    for i in range(args.runs):
+        timings = run_once(args.module, args.message)
+        runs.append(timings)
+        print(f"run {i + 1}: import {timings['import_s'] * 1000:.1f} ms, "
+              f"first response {timings['import_to_first_response_s'] * 1000:.1f} ms (HTTP {timings['status']})")
+
+    print(f"\n{args.module} over {len(runs)} cold starts")
+    for key in ("import_s", "first_request_s", "import_to_first_response_s"):
+        print(f"  {key:<28} {summarize([r[key] for r in runs])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "cloud_function"))
+
+from knn_severity import DEFAULT_INDEX_PATH, KNNSeverityRetriever, embed  # noqa: E402
+from local_severity import NEVER, SEVERITY_LABELS  # noqa: E402
+
+DATA_DIR = ROOT / "fine_tuning_training"
+LABELED_FILES = [DATA_DIR / "symptom_severity.jsonl", DATA_DIR / "severity_train.jsonl"]  # {"text_input", "output_label"}
+CONVERSATION_FILE = DATA_DIR / "conversational_dataset.jsonl"  # {"messages": [user, model]}
+INDEX_FILE = Path(DEFAULT_INDEX_PATH)  # shipped next to the function, with its .json metadata
+
+DIM = 2 ** 11
+K = 5
+TARGET_PRECISION = 0.95  # leave-one-out precision a label needs before the vote may answer with it
+MIN_SUPPORT = 10  # ... measured on at least this many answers
+
+
+def load_examples():
+    """Read the three labeled sources and drop exact duplicates (they overlap almost entirely)."""
+    seen = set()
+    examples = []
+
+    def keep(text, label):
+        text, label = (text or "").strip(), (label or "").strip().lower()
+        if text and label in SEVERITY_LABELS and (text, label) not in seen:
+            seen.add((text, label))
+            examples.append((text, label))
+
+    for path in LABELED_FILES:
+        with path.open(encoding="utf-8") as fin:
+            for raw in fin:
+                if raw.strip():
+                    record = json.loads(raw)
+                    keep(record["text_input"], record["output_label"])
+    with CONVERSATION_FILE.open(encoding="utf-8") as fin:
+        for raw in fin:
+            if raw.strip():
+                turns = json.loads(raw)["messages"]
+                user = [t["contents"] for t in turns if t["role"] == "user"]
+                model = [t["contents"] for t in turns if t["role"] == "model"]
+                if user and model:
+                    keep(user[-1], model[-1])
+    return examples
+
+
+def leave_one_out(matrix, texts, labels):
+    """For every example, (vote shares, nearest similarity) of an index built from all the other examples."""
+    y = np.array([SEVERITY_LABELS.index(label) for label in labels])
+    shares = np.zeros((len(texts), len(SEVERITY_LABELS)))
+    nearest = np.zeros(len(texts))
+    for i in range(len(texts)):
+        rest = np.arange(len(texts)) != i
+        probe = KNNSeverityRetriever(matrix[rest], [t for t, r in zip(texts, rest) if r], np.array(labels)[rest], k=K)
+        vote_shares, _, top_sims = probe.vote([texts[i]])
+        shares[i], nearest[i] = vote_shares[0], top_sims[0, 0]
+    return shares, nearest, y
+
+
+def calibrate_thresholds(probe, shares, nearest, y):
+    """
+    Per label, the lowest vote share from which the leave-one-out fast-path answers
+    (similarity and escalation guards included) reach TARGET_PRECISION on MIN_SUPPORT
+    answers and never undertriage; NEVER if no share does.
+    """
+    thresholds = np.full(len(SEVERITY_LABELS), NEVER)
+    for label in range(len(SEVERITY_LABELS)):
+        answered = [(s[label], y_true) for s, n, y_true in zip(shares, nearest, y)
+                    if s.argmax() == label and probe.fast_path(s, n, threshold=0.0) is not None]
+        for t in sorted({share for share, _ in answered}):
+            kept = [y_true for share, y_true in answered if share >= t]
+            if len(kept) < MIN_SUPPORT:
+                break
+            if np.mean(np.array(kept) == label) >= TARGET_PRECISION and max(kept) <= label:
+                thresholds[label] = t  # max(kept) <= label: no answer below the true severity
+                break
+    return thresholds
+
+
+def report(probe, shares, nearest, y, thresholds):
+    accuracy = np.mean(shares.argmax(axis=1) == y)
+    print(f"Leave-one-out accuracy on {len(y)} examples: {accuracy:.3f}")
+    print(f"Fast-path thresholds (leave-one-out precision >= {TARGET_PRECISION} on >= {MIN_SUPPORT} answers, "
+          f"no undertriage):")
+    for label, name in enumerate(SEVERITY_LABELS):
+        if thresholds[label] >= NEVER:
+            print(f"  {name:<9} never")
+            continue
+        answered = [y_true for s, n, y_true in zip(shares, nearest, y)
+                    if s.argmax() == label and probe.fast_path(s, n, threshold=thresholds[label]) is not None]
+        correct = sum(y_true == label for y_true in answered)
+        print(f"  {name:<9} >= {thresholds[label]:.3f}: {len(answered)} answers, precision {correct / len(answered):.3f}")
+
+
+def main():
+    examples = load_examples()
+    texts = [text for text, _ in examples]
+    labels = [label for _, label in examples]
+    matrix = embed(texts, DIM)
+
+    retriever = KNNSeverityRetriever(matrix, texts, labels, k=K)
+    shares, nearest, y = leave_one_out(matrix, texts, labels)
+    retriever.thresholds = calibrate_thresholds(retriever, shares, nearest, y)
+    report(retriever, shares, nearest, y, retriever.thresholds)
+
+    retriever.save(INDEX_FILE)
+    print(f"Indexed {len(examples)} examples ({DIM} dims), wrote {INDEX_FILE}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,70 +1,226 @@
-# import json
-# from pathlib import Path
-
-# OLD_FILE = "conversational_dataset.jsonl"   # ← your existing file
-# NEW_FILE = "symptom_severity_new.jsonl"   # ← will be created
-
-# def convert_record(old_rec: dict) -> dict:
-#     """
-#     old_rec =
-#       {"messages": [
-#           {"role":"user",  "contents":"…"},
-#           {"role":"model", "contents":"routine"}
-#       ]}
-#     returns =
-#       {"contents":[
-#           {"role":"user","parts":[{"text":"…"}]},
-#           {"role":"model","parts":[{"text":"routine"}]}
-#       ]}
-#     """
-#     new_contents = [
-#         {
-#             "role": m["role"],
-#             "parts": [{"text": m["contents"]}]
-#         }
-#         for m in old_rec["messages"]
-#     ]
-#     return {"contents": new_contents}
-
-# with Path(OLD_FILE).open() as fin, Path(NEW_FILE).open("w") as fout:
-#     for line in fin:
-#         line = line.strip()
-#         if not line:                 # skip blank lines
-#             continue
-#         old = json.loads(line)
-#         new = convert_record(old)
-#         fout.write(json.dumps(new, ensure_ascii=False) + "\n")
-
-# print(f"Converted → {NEW_FILE}")
+"""
+Convert severity training data between the formats used in fine_tuning_training.
 
+Every input is read as a stream of (text, label) examples and every output is
+written as it goes, so memory stays flat however many rows there are.
+
+Input formats (detected from the extension / first record, or --from):
+    csv       "text",label rows, no header              (symptom_severity.csv)
+    labeled   {"text_input": ..., "output_label": ...}   (severity_train.jsonl)
+    messages  {"messages": [{"role", "contents"}, ...]}  (conversational_dataset.jsonl)
+    contents  {"contents": [{"role", "parts": [{"text"}]}, ...]}, one or many
+              user/model pairs per record; a model turn that is a JSON object
+              with a "severity" field (aibot_train.jsonl) counts as that label
+Records may span several lines (pretty-printed JSON). A single record holding
+the whole corpus, like symptom_severity_combined.jsonl, is necessarily read
+whole; write "contents" (one record per example) for large corpora instead.
+
+Output formats: csv, labeled, messages, contents, and combined (one
+{"contents": [...]} object with every turn, what this script used to write).
+
+With several inputs, each file is converted in its own process and the parts
+are concatenated in input order.
+
+    python utils/dataset_converter.py conversational_dataset.jsonl -o symptom_severity_combined.jsonl --to combined
+    python utils/dataset_converter.py a.csv b.jsonl c.jsonl -o all.jsonl --to labeled --workers 8
+"""
+import argparse
+import csv
+import io
 import json
-from pathlib import Path
-
-OLD_FILE = "conversational_dataset.jsonl"     # original file
-NEW_FILE = "symptom_severity_combined.jsonl"  # new file with one record
-
-def to_content(message):
-    """Turn {"role":..., "contents":...} → {"role":..., "parts":[{"text":...}]}"""
-    return {
-        "role": message["role"],
-        "parts": [{"text": message["contents"]}]
-    }
-
-all_contents = []
-
-# Read every line and append its user / model parts to one big list
-with Path(OLD_FILE).open() as fin:
-    for raw in fin:
-        raw = raw.strip()
-        if not raw:
-            continue
-        record = json.loads(raw)
-        for msg in record["messages"]:
-            all_contents.append(to_content(msg))
-
-# Write a single JSON object containing the aggregated contents array
-with Path(NEW_FILE).open("w") as fout:
-    json.dump({"contents": all_contents}, fout, ensure_ascii=False)
-    fout.write("\n")
-
-print(f"Created {NEW_FILE} with {len(all_contents)} dialogue turns.")
+import os
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+INPUT_FORMATS = ("csv", "labeled", "messages", "contents")
+OUTPUT_FORMATS = ("csv", "labeled", "messages", "contents", "combined")
+READ_CHUNK_CHARS = 1 << 16
+MAX_RECORD_CHARS = 1 << 26  # a value still undecoded past this many characters is treated as malformed
+
+
+# ---------------------------------------------------------------------------
+# Reading
+# ---------------------------------------------------------------------------
+def iter_json_values(path):
+    """
+    Yield each top-level JSON value of a file, whether one per line or pretty-printed over many.
+    Raises ValueError with the character offset of a malformed value as soon as more input can't fix
+    it, instead of buffering the rest of the file: a JSON token never spans a line break, so a decode
+    error with a newline after it is final, and so is a value longer than MAX_RECORD_CHARS.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    offset = 0  # characters of the file before buffer[0]
+    with open(path, encoding="utf-8") as fin:
+        while True:
+            chunk = fin.read(READ_CHUNK_CHARS)
+            buffer += chunk
+            while True:
+                stripped = buffer.lstrip()
+                offset += len(buffer) - len(stripped)
+                buffer = stripped
+                if not buffer:
+                    break
+                try:
+                    value, end = decoder.raw_decode(buffer)
+                except json.JSONDecodeError as e:
+                    if chunk and "\n" not in buffer[e.pos:] and len(buffer) <= MAX_RECORD_CHARS:
+                        break  # value continues in the next chunk
+                    raise ValueError(f"{path}: malformed JSON at character {offset + e.pos}: {e.msg}") from e
+                yield value
+                buffer = buffer[end:]
+                offset += end
+            if not chunk:
+                return
+
+
+def label_of(text):
+    """A model turn is either the bare label or a JSON object with a "severity" field."""
+    text = (text or "").strip()
+    if text.startswith("{"):
+        try:
+            return str(json.loads(text).get("severity", "")).strip()
+        except (ValueError, AttributeError):
+            return text
+    return text
+
+
+def pair_turns(turns):
+    """[(role, text), ...] -> (user text, model label) for every user turn answered by a model turn."""
+    pending = None
+    for role, text in turns:
+        if role == "user":
+            pending = text
+        elif role == "model" and pending is not None:
+            yield pending, label_of(text)
+            pending = None
+
+
+def read_csv(path):
+    with open(path, encoding="utf-8", newline="") as fin:
+        for row in csv.reader(fin):
+            if len(row) == 2:
+                yield row[0], row[1]
+
+
+def read_labeled(path):
+    for record in iter_json_values(path):
+        yield record["text_input"], record["output_label"]
+
+
+def read_messages(path):
+    for record in iter_json_values(path):
+        yield from pair_turns((m["role"], m["contents"]) for m in record["messages"])
+
+
+def read_contents(path):
+    for record in iter_json_values(path):
+        yield from pair_turns((c["role"], "".join(p.get("text", "") for p in c.get("parts", [])))
+                              for c in record.get("contents", []))
+
+
+READERS = {"csv": read_csv, "labeled": read_labeled, "messages": read_messages, "contents": read_contents}
+
+
+def detect_format(path):
+    if path.lower().endswith(".csv"):
+        return "csv"
+    first = next(iter_json_values(path), None)
+    if isinstance(first, dict):
+        for key, fmt in (("text_input", "labeled"), ("messages", "messages"), ("contents", "contents")):
+            if key in first:
+                return fmt
+    raise ValueError(f"Can't tell the format of {path}; pass --from")
+
+
+def read_examples(path, fmt=None):
+    """Stream (text, label) from one input file."""
+    for text, label in READERS[fmt or detect_format(path)](path):
+        text, label = (text or "").strip(), (label or "").strip()
+        if text and label:
+            yield text, label
+
+
+# ---------------------------------------------------------------------------
+# Writing: one serialized item per example; assemble() adds the combined wrapper
+# ---------------------------------------------------------------------------
+def format_item(fmt, text, label):
+    if fmt == "csv":
+        line = io.StringIO()
+        csv.writer(line, quoting=csv.QUOTE_MINIMAL, lineterminator="\n").writerow([text, label])
+        return line.getvalue()
+    if fmt == "labeled":
+        record = {"text_input": text, "output_label": label}
+    elif fmt == "messages":
+        record = {"messages": [{"role": "user", "contents": text}, {"role": "model", "contents": label}]}
+    else:  # contents / combined
+        turns = [{"role": "user", "parts": [{"text": text}]}, {"role": "model", "parts": [{"text": label}]}]
+        if fmt == "combined":
+            return ", ".join(json.dumps(t, ensure_ascii=False) for t in turns) + "\n"
+        record = {"contents": turns}
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+
+def convert_file(args):
+    """Worker: convert one input into a part file of serialized items; returns (part path, examples)."""
+    path, in_fmt, out_fmt, part_path = args
+    count = 0
+    with open(part_path, "w", encoding="utf-8", newline="") as fout:
+        for text, label in read_examples(path, in_fmt):
+            fout.write(format_item(out_fmt, text, label))
+            count += 1
+    return part_path, count
+
+
+def assemble(part_paths, output, out_fmt):
+    """Concatenate part files into the output; combined joins them into one JSON array."""
+    with open(output, "w", encoding="utf-8", newline="") as fout:
+        if out_fmt != "combined":
+            for part_path in part_paths:
+                with open(part_path, encoding="utf-8", newline="") as fin:
+                    shutil.copyfileobj(fin, fout)
+            return
+        fout.write('{"contents": [')
+        first = True
+        for part_path in part_paths:
+            with open(part_path, encoding="utf-8") as fin:
+                for line in fin:
+                    fout.write(("" if first else ", ") + line.rstrip("\n"))
+                    first = False
+        fout.write("]}\n")
+
+
+def convert(inputs, output, out_fmt, in_fmt=None, workers=None):
+    """Convert inputs (in order) into output; returns the number of examples written."""
+    workers = max(1, min(workers or os.cpu_count() or 1, len(inputs)))
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output))) as tmp:
+        jobs = [(path, in_fmt, out_fmt, os.path.join(tmp, f"part-{i:05d}")) for i, path in enumerate(inputs)]
+        if workers == 1:
+            results = [convert_file(job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(convert_file, jobs))
+        assemble([part for part, _ in results], output, out_fmt)
+    return sum(count for _, count in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="*", default=["conversational_dataset.jsonl"])
+    parser.add_argument("-o", "--output", default="symptom_severity_combined.jsonl")
+    parser.add_argument("--to", choices=OUTPUT_FORMATS, default="combined")
+    parser.add_argument("--from", dest="from_format", choices=INPUT_FORMATS,
+                        help="input format for every file (default: detect per file)")
+    parser.add_argument("--workers", type=int, help="processes for multi-file inputs (default: CPU count)")
+    args = parser.parse_args()
+
+    if os.path.abspath(args.output) in {os.path.abspath(p) for p in args.inputs}:
+        sys.exit("The output file can't also be an input.")
+    count = convert(args.inputs, args.output, args.to, args.from_format, args.workers)
+    print(f"Created {args.output} with {count} examples from {len(args.inputs)} file(s).")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+"""
+Find exact and near-duplicate examples across the training files, and
+duplicates that disagree on the label.
+
+    python utils/dedup_training_data.py                   # every file in fine_tuning_training
+    python utils/dedup_training_data.py train.jsonl other.csv --eval eval.jsonl --report dups.jsonl --clean clean.jsonl
+
+Pass 1 streams every file through dataset_converter's readers and hashes the
+normalized text (the normalization the triage caches use), so exact
+duplicates fall out of one dict lookup per row; only distinct texts are kept.
+Pass 2 computes MinHash signatures of the distinct texts' character shingles
+with NumPy, a batch at a time, and LSH banding (BANDS bands of ROWS values)
+proposes candidate pairs; pairs whose estimated Jaccard similarity reaches
+--threshold are merged into near-duplicate clusters.
+
+Reported: duplicate rows within and across files, label conflicts (the same
+or nearly the same text with different labels) and, with --eval, eval rows
+whose text is also in the training files. --report writes one JSON line per
+duplicate cluster; --clean writes one training example per cluster, without
+the clusters whose labels conflict and, with --eval, without every cluster
+that holds an eval row, so the cleaned set can't leak into the evaluation.
+
+Memory is about NUM_PERM * 4 bytes per distinct text plus the texts themselves.
+"""
+import argparse
+import hashlib
+import json
+import sys
+import time
+from array import array
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "cloud_function"))
+
+from caching import normalize_message  # noqa: E402
+from dataset_converter import OUTPUT_FORMATS, format_item, read_examples  # noqa: E402
+
+DATA_DIR = ROOT / "fine_tuning_training"
+
+SHINGLE = 5  # characters per shingle
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS  # candidate threshold ~ (1 / BANDS) ** (1 / ROWS) = 0.5
+MAX_BATCH_SHINGLES = 1 << 16  # bounds the (shingles x NUM_PERM) matrix of one batch
+VERIFY_CHUNK = 1 << 20
+SEED = 1
+
+
+# ---------------------------------------------------------------------------
+# Pass 1: exact duplicates
+# ---------------------------------------------------------------------------
+def text_hash(normalized):
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=8).digest()
+
+
+class Corpus:
+    """Every row as (distinct text id, file, label) in compact arrays, and each distinct text once."""
+
+    def __init__(self):
+        self.texts = []  # first-seen original text per distinct text id
+        self.ids = {}  # text hash -> distinct text id
+        self.labels = []
+        self._label_codes = {}
+        self.files = []
+        self.row_text = array("I")
+        self.row_file = array("H")
+        self.row_label = array("H")
+
+    def add_file(self, path):
+        file_code = len(self.files)
+        self.files.append(str(path))
+        for text, label in read_examples(str(path)):
+            key = text_hash(normalize_message(text))
+            text_id = self.ids.get(key)
+            if text_id is None:
+                text_id = self.ids[key] = len(self.texts)
+                self.texts.append(text)
+            label = label.lower()
+            label_code = self._label_codes.get(label)
+            if label_code is None:
+                label_code = self._label_codes[label] = len(self.labels)
+                self.labels.append(label)
+            self.row_text.append(text_id)
+            self.row_file.append(file_code)
+            self.row_label.append(label_code)
+
+    def arrays(self):
+        return (np.frombuffer(self.row_text, dtype=np.uint32).astype(np.int64),
+                np.frombuffer(self.row_file, dtype=np.uint16).astype(np.int64),
+                np.frombuffer(self.row_label, dtype=np.uint16).astype(np.int64))
+
+
+# ---------------------------------------------------------------------------
+# Pass 2: MinHash + LSH over the distinct texts
+# ---------------------------------------------------------------------------
+def shingle_hashes(texts):
+    """32-bit hashes of every SHINGLE-byte window of each text, and the index of each text's first one."""
+    encoded = [t.encode("utf-8").ljust(SHINGLE) for t in texts]
+    lengths = np.fromiter((len(b) for b in encoded), dtype=np.int64, count=len(encoded))
+    data = np.frombuffer(b"".join(encoded), dtype=np.uint8).astype(np.uint64)
+    counts = lengths - SHINGLE + 1
+    offsets = np.cumsum(lengths) - lengths
+    starts = np.cumsum(counts) - counts
+    positions = np.repeat(offsets - starts, counts) + np.arange(counts.sum())
+    hashes = np.zeros(len(positions), dtype=np.uint64)
+    for j in range(SHINGLE):
+        hashes = hashes * np.uint64(257) + data[positions + j]
+    return (hashes * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32), starts
+
+
+def minhash_signatures(texts, a, b):
+    """
+    (len(texts), NUM_PERM) uint32 MinHash signatures: per hash function, the
+    min over shingles of (a * x + b) mod 2**64 >> 32 (multiply-add-shift, a odd).
+    """
+    shingles, starts = shingle_hashes(texts)
+    values = (shingles[:, None] * a + b) >> np.uint64(32)  # uint64 arithmetic wraps mod 2**64
+    return np.minimum.reduceat(values, starts, axis=0).astype(np.uint32)
+
+
+def batches(texts):
+    batch, size = [], 0
+    for text in texts:
+        batch.append(text)
+        size += len(text) + 1
+        if size >= MAX_BATCH_SHINGLES:
+            yield batch
+            batch, size = [], 0
+    if batch:
+        yield batch
+
+
+def signatures_of(texts):
+    rng = np.random.default_rng(SEED)
+    a = rng.integers(0, 1 << 64, NUM_PERM, dtype=np.uint64, endpoint=False) | np.uint64(1)
+    b = rng.integers(0, 1 << 64, NUM_PERM, dtype=np.uint64, endpoint=False)
+    signatures = np.empty((len(texts), NUM_PERM), dtype=np.uint32)
+    done = 0
+    for batch in batches(normalize_message(t) for t in texts):
+        signatures[done:done + len(batch)] = minhash_signatures(batch, a, b)
+        done += len(batch)
+    return signatures
+
+
+def lsh_candidates(signatures):
+    """
+    (i, j) pairs of rows sharing all ROWS values of at least one band. Each
+    bucket becomes a star around its lowest index, so pairs grow linearly with
+    bucket size; clustering recovers the transitive links.
+    """
+    n = len(signatures)
+    pairs = []
+    for band in range(BANDS):
+        keys = np.zeros(n, dtype=np.uint64)
+        for column in range(band * ROWS, (band + 1) * ROWS):
+            keys = keys * np.uint64(0x100000001B3) + signatures[:, column]
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        bucket_start = np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1]))
+        leaders = order[np.maximum.accumulate(np.where(bucket_start, np.arange(n), 0))]
+        members = leaders != order
+        pairs.append(np.stack([leaders[members], order[members]], axis=1))
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def similar_pairs(signatures, pairs, threshold):
+    """Candidate pairs whose estimated Jaccard similarity (share of equal MinHash values) is >= threshold."""
+    keep = np.zeros(len(pairs), dtype=bool)
+    for start in range(0, len(pairs), VERIFY_CHUNK):
+        chunk = pairs[start:start + VERIFY_CHUNK]
+        keep[start:start + len(chunk)] = (signatures[chunk[:, 0]] == signatures[chunk[:, 1]]).mean(axis=1) >= threshold
+    return pairs[keep]
+
+
+def connected_components(n, pairs):
+    """Component of every node, labelled by its smallest member (hook to the smaller root, then pointer-jump)."""
+    parent = np.arange(n)
+    i, j = pairs[:, 0], pairs[:, 1]
+    while True:
+        while True:
+            jumped = parent[parent]
+            if np.array_equal(jumped, parent):
+                break
+            parent = jumped
+        pi, pj = parent[i], parent[j]
+        if np.array_equal(pi, pj):
+            return parent
+        lower = np.minimum(pi, pj)
+        np.minimum.at(parent, pi, lower)
+        np.minimum.at(parent, pj, lower)
+
+
+# ---------------------------------------------------------------------------
+# Report
+# ---------------------------------------------------------------------------
+def distinct_per_group(groups, values, n_groups):
+    """Number of distinct values in each group."""
+    pairs = np.unique(groups * (values.max(initial=0) + 1) + values)
+    return np.bincount(pairs // (values.max(initial=0) + 1), minlength=n_groups)
+
+
+def cluster_report(corpus, cluster, row_text, row_file, row_label):
+    """One dict per cluster holding more than one row, in order of first appearance."""
+    row_cluster = cluster[row_text]
+    order = np.argsort(row_cluster, kind="stable")
+    bounds = np.flatnonzero(np.diff(row_cluster[order])) + 1
+    for rows in np.split(order, bounds):
+        if len(rows) < 2:
+            continue
+        text_ids = np.unique(row_text[rows])
+        labels = np.bincount(row_label[rows], minlength=len(corpus.labels))
+        files = np.bincount(row_file[rows], minlength=len(corpus.files))
+        yield {
+            "cluster": int(row_cluster[rows[0]]),
+            "rows": len(rows),
+            "near": len(text_ids) > 1,
+            "conflict": int((labels > 0).sum()) > 1,
+            "labels": {corpus.labels[k]: int(c) for k, c in enumerate(labels) if c},
+            "files": {Path(corpus.files[k]).name: int(c) for k, c in enumerate(files) if c},
+            "texts": [corpus.texts[t] for t in text_ids],
+        }
+
+
+def default_inputs():
+    return sorted(p for p in DATA_DIR.iterdir() if p.suffix in (".csv", ".json", ".jsonl"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="*", type=Path, help="training files (default: all of fine_tuning_training)")
+    parser.add_argument("--eval", nargs="*", type=Path, default=[], help="held-out files to check for leakage")
+    parser.add_argument("--threshold", type=float, default=0.8, help="Jaccard similarity of near-duplicates")
+    parser.add_argument("--report", type=Path, help="write every duplicate cluster as JSON lines")
+    parser.add_argument("--clean", type=Path,
+                        help="write one training example per cluster, without label conflicts or eval overlap")
+    parser.add_argument("--to", choices=OUTPUT_FORMATS[:-1], default="labeled", help="format of --clean")
+    parser.add_argument("--show", type=int, default=10, help="label conflicts to print")
+    args = parser.parse_args()
+
+    train_files = args.inputs or default_inputs()
+    corpus = Corpus()
+    started = time.perf_counter()
+    for path in train_files + args.eval:
+        corpus.add_file(path)
+    row_text, row_file, row_label = corpus.arrays()
+    n_rows, n_texts = len(row_text), len(corpus.texts)
+    print(f"Pass 1: {n_rows} rows, {n_texts} distinct texts in {len(corpus.files)} files "
+          f"({time.perf_counter() - started:.1f}s)")
+
+    started = time.perf_counter()
+    signatures = signatures_of(corpus.texts)
+    candidates = lsh_candidates(signatures)
+    similar = similar_pairs(signatures, candidates, args.threshold)
+    cluster = connected_components(n_texts, similar)
+    n_clusters = int((cluster == np.arange(n_texts)).sum())
+    print(f"Pass 2: {len(candidates)} LSH candidate pairs, {len(similar)} at Jaccard >= {args.threshold}, "
+          f"{n_clusters} clusters ({time.perf_counter() - started:.1f}s)")
+
+    files_per_text = distinct_per_group(row_text, row_file, n_texts)
+    labels_per_text = distinct_per_group(row_text, row_label, n_texts)
+    labels_per_cluster = distinct_per_group(cluster[row_text], row_label, n_texts)
+    text_rows = np.bincount(row_text, minlength=n_texts)
+    print(f"Exact duplicates: {n_rows - n_texts} rows; {int((text_rows > 1).sum())} texts repeated, "
+          f"{int((files_per_text > 1).sum())} of them across files")
+    print(f"Near duplicates: {n_texts - n_clusters} more texts fold into another text's cluster")
+    print(f"Label conflicts: {int((labels_per_text > 1).sum())} exact texts, "
+          f"{int((labels_per_cluster > 1).sum())} clusters")
+
+    is_eval = row_file >= len(train_files)
+    eval_clusters = np.zeros(n_texts, dtype=bool)
+    eval_clusters[cluster[row_text[is_eval]]] = True
+    if args.eval:
+        train_texts = np.zeros(n_texts, dtype=bool)
+        train_texts[row_text[~is_eval]] = True
+        train_clusters = np.zeros(n_texts, dtype=bool)
+        train_clusters[cluster[row_text[~is_eval]]] = True
+        exact = train_texts[row_text[is_eval]]
+        near = train_clusters[cluster[row_text[is_eval]]] & ~exact
+        print(f"Eval leakage: {int(exact.sum())} of {int(is_eval.sum())} eval rows are in the training files, "
+              f"{int(near.sum())} more nearly")
+
+    shown = 0
+    report = args.report.open("w", encoding="utf-8") if args.report else None
+    try:
+        for entry in cluster_report(corpus, cluster, row_text, row_file, row_label):
+            if report is not None:
+                report.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            if entry["conflict"] and shown < args.show:
+                near = f" (+{len(entry['texts']) - 1} near)" if entry["near"] else ""
+                print(f"  {entry['labels']} {entry['texts'][0]!r}{near}")
+                shown += 1
+    finally:
+        if report is not None:
+            report.close()
+            print(f"Wrote {args.report}")
+
+    if args.clean:
+        first_row = np.full(n_texts, n_rows)
+        np.minimum.at(first_row, row_text, np.arange(n_rows))
+        written = 0
+        # Clusters without eval rows only hold training texts, so the representative and its label come from them
+        keep = (cluster == np.arange(n_texts)) & (labels_per_cluster[cluster] == 1) & ~eval_clusters
+        with args.clean.open("w", encoding="utf-8", newline="") as fout:
+            for text_id in np.flatnonzero(keep):
+                label = corpus.labels[row_label[first_row[text_id]]]
+                fout.write(format_item(args.to, corpus.texts[text_id], label))
+                written += 1
+        print(f"Wrote {written} examples to {args.clean}"
+              + (f", leaving out {int((eval_clusters & (cluster == np.arange(n_texts))).sum())} clusters shared with --eval"
+                 if args.eval else ""))
+
+
+if __name__ == "__main__":
+    main()
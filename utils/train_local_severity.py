@@ -0,0 +1,135 @@
+import csv
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "cloud_function"))
+
+from local_severity import NEVER, SEVERITY_LABELS, LocalSeverityModel, hashed_features  # noqa: E402
+
+JSONL_FILE = ROOT / "fine_tuning_training" / "severity_train.jsonl"   # {"text_input": ..., "output_label": ...}
+CSV_FILE = ROOT / "fine_tuning_training" / "symptom_severity.csv"     # "text",label (no header)
+MODEL_FILE = ROOT / "cloud_function" / "local_severity_model.npz"      # shipped next to the function
+
+N_FEATURES = 2 ** 14
+EPOCHS = 400
+LEARNING_RATE = 0.5
+L2 = 1e-3
+FOLDS = 5  # cross-validation folds for the accuracy report and the fast-path thresholds
+TARGET_PRECISION = 0.95  # held-out precision a label needs before the fast path may answer with it
+MIN_SUPPORT = 10  # ... measured on at least this many held-out answers
+
+
+def load_examples():
+    """Read both labeled sources and drop exact duplicates (they overlap almost entirely)."""
+    seen = set()
+    examples = []
+
+    def keep(text, label):
+        text, label = text.strip(), label.strip().lower()
+        if text and label in SEVERITY_LABELS and (text, label) not in seen:
+            seen.add((text, label))
+            examples.append((text, label))
+
+    with JSONL_FILE.open(encoding="utf-8") as fin:
+        for raw in fin:
+            if raw.strip():
+                record = json.loads(raw)
+                keep(record["text_input"], record["output_label"])
+    with CSV_FILE.open(encoding="utf-8", newline="") as fin:
+        for row in csv.reader(fin):
+            if len(row) == 2:
+                keep(row[0], row[1])
+    return examples
+
+
+def vectorize(texts):
+    X = np.zeros((len(texts), N_FEATURES), dtype=np.float32)
+    for i, text in enumerate(texts):
+        X[i, hashed_features(text, N_FEATURES)] = 1.0
+    return X
+
+
+def train(X, y):
+    """Full-batch softmax regression with L2; the corpus is tiny so this runs in seconds."""
+    n_labels = len(SEVERITY_LABELS)
+    W = np.zeros((X.shape[1], n_labels), dtype=np.float32)
+    b = np.zeros(n_labels, dtype=np.float32)
+    Y = np.eye(n_labels, dtype=np.float32)[y]
+    for _ in range(EPOCHS):
+        logits = X @ W + b
+        logits -= logits.max(axis=1, keepdims=True)
+        P = np.exp(logits)
+        P /= P.sum(axis=1, keepdims=True)
+        G = (P - Y) / len(X)
+        W -= LEARNING_RATE * (X.T @ G + L2 * W)
+        b -= LEARNING_RATE * G.sum(axis=0)
+    return LocalSeverityModel(W, b, SEVERITY_LABELS)
+
+
+def cross_validated_probs(texts, X, y):
+    """Out-of-fold class probabilities for every example."""
+    probs = np.zeros((len(texts), len(SEVERITY_LABELS)))
+    fold = np.arange(len(texts)) % FOLDS
+    for k in range(FOLDS):
+        probe = train(X[fold != k], y[fold != k])
+        for i in np.flatnonzero(fold == k):
+            probs[i] = probe.predict_proba(texts[i])
+    return probs
+
+
+def calibrate_thresholds(model, probs, y):
+    """
+    Per label, the lowest confidence from which the held-out fast-path answers
+    (escalation guard included) reach TARGET_PRECISION on MIN_SUPPORT answers
+    and never undertriage; NEVER if no confidence does.
+    """
+    thresholds = np.full(len(SEVERITY_LABELS), NEVER)
+    for label in range(len(SEVERITY_LABELS)):
+        answered = [(p[label], y_true) for p, y_true in zip(probs, y)
+                    if model.fast_path(p, threshold=0.0) is not None and p.argmax() == label]
+        for t in sorted({conf for conf, _ in answered}):
+            kept = [y_true for conf, y_true in answered if conf >= t]
+            if len(kept) < MIN_SUPPORT:
+                break
+            if np.mean(np.array(kept) == label) >= TARGET_PRECISION and max(kept) <= label:
+                thresholds[label] = t  # max(kept) <= label: no answer below the true severity
+                break
+    return thresholds
+
+
+def report(probs, y, thresholds, model):
+    accuracy = np.mean(probs.argmax(axis=1) == y)
+    print(f"{FOLDS}-fold cross-validated accuracy on {len(y)} examples: {accuracy:.3f}")
+    print(f"Fast-path thresholds (held-out precision >= {TARGET_PRECISION} on >= {MIN_SUPPORT} answers, "
+          f"no undertriage):")
+    for label, name in enumerate(SEVERITY_LABELS):
+        answered = [(p, y_true) for p, y_true in zip(probs, y)
+                    if p.argmax() == label and model.fast_path(p, threshold=thresholds[label]) is not None]
+        if thresholds[label] >= NEVER:
+            print(f"  {name:<9} never")
+            continue
+        correct = sum(y_true == label for _, y_true in answered)
+        print(f"  {name:<9} >= {thresholds[label]:.3f}: {len(answered)} answers, precision {correct / len(answered):.3f}")
+
+
+def main():
+    examples = load_examples()
+    texts = [text for text, _ in examples]
+    y = np.array([SEVERITY_LABELS.index(label) for _, label in examples])
+    X = vectorize(texts)
+
+    probs = cross_validated_probs(texts, X, y)
+    model = train(X, y)
+    model.thresholds = calibrate_thresholds(model, probs, y)
+    report(probs, y, model.thresholds, model)
+
+    model.save(MODEL_FILE)
+    print(f"Trained on {len(examples)} examples, wrote {MODEL_FILE}")
+
+
+if __name__ == "__main__":
+    main()